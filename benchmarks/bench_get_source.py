@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+compare the cost of resolving a sample's source line with inspect.stack()
+against mongodrums.util.source.SourceResolver
+
+"""
+
+import inspect
+import sys
+import timeit
+
+from argparse import ArgumentParser
+
+from mongodrums.util.source import SourceResolver
+
+
+FILTER_PACKAGES = ['pymongo', 'mongoengine', 'mongodrums']
+
+
+def inspect_source():
+    frame = filter(lambda f: f[0].f_globals.get('__package__') \
+                             not in FILTER_PACKAGES,
+                   inspect.stack()[1:])[0]
+    try:
+        return '%s:%d' % (frame[1], frame[2])
+    finally:
+        del frame
+
+
+_resolver = SourceResolver(FILTER_PACKAGES)
+
+
+def resolver_source():
+    return _resolver.resolve(sys._getframe(1))
+
+
+def call_at_depth(func, depth):
+    if depth == 0:
+        return func()
+    return call_at_depth(func, depth - 1)
+
+
+def main():
+    parser = ArgumentParser('benchmark source resolution')
+    parser.add_argument('-d', '--depth', type=int, default=30,
+                        help='stack depth to resolve from [default: '
+                             '%(default)s]')
+    parser.add_argument('-n', '--number', type=int, default=2000,
+                        help='calls per repetition [default: %(default)s]')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='repetitions [default: %(default)s]')
+    args = parser.parse_args()
+
+    expected = call_at_depth(inspect_source, args.depth)
+    actual = call_at_depth(resolver_source, args.depth)
+    if expected != actual:
+        print 'MISMATCH: inspect.stack gave %s, resolver gave %s' % \
+              (expected, actual)
+        return 1
+
+    results = {}
+    for name, func in [('inspect.stack', inspect_source),
+                       ('SourceResolver', resolver_source)]:
+        best = min(timeit.repeat(lambda: call_at_depth(func, args.depth),
+                                 number=args.number, repeat=args.repeat))
+        results[name] = best / args.number
+        print '%-16s %10.2f us/call' % (name, results[name] * 1e6)
+    print 'speedup: %.1fx' % (results['inspect.stack'] /
+                              results['SourceResolver'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
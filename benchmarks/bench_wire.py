@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+compare encoding and decoding a typical explain record with the legacy JSON
+wire format against the binary BSON one
+
+"""
+
+import sys
+import timeit
+
+from argparse import ArgumentParser
+from datetime import datetime
+
+from bson.json_util import dumps, loads
+from bson.objectid import ObjectId
+
+from mongodrums import wire
+
+
+def make_msg():
+    plan = {'cursor': 'BtreeCursor store_1_widget_1_sold_-1',
+            'isMultiKey': False,
+            'n': 899,
+            'nscannedObjects': 899,
+            'nscanned': 899,
+            'scanAndOrder': False,
+            'indexOnly': False,
+            'nYields': 7,
+            'nChunkSkips': 0,
+            'millis': 3,
+            'indexBounds': {'store': [[{'$minElement': 1},
+                                       {'$maxElement': 1}]],
+                            'widget': [[{'$minElement': 1},
+                                        {'$maxElement': 1}]],
+                            'sold': [[1.7976931348623157e+308, 100]]}}
+    explain = dict(plan)
+    explain.update({'allPlans': [dict(plan) for i in xrange(3)],
+                    'server': 'localhost:27017',
+                    'filterSet': False})
+    return {'type': 'explain',
+            'function': 'find',
+            'database': 'store',
+            'collection': 'widgets',
+            'query': '{"sold": {"$gt": 100}}',
+            'source': '/srv/app/store/models.py:123',
+            'plan_id': str(ObjectId()),
+            'created': datetime.utcnow(),
+            'explain': explain}
+
+
+def main():
+    parser = ArgumentParser('benchmark the pusher/collector wire formats')
+    parser.add_argument('-n', '--number', type=int, default=5000,
+                        help='calls per repetition [default: %(default)s]')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='repetitions [default: %(default)s]')
+    args = parser.parse_args()
+
+    msg = make_msg()
+    json_data = dumps(msg)
+    bson_data = wire.encode(msg, 'bson')
+    cases = [('json encode', lambda: dumps(msg)),
+             ('bson encode', lambda: wire.encode(msg, 'bson')),
+             ('json decode', lambda: loads(json_data)),
+             ('bson decode', lambda: wire.decode(bson_data)),
+             ('json decode (wire)', lambda: wire.decode(json_data))]
+    print 'json size: %d bytes, bson size: %d bytes' % (len(json_data),
+                                                         len(bson_data))
+    for name, func in cases:
+        best = min(timeit.repeat(func, number=args.number,
+                                 repeat=args.repeat))
+        print '%-20s %10.2f us/msg' % (name, best / args.number * 1e6)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
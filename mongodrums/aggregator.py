@@ -0,0 +1,160 @@
+"""
+In process pre-aggregation of sampled explains, pushed periodically as one
+summary record per (database, collection, function, skeleton, index,
+source)
+
+"""
+
+import atexit
+import logging
+import os
+import threading
+
+from bson.errors import InvalidDocument
+
+from .config import get_config, register_update_callback
+from .plan import plan_summary
+from .pusher import push
+from .util import skeleton
+from .util.histogram import Histogram
+
+
+class _Entry(object):
+    def __init__(self, msg):
+        self.msg = msg
+        self.count = 0
+        self.hits = 0
+        self.millis = Histogram()
+        self.durations = Histogram()
+
+    def add(self, msg):
+        self.count += 1
+        if msg.get('cached', False):
+            self.hits += 1
+        else:
+            # keep the most recent full explain as the representative one
+            self.msg = msg
+            millis = plan_summary(msg)['millis']
+            if millis is not None:
+                self.millis.add(millis)
+        if 'duration' in msg:
+            self.durations.add(msg['duration'])
+
+    def to_summary(self):
+        summary = dict([(k, v) for k, v in self.msg.iteritems()
+                        if k not in ('type', 'cached', 'duration')])
+        summary.update({'type': 'explain_summary',
+                        'count': self.count,
+                        'hits': self.hits,
+                        'millis': self.millis.to_document()})
+        if self.durations.count > 0:
+            summary['durations'] = self.durations.to_document()
+        return summary
+
+
+class Aggregator(object):
+    def __new__(cls, *args, **kwargs):
+        if not hasattr(cls, '_instance'):
+            cls._instance = super(cls, Aggregator).__new__(cls, *args,
+                                                           **kwargs)
+            cls._instance._initialized = False
+        return cls._instance
+
+    def __init__(self):
+        if not self._initialized:
+            self._reset()
+            self._stopped = False
+            self._configure(get_config())
+            register_update_callback(self._configure)
+            self._initialized = True
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._size = 0
+        self._thread = None
+        self._wake = threading.Event()
+
+    def _check_fork(self):
+        # a forked child starts its own flush thread, what the parent had
+        # aggregated is pushed by the parent
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _configure(self, config):
+        self._flush_interval = config.instrument.aggregate.flush_interval
+        self._flush_size = config.instrument.aggregate.flush_size
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='mongodrums-aggregator')
+            self._thread.daemon = True
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self._flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def stop(self):
+        """ Stop the flush thread, pushing whatever has been aggregated
+
+        """
+        self._stopped = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _key(self, msg):
+        return (msg['database'], msg['collection'], msg['function'],
+                skeleton(msg['query']), plan_summary(msg)['index'],
+                msg['source'])
+
+    def add(self, msg):
+        """ Aggregate an explain record, records that can't be aggregated
+        (explain errors, queries without a skeleton) are pushed as is
+
+        """
+        key = None
+        if 'error' not in msg['explain']:
+            try:
+                key = self._key(msg)
+            except (InvalidDocument, ValueError):
+                pass
+        if key is None:
+            push(msg)
+            return
+        self._check_fork()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry(msg)
+            entry.add(msg)
+            self._size += 1
+            full = self._size >= self._flush_size
+        if self._thread is None:
+            self._start()
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        self._check_fork()
+        with self._lock:
+            entries, self._entries = self._entries, {}
+            self._size = 0
+        for entry in entries.itervalues():
+            try:
+                push(entry.to_summary())
+            except Exception:
+                logging.exception('failed to push explain summary')
+
+
+def add(msg):
+    Aggregator().add(msg)
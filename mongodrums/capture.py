@@ -0,0 +1,72 @@
+"""
+Capture files of the raw datagrams a collector received, for replaying
+collector load
+
+A capture file starts with ``MAGIC`` and the format version, followed by one
+record per datagram: a ``RECORD`` header (the time it was received, the
+length of the source address and the length of the datagram), the source
+address as ``host:port`` (empty for unix sockets) and the datagram itself.
+
+"""
+
+import struct
+import time
+
+
+MAGIC = 'MDCAP'
+VERSION = 1
+
+HEADER = struct.Struct('!5sB')
+RECORD = struct.Struct('!dHI')
+
+
+def format_address(address):
+    if isinstance(address, tuple):
+        return '%s:%d' % (address[0], address[1])
+    return address or ''
+
+
+def parse_address(address):
+    if not address:
+        return None
+    host, port = address.rsplit(':', 1)
+    return (host, int(port))
+
+
+class CaptureWriter(object):
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, VERSION))
+
+    def write(self, data, address, timestamp=None):
+        address = format_address(address)
+        self._file.write(
+            RECORD.pack(time.time() if timestamp is None else timestamp,
+                        len(address), len(data)) + address + data)
+
+    def close(self):
+        self._file.close()
+
+
+def read_capture(path):
+    """ Yield the ``(timestamp, address, datagram)`` records of a capture
+    file, addresses as ``(host, port)`` or None
+
+    """
+    with open(path, 'rb') as f:
+        magic, version = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError('%s is not a capture file' % (path))
+        if version != VERSION:
+            raise ValueError('unsupported capture version %d' % (version))
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            timestamp, address_len, data_len = RECORD.unpack(header)
+            address = f.read(address_len)
+            data = f.read(data_len)
+            if len(data) < data_len:
+                # cut short by a collector that didn't stop cleanly
+                break
+            yield (timestamp, parse_address(address), data)
@@ -1,3 +1,6 @@
+import logging
+import random
+
 import pymongo
 
 from inflection import underscore
@@ -7,6 +10,9 @@ from .bindings import bindings
 from .document import (
     Document, SessionDocument, IndexProfileDocument, QueryProfileDocument
 )
+from .plan import cursor_index, summarize
+from .util import merge_update
+from .util.histogram import Histogram
 
 
 class MongoDrumsCollection(ObjectCollection):
@@ -59,16 +65,201 @@ class SessionCollection(MongoDrumsCollection):
 
 
 class IndexProfileCollection(MongoDrumsCollection):
+    """ Index profiles, built by :class:`~mongodrums.sink.IndexProfileSink`
+
+    The indexes it relies on are only built by :meth:`ensure_indexes`, so
+    reports can read profiles without writing to the database.
+
+    """
     _default_class = IndexProfileDocument
 
-    def __init__(self, collection):
-        super(IndexProfileCollection, self).__init__(collection)
+    # the index names of profiles keyed by a legacy explain's cursor
+    LEGACY_INDEX = r'^(BtreeCursor |BasicCursor|IDCursor$)'
+
+    def ensure_indexes(self):
+        self._migrate()
+        self._rekey()
         self.collection.ensure_index([('session', pymongo.ASCENDING),
                                       ('collection', pymongo.ASCENDING),
                                       ('index', pymongo.ASCENDING)],
                                      unique=True)
 
+    def _migrate(self):
+        # profiles written before they were aggregated keep their queries in
+        # a list, the sink's updates address them by query key
+        from .sink import query_key
+        migrated = 0
+        for doc in self.collection.find({'$or': [
+                {'queries.0': {'$exists': True}}, {'queries': []}]}):
+            queries = {}
+            for q in doc['queries']:
+                durations = Histogram()
+                for millis in q.get('durations', []):
+                    durations.add(millis)
+                queries[query_key(q['query'])] = {
+                    'query': q['query'],
+                    'count': q.get('count', 0),
+                    'covered': q.get('covered', False),
+                    'durations': durations.to_document()
+                }
+            # only while the list is untouched, so each is migrated once
+            result = self.collection.update(
+                {'_id': doc['_id'], 'queries': doc['queries']},
+                {'$set': {'queries': queries}})
+            migrated += result['n']
+        if migrated > 0:
+            logging.info('migrated %d index profiles to keyed queries' %
+                         (migrated))
+
+    def _rekey(self):
+        # profiles were first keyed by the legacy explain's cursor, their
+        # queries are folded into the profile of the index it names
+        rekeyed = 0
+        while True:
+            doc = self.collection.find_and_modify(
+                {'index': {'$regex': self.__class__.LEGACY_INDEX}},
+                remove=True)
+            if doc is None:
+                break
+            update = {}
+            for key, query in doc.get('queries', {}).iteritems():
+                prefix = 'queries.%s.' % (key)
+                merge_update(update,
+                              {'$inc': {prefix + 'count':
+                                        query.get('count', 0)},
+                               '$set': {prefix + 'query': query['query'],
+                                        prefix + 'covered':
+                                        query.get('covered', False)}})
+                if isinstance(query.get('durations'), dict):
+                    merge_update(update, Histogram.from_document(
+                        query['durations']).to_update(prefix + 'durations'))
+                for name, value in query.get('scan', {}).iteritems():
+                    field = '%sscan.%s' % (prefix, name)
+                    if isinstance(value, dict):
+                        merge_update(update, Histogram.from_document(
+                            value).to_update(field))
+                    else:
+                        merge_update(update, {'$inc': {field: value}})
+            if len(update) > 0:
+                self.collection.update(
+                    {'session': doc['session'],
+                     'collection': doc['collection'],
+                     'index': cursor_index(doc['index'])},
+                    update, upsert=True)
+            rekeyed += 1
+        if rekeyed > 0:
+            logging.info('rekeyed %d index profiles by index' % (rekeyed))
+
 
 class QueryProfileCollection(MongoDrumsCollection):
+    """ Query profiles, built by :class:`~mongodrums.sink.QueryProfileSink`,
+    one per :attr:`KEY`
+
+    The indexes it relies on are only built by :meth:`ensure_indexes`, so
+    reports can read profiles without writing to the database.
+
+    """
     _default_class = QueryProfileDocument
 
+    KEY = ('session', 'database', 'collection', 'function', 'query', 'source',
+           'index')
+
+    def ensure_indexes(self, samples):
+        """ Build the indexes, first folding the documents stored per sample
+        (before profiles were counted) into profiles keeping up to
+        ``samples`` sample explains and rekeying the profiles keyed by
+        ``cursor`` (before plans were summarized) by ``index``, the unique
+        index on :attr:`KEY` can't be built over either
+
+        """
+        key = [(field, pymongo.ASCENDING) for field in self.__class__.KEY]
+        name = '_'.join(['%s_%d' % (field, direction)
+                         for field, direction in key])
+        indexes = self.collection.index_information()
+        if name not in indexes:
+            # profiles were first keyed by the legacy explain's cursor
+            for stale, info in indexes.iteritems():
+                if 'cursor' in [field for field, _ in info['key']]:
+                    self.collection.drop_index(stale)
+            self._migrate(samples)
+            self._rekey(samples)
+        self.collection.ensure_index(key, unique=True)
+        # for reports, which look up the queries using an index
+        self.collection.ensure_index([('collection', pymongo.ASCENDING),
+                                      ('index', pymongo.ASCENDING),
+                                      ('session', pymongo.ASCENDING)])
+
+    def _migrate(self, samples):
+        migrated = dropped = 0
+        while True:
+            # taken one at a time, so each is folded in once however many
+            # collectors are starting
+            doc = self.collection.find_and_modify(
+                {'count': {'$exists': False}}, remove=True)
+            if doc is None:
+                break
+            try:
+                plan = summarize(doc['explain'])
+            except (KeyError, ValueError):
+                # failed explains aren't profiled any more
+                dropped += 1
+                continue
+            seen = doc['_id'].generation_time.replace(tzinfo=None)
+            q = dict([(field, doc.get(field))
+                      for field in self.__class__.KEY])
+            q['index'] = plan['index']
+            update = {'$inc': {'count': 1, 'hits': 0},
+                      '$min': {'first_seen': seen},
+                      '$max': {'last_seen': seen},
+                      '$set': {'explain': doc['explain'], 'plan': plan},
+                      '$push': {'samples': {
+                          '$each': [{'explain': doc['explain'], 'seen': seen,
+                                     'priority': random.random()}],
+                          '$sort': {'priority': 1},
+                          '$slice': samples}}}
+            if plan['millis'] is not None:
+                millis = Histogram()
+                millis.add(plan['millis'])
+                merge_update(update, millis.to_update('millis'))
+            self.collection.update(q, update, upsert=True)
+            migrated += 1
+        if migrated > 0 or dropped > 0:
+            logging.info('folded %d query profile samples into counted '
+                         'profiles, dropped %d failed explains' %
+                         (migrated, dropped))
+
+    def _rekey(self, samples):
+        rekeyed = 0
+        while True:
+            doc = self.collection.find_and_modify(
+                {'cursor': {'$exists': True}}, remove=True)
+            if doc is None:
+                break
+            q = dict([(field, doc.get(field))
+                      for field in self.__class__.KEY])
+            update = {'$inc': {'count': doc.get('count', 0),
+                               'hits': doc.get('hits', 0)},
+                      '$set': {'explain': doc['explain']},
+                      '$push': {'samples': {
+                          '$each': [dict(sample, priority=random.random())
+                                    if 'priority' not in sample else sample
+                                    for sample in doc.get('samples', [])],
+                          '$sort': {'priority': 1},
+                          '$slice': samples}}}
+            try:
+                plan = summarize(doc['explain'])
+                q['index'] = plan['index']
+                update['$set']['plan'] = plan
+            except (KeyError, ValueError):
+                q['index'] = cursor_index(doc['cursor'])
+            for op, field in [('$min', 'first_seen'), ('$max', 'last_seen')]:
+                if doc.get(field) is not None:
+                    update.setdefault(op, {})[field] = doc[field]
+            for field in ['millis', 'durations']:
+                if isinstance(doc.get(field), dict):
+                    merge_update(update, Histogram.from_document(
+                        doc[field]).to_update(field))
+            self.collection.update(q, update, upsert=True)
+            rekeyed += 1
+        if rekeyed > 0:
+            logging.info('rekeyed %d query profiles by index' % (rekeyed))
@@ -2,30 +2,75 @@
 TODO: add dtls support
 
 """
+import errno
+import json
 import logging
+import multiprocessing
+import os
+import signal
+import socket
 import threading
+import time
 
 from datetime import datetime
 
 import pymongo
 import gevent
+import gevent.lock
+import gevent.queue
+import gevent.socket
 
-from bson.json_util import loads
+from gevent.pywsgi import WSGIServer
 from gevent.server import DatagramServer
 
+from . import wire
 from .config import get_config
+from .capture import CaptureWriter
 from .collection import SessionCollection
-from .util import get_default_database
+from .sink import BACKEND_ERRORS
+from .spool import Spool
+from .util import get_default_database, skeleton_stats, unix_socket_path
+from .util.histogram import Histogram
+
+
+def _run_worker(listener, sinks, stats_port, spool_dir, capture_path):
+    # the parent handles ^C and stops workers with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    gevent.reinit()
+    server = Collector(listener, reuse_port=True, stats_port=stats_port,
+                       spool_dir=spool_dir, capture_path=capture_path)
+    for sink in (sinks() if callable(sinks) else sinks):
+        server.add_sink(sink)
+    gevent.signal(signal.SIGTERM, server.stop)
+    server.serve_forever()
 
 
 class CollectorRunner(threading.Thread):
-    def __init__(self, sinks=None):
+    """ Run a collector until stopped
+
+    With more than one worker the collector is run in that many processes,
+    each with its own socket bound to the same address with
+    ``SO_REUSEPORT`` (so the kernel spreads pushers across them) and its
+    own sinks. ``sinks`` can be a callable returning the sinks, called in
+    each worker, rather than a list that is copied into each worker when it
+    is forked. Workers that die are restarted. Worker ``i`` serves its
+    stats on ``collector.stats.port + i``, spools to ``worker-i`` in
+    ``collector.spool.directory`` and captures to ``collector.capture.i``.
+
+    """
+    # how often, in seconds, workers are checked on
+    SUPERVISE_INTERVAL = .5
+    # how long, in seconds, stopped workers get to exit before being killed
+    STOP_TIMEOUT = 10
+
+    def __init__(self, sinks=None, workers=None):
         threading.Thread.__init__(self)
         self.daemon = False
 
         self._server = None
         self._stop = threading.Event()
         self._sinks = [] if sinks is None else sinks
+        self._workers = workers
 
     @property
     def server(self):
@@ -37,65 +82,617 @@ class CollectorRunner(threading.Thread):
         if self._server is not None:
             self._server.stop()
 
-    def run(self):
+    def _start_session(self, session):
+        mongo_uri = get_config().collector.mongo_uri
+        client = pymongo.MongoClient(mongo_uri)
+        db = get_default_database(client, mongo_uri)
+        session_col = SessionCollection(
+                            db[SessionCollection.get_collection_name()])
+        try:
+            session_col.insert({'name': session,
+                                'start_time': datetime.utcnow()})
+        except pymongo.errors.DuplicateKeyError:
+            logging.warning('session %s already exists, end time will be '
+                            'updated' % (session))
+        return session_col
+
+    def _serve(self, listener):
         config = get_config()
-        self._server = Collector((config.collector.addr,
-                                  config.collector.port))
-        for sink in self._sinks:
+        self._server = Collector(listener,
+                                 stats_port=config.collector.stats.port,
+                                 spool_dir=config.collector.spool.directory,
+                                 capture_path=config.collector.capture)
+        for sink in (self._sinks() if callable(self._sinks)
+                     else self._sinks):
             self._server.add_sink(sink)
         stop_check = gevent.spawn(self._check_stopped)
-        session_col = None
-        if self._server.session is not None:
-            mongo_uri = get_config().collector.mongo_uri
-            client = pymongo.MongoClient(mongo_uri)
-            db = get_default_database(client, mongo_uri)
-            session_col = SessionCollection(
-                                db[SessionCollection.get_collection_name()])
-            try:
-                session_col.insert({'name': self._server.session,
-                                    'start_time': datetime.utcnow()})
-            except pymongo.errors.DuplicateKeyError:
-                logging.warning('session %s already exists, end time will be '
-                                'updated' % (self._server.session))
         try:
             self._server.serve_forever()
         finally:
             stop_check.join()
+
+    def _start_worker(self, listener, index):
+        config = get_config()
+        stats_port = config.collector.stats.port
+        if stats_port:
+            stats_port += index
+        spool_dir = config.collector.spool.directory
+        if spool_dir is not None:
+            spool_dir = os.path.join(spool_dir, 'worker-%d' % (index))
+        capture_path = config.collector.capture
+        if capture_path is not None:
+            capture_path = '%s.%d' % (capture_path, index)
+        worker = multiprocessing.Process(target=_run_worker,
+                                         args=(listener, self._sinks,
+                                               stats_port, spool_dir,
+                                               capture_path),
+                                         name='mongodrums-collector-%d' %
+                                              (index))
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    def _supervise(self, listener, num_workers):
+        if unix_socket_path(listener[0]) is not None:
+            raise ValueError('collector workers need a udp address')
+        workers = [self._start_worker(listener, i)
+                   for i in xrange(num_workers)]
+        try:
+            while not self._stop.wait(self.__class__.SUPERVISE_INTERVAL):
+                for i, worker in enumerate(workers):
+                    if not worker.is_alive():
+                        logging.warning('collector worker %d exited with %s, '
+                                        'restarting' %
+                                        (worker.pid, worker.exitcode))
+                        workers[i] = self._start_worker(listener, i)
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+            deadline = time.time() + self.__class__.STOP_TIMEOUT
+            for worker in workers:
+                worker.join(max(0, deadline - time.time()))
+                if worker.is_alive():
+                    logging.warning('killing collector worker %d' %
+                                    (worker.pid))
+                    os.kill(worker.pid, signal.SIGKILL)
+                    worker.join()
+
+    def run(self):
+        config = get_config()
+        listener = (config.collector.addr, config.collector.port)
+        num_workers = self._workers
+        if num_workers is None:
+            num_workers = config.collector.workers
+        session_col = None
+        if config.collector.session is not None:
+            session_col = self._start_session(config.collector.session)
+        try:
+            if num_workers > 1:
+                self._supervise(listener, num_workers)
+            else:
+                self._serve(listener)
+        finally:
             if session_col is not None:
-                session_col.update({'name': self._server.session},
+                session_col.update({'name': config.collector.session},
                                    {'$set': {'end_time': datetime.utcnow()}})
 
-
     def stop(self):
         self._stop.set()
 
 
+def _histogram_stats(histogram, full):
+    return histogram.to_document() if full else histogram.summary()
+
+
+class SinkQueue(object):
+    """ Hand messages to a sink through a bounded queue drained by consumer
+    greenlets, so a slow sink only holds up (and drops) its own messages
+
+    With a :class:`~mongodrums.spool.Spool` messages that don't fit in the
+    queue, that arrive within ``collector.spool.retry_interval`` seconds of
+    the sink failing, or that the sink failed to handle (up to
+    ``collector.spool.max_attempts`` times) are spooled instead of dropped.
+    They are replayed into the queue in batches of
+    ``collector.spool.batch_size`` once it has room and the sink has stopped
+    failing. Only errors of the sink's backend (see
+    :data:`~mongodrums.sink.BACKEND_ERRORS`) count as the sink failing,
+    messages the sink can't handle for any other reason are dropped.
+
+    The sink is flushed (see :meth:`~mongodrums.sink.Sink.flush`) every
+    ``collector.sink_queue.flush_interval`` seconds, whenever it is
+    :meth:`~mongodrums.sink.Sink.full`, once the queue is joined and when it
+    stops, one flush at a time. A failed flush counts as the sink failing,
+    and the sink isn't flushed again (but for the queue being joined) until
+    ``collector.spool.retry_interval`` seconds later.
+
+    """
+    # how often, in seconds, the spool is checked for records to replay
+    REPLAY_INTERVAL = 1
+
+    def __init__(self, sink, size, workers, name=None, spool=None):
+        config = get_config()
+        self.sink = sink
+        self.name = name if name is not None else sink.__class__.__name__
+        self._queue = gevent.queue.JoinableQueue(size)
+        self._num_workers = workers
+        self._workers = None
+        self._spool = spool
+        self._replayer = None
+        self._flusher = None
+        self._flush_lock = gevent.lock.Semaphore()
+        self._flush_interval = config.collector.sink_queue.flush_interval
+        self._batch_size = config.collector.spool.batch_size
+        self._retry_interval = config.collector.spool.retry_interval
+        self._max_attempts = config.collector.spool.max_attempts
+        self._last_error = 0
+        self._stats = {'enqueued': 0, 'handled': 0, 'dropped': 0,
+                       'errors': 0, 'max_queued': 0, 'spooled': 0,
+                       'replayed': 0}
+        # milliseconds spent waiting in the queue and in the sink
+        self._wait_times = Histogram()
+        self._handle_times = Histogram()
+
+    def start(self):
+        if self._workers is not None:
+            return
+        self._workers = [gevent.spawn(self._work)
+                         for i in xrange(self._num_workers)]
+        if self._spool is not None:
+            self._replayer = gevent.spawn(self._replay)
+        self._flusher = gevent.spawn(self._flush_loop)
+
+    def _spool_put(self, msg, address, attempts):
+        try:
+            spooled = self._spool.append({'msg': msg, 'address': address,
+                                          'attempts': attempts})
+        except Exception:
+            logging.exception('failed to spool data for sink %s' %
+                              (self.name))
+            spooled = False
+        self._stats['spooled' if spooled else 'dropped'] += 1
+        return spooled
+
+    def _failing(self):
+        return time.time() - self._last_error < self._retry_interval
+
+    def _work(self):
+        while True:
+            msg, address, queued, attempts = self._queue.get()
+            start = time.time()
+            self._wait_times.add((start - queued) * 1000)
+            try:
+                self.sink.handle(msg, address)
+                self._stats['handled'] += 1
+                if self.sink.full() and not self._failing():
+                    self._flush()
+            except BACKEND_ERRORS:
+                self._stats['errors'] += 1
+                self._last_error = time.time()
+                logging.exception('sink %s failed to handle data <%s>' %
+                                  (self.name, str(msg)))
+                if self._spool is not None and \
+                        attempts + 1 < self._max_attempts:
+                    self._spool_put(msg, address, attempts + 1)
+            except Exception:
+                # bad data fails however often it is retried, and says
+                # nothing about whether the sink is up
+                self._stats['errors'] += 1
+                logging.exception('sink %s failed to handle data <%s>' %
+                                  (self.name, str(msg)))
+            finally:
+                self._handle_times.add((time.time() - start) * 1000)
+                self._queue.task_done()
+
+    def _flush(self):
+        with self._flush_lock:
+            try:
+                self.sink.flush()
+            except Exception:
+                self._stats['errors'] += 1
+                self._last_error = time.time()
+                logging.exception('sink %s failed to flush' % (self.name))
+
+    def _flush_loop(self):
+        while True:
+            gevent.sleep(self._flush_interval)
+            if not self._failing():
+                self._flush()
+
+    def _room(self):
+        """ Get how many spooled records can be replayed into the queue,
+        leaving half of it for live messages (or, if it is unbounded, keeping
+        no more than a batch queued)
+
+        """
+        if self._queue.maxsize is None:
+            return self._batch_size - self._queue.qsize()
+        return self._queue.maxsize // 2 - self._queue.qsize()
+
+    def _replay_records(self, records):
+        """ Queue spooled records, spooling them again if live messages
+        have filled the queue, returning how many were queued
+
+        """
+        for i, record in enumerate(records):
+            address = record['address']
+            if isinstance(address, list):
+                address = tuple(address)
+            try:
+                self._queue.put_nowait((record['msg'], address, time.time(),
+                                        record['attempts']))
+            except gevent.queue.Full:
+                for record in records[i:]:
+                    self._spool_put(record['msg'], record['address'],
+                                    record['attempts'])
+                return i
+        return len(records)
+
+    def _replay(self):
+        replayed = 0
+        while True:
+            gevent.sleep(self.__class__.REPLAY_INTERVAL)
+            if self._failing():
+                continue
+            # after a failure probe with a single record, so a sink that is
+            # still failing doesn't use up the attempts of a whole batch
+            probe = self._last_error > replayed
+            replayed = time.time()
+            # live messages are queued while the consumers are at a batch, so
+            # the room left is checked before each one
+            room = self._room()
+            while room > 0 and not self._spool.empty():
+                records = self._spool.read(1 if probe else
+                                           min(room, self._batch_size))
+                queued = self._replay_records(records)
+                self._stats['replayed'] += queued
+                if probe or queued < len(records):
+                    break
+                # let the consumers at the batch
+                gevent.sleep(0)
+                room = self._room()
+
+    def put(self, msg, address):
+        """ Queue a message, spooling or dropping it if the queue is full
+
+        """
+        if self._workers is None:
+            self.start()
+        if self._spool is not None and self._failing():
+            # don't wait on a sink that is failing
+            return self._spool_put(msg, address, 0)
+        try:
+            self._queue.put_nowait((msg, address, time.time(), 0))
+        except gevent.queue.Full:
+            if self._spool is not None:
+                return self._spool_put(msg, address, 0)
+            self._stats['dropped'] += 1
+            return False
+        self._stats['enqueued'] += 1
+        queued = self._queue.qsize()
+        if queued > self._stats['max_queued']:
+            self._stats['max_queued'] = queued
+        return True
+
+    def join(self, timeout=None):
+        """ Wait for every queued message to be handled, and flush the sink
+
+        """
+        joined = self._queue.join(timeout)
+        self._flush()
+        return joined
+
+    def stop(self, timeout=None):
+        """ Wait for the queue to drain, then stop the consumers, anything
+        still spooled is kept for next time
+
+        """
+        if self._workers is None:
+            return
+        if self._replayer is not None:
+            self._replayer.kill()
+            self._replayer = None
+        # not in the middle of a flush, which would lose what it was writing
+        with self._flush_lock:
+            self._flusher.kill()
+        self._flusher = None
+        self.join(timeout)
+        gevent.killall(self._workers)
+        self._workers = None
+        if self._spool is not None:
+            self._spool.close()
+
+    def stats(self, histograms=False):
+        stats = dict(self._stats)
+        stats.update({'queued': self._queue.qsize(),
+                      'wait_ms': _histogram_stats(self._wait_times,
+                                                  histograms),
+                      'handle_ms': _histogram_stats(self._handle_times,
+                                                    histograms)})
+        if self._spool is not None:
+            stats['spool'] = self._spool.stats()
+        sink_stats = self.sink.stats()
+        if sink_stats is not None:
+            stats['sink'] = sink_stats
+        return stats
+
+
+def udp_socket_stats(sock):
+    """ Get the kernel's receive queue length (in bytes) and drop count for
+    a udp socket from ``/proc/net/udp``, or None when they aren't available
+
+    """
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+        for path in ('/proc/net/udp', '/proc/net/udp6'):
+            with open(path) as f:
+                # skip the headings
+                lines = f.readlines()[1:]
+            for line in lines:
+                # sl local_address rem_address st tx_queue:rx_queue
+                # tr:tm->when retrnsmt uid timeout inode ref pointer drops
+                values = line.split()
+                if values[9] == inode:
+                    return {'rx_queue': int(values[4].split(':')[1], 16),
+                            'drops': int(values[12])}
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _remove_stale_socket(path):
+    # a socket file nobody is bound to any more is left behind by a collector
+    # that didn't stop cleanly, one that is still in use is left alone so bind
+    # fails
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        probe.connect(path)
+    except socket.error as e:
+        if e.errno == errno.ECONNREFUSED:
+            os.unlink(path)
+    finally:
+        probe.close()
+
+
 class Collector(DatagramServer):
-    def __init__(self, listener, spawn='default'):
+    """ Receive pushed datagrams and hand their messages to sinks
+
+    ``listener`` is anything gevent's :class:`DatagramServer` accepts, or a
+    ``unix:///path`` address (on its own or as the address of an
+    ``(addr, port)`` pair) to listen on a unix datagram socket instead. With
+    ``reuse_port`` the socket is bound with ``SO_REUSEPORT`` so several
+    collectors can share a udp address.
+
+    Each sink is fed through its own :class:`SinkQueue`, spooling to a
+    directory named after the sink in ``spool_dir`` if given. While running,
+    :meth:`stats` are served as JSON over HTTP on ``stats_port`` (on
+    ``collector.stats.addr``), if given, and logged every
+    ``collector.stats.log_interval`` seconds. ``/histograms`` serves them
+    with full histograms rather than summaries. Datagrams received are
+    recorded to a capture file (see :mod:`mongodrums.capture`) at
+    ``capture_path`` if given.
+
+    """
+    # large enough for any UDP datagram, gevent only reads 8k by default
+    RECV_SIZE = 65535
+    # unix datagrams aren't limited to 64k, this allows for the pusher's
+    # pusher.unix.max_datagram_size with room to spare
+    UNIX_RECV_SIZE = 2 ** 18
+    # how long, in seconds, sinks get to handle what is queued on stop
+    SINK_STOP_TIMEOUT = 10
+
+    def __init__(self, listener, spawn='default', reuse_port=False,
+                 stats_port=None, spool_dir=None, capture_path=None):
+        self._unix_path = None
+        self._reuse_port = reuse_port
+        self._spool_dir = spool_dir
+        self._capture_path = capture_path
+        self._capture = None
         DatagramServer.__init__(self, listener, self.handle, spawn)
+        config = get_config()
         self._sinks = []
-        self._session = get_config().collector.session
+        self._sink_queue_size = config.collector.sink_queue.size
+        self._sink_queue_workers = config.collector.sink_queue.workers
+        self._session = config.collector.session
+        self._reassembler = \
+            wire.Reassembler(config.collector.reassembly.timeout,
+                             config.collector.reassembly.max_bytes)
+        self._stats_addr = (config.collector.stats.addr, stats_port)
+        self._stats_log_interval = config.collector.stats.log_interval
+        self._stats_server = None
+        self._stats_logger = None
+        self._started = time.time()
+        self._counters = {'datagrams': 0, 'bytes': 0, 'messages': 0,
+                          'decode_errors': 0}
+        # milliseconds spent decoding datagrams and handling them as a whole
+        self._decode_times = Histogram()
+        self._handle_times = Histogram()
 
     @property
     def session(self):
         return self._session
 
-    def add_sink(self, sink):
-        self._sinks.append(sink)
+    def set_listener(self, listener):
+        path = unix_socket_path(listener[0] if isinstance(listener, tuple)
+                                else listener)
+        if path is None:
+            DatagramServer.set_listener(self, listener)
+        else:
+            self.family, self.address = socket.AF_UNIX, path
 
-    def handle(self, data, address):
-        logging.debug('processing data from %s:\n%s' % (str(address), data))
-        if isinstance(data, basestring):
+    def get_listener(self, address, family=None):
+        if family == socket.AF_UNIX:
+            sock = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            if os.path.exists(address):
+                _remove_stale_socket(address)
+        elif self._reuse_port:
+            sock = gevent.socket.socket(family, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        else:
+            return DatagramServer.get_listener(address, family)
+        sock.bind(address)
+        return sock
+
+    def init_socket(self):
+        DatagramServer.init_socket(self)
+        if self.family == socket.AF_UNIX:
+            self._unix_path = self.address
+
+    def close(self):
+        DatagramServer.close(self)
+        if self._unix_path is not None:
             try:
-                if data.strip()[0] == '{':
-                    data = loads(data)
-                    data.update({'session': self._session})
-            except (ValueError, IndexError):
+                os.unlink(self._unix_path)
+            except OSError:
                 pass
-        for sink in self._sinks:
-            try:
-                sink.handle(data, address)
-            except Exception:
-                logging.exception('sink %s failed to handle data <%s>' %
-                                  (sink.__class__.__name__, str(data)))
+            self._unix_path = None
+
+    def do_read(self):
+        if self.family == socket.AF_UNIX:
+            size = self.__class__.UNIX_RECV_SIZE
+        else:
+            size = self.__class__.RECV_SIZE
+        try:
+            data, address = self._socket.recvfrom(size)
+        except socket.error as err:
+            if err.args[0] == errno.EWOULDBLOCK:
+                return
+            raise
+        return data, address
+
+    def add_sink(self, sink, queue_size=None, workers=None):
+        """ Add a sink, with its own queue of ``queue_size`` messages drained
+        by ``workers`` greenlets [default: collector.sink_queue settings]
+
+        """
+        name = sink.__class__.__name__
+        if name in [sink_queue.name for sink_queue in self._sinks]:
+            name = '%s-%d' % (name, len(self._sinks))
+        spool = None
+        if self._spool_dir is not None:
+            config = get_config()
+            spool = Spool(os.path.join(self._spool_dir, name),
+                          config.collector.spool.segment_size,
+                          config.collector.spool.max_size)
+        self._sinks.append(
+            SinkQueue(sink,
+                      queue_size if queue_size is not None
+                      else self._sink_queue_size,
+                      workers if workers is not None
+                      else self._sink_queue_workers,
+                      name, spool))
+
+    def join_sinks(self, timeout=None):
+        """ Wait for every sink to handle what has been queued for it
+
+        """
+        for sink_queue in self._sinks:
+            sink_queue.join(timeout)
+
+    def start(self):
+        if self._capture_path is not None:
+            self._capture = CaptureWriter(self._capture_path)
+        DatagramServer.start(self)
+        self._started = time.time()
+        for sink_queue in self._sinks:
+            sink_queue.start()
+        if self._stats_addr[1]:
+            self._stats_server = WSGIServer(self._stats_addr,
+                                            self._serve_stats, log=None)
+            self._stats_server.start()
+        if self._stats_log_interval > 0:
+            self._stats_logger = gevent.spawn(self._log_stats)
+
+    def stop(self, timeout=None):
+        DatagramServer.stop(self, timeout)
+        if self._stats_server is not None:
+            self._stats_server.stop()
+            self._stats_server = None
+        if self._stats_logger is not None:
+            self._stats_logger.kill()
+            self._stats_logger = None
+        for sink_queue in self._sinks:
+            sink_queue.stop(self.__class__.SINK_STOP_TIMEOUT)
+        if self._capture is not None:
+            self._capture.close()
+            self._capture = None
+
+    def _serve_stats(self, environ, start_response):
+        histograms = environ.get('PATH_INFO') == '/histograms'
+        body = json.dumps(self.stats(histograms), sort_keys=True)
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
 
+    def _log_stats(self):
+        while True:
+            gevent.sleep(self._stats_log_interval)
+            logging.info('collector stats: %s' %
+                         (json.dumps(self.stats(), sort_keys=True)))
+
+    def stats(self, histograms=False):
+        """ Get receive, decode and per sink counters and timings, along with
+        the kernel's receive queue stats for the socket and the skeleton
+        cache's hit rate
+
+        :param histograms:  include the timing histograms in full rather than
+                            summarized
+
+        """
+        stats = {'pid': os.getpid(),
+                 'uptime': time.time() - self._started,
+                 'receive': dict(self._counters),
+                 'decode_ms': _histogram_stats(self._decode_times,
+                                               histograms),
+                 'handle_ms': _histogram_stats(self._handle_times,
+                                               histograms),
+                 'reassembly': self._reassembler.stats(),
+                 'sinks': self.sink_stats(histograms),
+                 'skeleton_cache': skeleton_stats(),
+                 'kernel': None}
+        if self.family != socket.AF_UNIX and self._socket is not None:
+            stats['kernel'] = udp_socket_stats(self._socket)
+        return stats
+
+    def sink_stats(self, histograms=False):
+        """ Get the queue stats of each sink, by sink class name
+
+        """
+        return dict([(sink_queue.name, sink_queue.stats(histograms))
+                     for sink_queue in self._sinks])
+
+    def _decode(self, data, address):
+        """ Get the messages carried by a datagram
+
+        """
+        start = time.time()
+        try:
+            if wire.is_fragment(data):
+                data = self._reassembler.add(address, data)
+                if data is None:
+                    return []
+            msgs = wire.decode(data)
+        except Exception:
+            self._counters['decode_errors'] += 1
+            logging.exception('failed to decode data from pusher')
+            return []
+        finally:
+            self._decode_times.add((time.time() - start) * 1000)
+        for msg in msgs:
+            if isinstance(msg, dict):
+                msg.update({'session': self._session})
+        return msgs
+
+    def handle(self, data, address):
+        start = time.time()
+        logging.debug('processing data from %s:\n%s', address, data)
+        self._counters['datagrams'] += 1
+        self._counters['bytes'] += len(data)
+        if self._capture is not None:
+            self._capture.write(data, address, start)
+        msgs = self._decode(data, address)
+        self._counters['messages'] += len(msgs)
+        for msg in msgs:
+            for sink_queue in self._sinks:
+                sink_queue.put(msg, address)
+        self._handle_times.add((time.time() - start) * 1000)
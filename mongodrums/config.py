@@ -6,23 +6,115 @@ ConfigManager().load(
     {
         'instrument': {
             'sample_frequency': 0.1,
-            'filter_packages': ['pymongo', 'mongoengine', 'mongodrums']
+            'filter_packages': ['pymongo', 'mongoengine', 'mongodrums'],
+            'async_explain': {
+                'enabled': False,
+                'workers': 2,
+                'queue_size': 1000
+            },
+            'explain_cache': {
+                'size': 1024,
+                'ttl': 60
+            },
+            'sampling': {
+                'decay': 0.01,
+                'min_frequency': 0.001,
+                'max_shapes': 10000,
+                'max_per_second': 100,
+                'burst': 100
+            },
+            'timing': {
+                'enabled': True,
+                'flush_interval': 10
+            },
+            'aggregate': {
+                'enabled': False,
+                'flush_interval': 5,
+                'flush_size': 1000
+            }
+        },
+        'skeleton': {
+            'cache_size': 10000,
+            'collapse': {
+                'enabled': False,
+                'operators': ['$in', '$nin', '$all', '$or', '$nor', '$and']
+            }
+        },
+        'cardinality_guard': {
+            'max_keys': 1000,
+            'candidates': 4000
         },
         'collector': {
             'addr': '127.0.0.1',
             'port': 63333,
+            'workers': 1,
             'session': None,
-            'mongo_uri': 'mongodb://127.0.0.1:27017/mongodrums_profile'
+            'capture': None,
+            'mongo_uri': 'mongodb://127.0.0.1:27017/mongodrums_profile',
+            'reassembly': {
+                'timeout': 5,
+                'max_bytes': 16777216
+            },
+            'sink_queue': {
+                'size': 10000,
+                'workers': 4,
+                'flush_interval': 1
+            },
+            'spool': {
+                'directory': None,
+                'segment_size': 16777216,
+                'max_size': 1073741824,
+                'batch_size': 1000,
+                'retry_interval': 5,
+                'max_attempts': 3
+            },
+            'stats': {
+                'addr': '127.0.0.1',
+                'port': None,
+                'log_interval': 60
+            }
         },
         'pusher': {
             'addr': '127.0.0.1',
-            'port': 63333
+            'port': 63333,
+            'format': 'json',
+            'compress_threshold': 0,
+            'max_datagram_size': 65000,
+            'queue': {
+                'size': 10000,
+                'overflow': 'drop_oldest'
+            },
+            'unix': {
+                'max_datagram_size': 131072,
+                'fallback_addr': '127.0.0.1',
+                'retry_interval': 5
+            },
+            'batch': {
+                'enabled': False,
+                'max_size': 1472,
+                'interval': 0.05
+            }
         },
         'index_profile_sink': {
-            'mongo_uri': 'mongodb://127.0.0.1:27017/mongodrums_profile'
+            'mongo_uri': 'mongodb://127.0.0.1:27017/mongodrums_profile',
+            'flush_size': 10000,
+            'max_buffered': 100000
         },
         'query_profile_sink': {
+            'mongo_uri': 'mongodb://127.0.0.1:27017/mongodrums_profile',
+            'flush_size': 10000,
+            'max_buffered': 100000,
+            'samples': 5
+        },
+        'timing_sink': {
             'mongo_uri': 'mongodb://127.0.0.1:27017/mongodrums_profile'
+        },
+        'top_k_sink': {
+            'mongo_uri': 'mongodb://127.0.0.1:27017/mongodrums_profile',
+            'size': 1000,
+            'k': 20,
+            'snapshot_interval': 60,
+            'path': None
         }
     }, False, CONFIG_NAMESPACE)
 
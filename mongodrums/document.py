@@ -173,7 +173,14 @@ class QueryProfileDocument(Document):
         self._collection = None
         self._source = None
         self._function = None
+        self._query = None
+        self._index = None
+        self._plan = None
         self._explain = None
+        self._count = None
+        self._first_seen = None
+        self._last_seen = None
+        self._samples = None
 
     @property
     def session(self):
@@ -215,6 +222,30 @@ class QueryProfileDocument(Document):
     def function(self, function):
         self._function = function
 
+    @property
+    def query(self):
+        return self._query
+
+    @query.setter
+    def query(self, query):
+        self._query = query
+
+    @property
+    def index(self):
+        return self._index
+
+    @index.setter
+    def index(self, index):
+        self._index = index
+
+    @property
+    def plan(self):
+        return self._plan
+
+    @plan.setter
+    def plan(self, plan):
+        self._plan = plan
+
     @property
     def explain(self):
         return self._explain
@@ -223,3 +254,35 @@ class QueryProfileDocument(Document):
     def explain(self, explain):
         self._explain = explain
 
+    @property
+    def count(self):
+        return self._count
+
+    @count.setter
+    def count(self, count):
+        self._count = count
+
+    @property
+    def first_seen(self):
+        return self._first_seen
+
+    @first_seen.setter
+    def first_seen(self, first_seen):
+        self._first_seen = first_seen
+
+    @property
+    def last_seen(self):
+        return self._last_seen
+
+    @last_seen.setter
+    def last_seen(self, last_seen):
+        self._last_seen = last_seen
+
+    @property
+    def samples(self):
+        return self._samples
+
+    @samples.setter
+    def samples(self, samples):
+        self._samples = samples
+
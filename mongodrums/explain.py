@@ -0,0 +1,140 @@
+"""
+Background explain workers so sampled calls don't pay for the explain round
+trip on the caller's thread
+
+"""
+
+import logging
+import os
+import threading
+import Queue
+
+from .config import get_config, register_update_callback
+
+
+class ExplainPool(object):
+    def __new__(cls, *args, **kwargs):
+        if not hasattr(cls, '_instance'):
+            cls._instance = super(cls, ExplainPool).__new__(cls, *args,
+                                                            **kwargs)
+            cls._instance._initialized = False
+        return cls._instance
+
+    def __init__(self):
+        if not self._initialized:
+            self._reset()
+            self._num_workers = None
+            self._queue_size = None
+            self._configure(get_config())
+            register_update_callback(self._configure)
+            self._initialized = True
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._queue = None
+        self._workers = []
+        self._stats = {'submitted': 0, 'completed': 0, 'dropped': 0,
+                       'errors': 0}
+
+    def _check_fork(self):
+        # a forked child starts its own workers, the explains the parent had
+        # queued are run by the parent's
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _configure(self, config):
+        num_workers = config.instrument.async_explain.workers
+        queue_size = config.instrument.async_explain.queue_size
+        with self._lock:
+            if (num_workers, queue_size) != (self._num_workers,
+                                             self._queue_size):
+                self._stop_workers()
+                self._num_workers = num_workers
+                self._queue_size = queue_size
+
+    def _start_workers(self):
+        # the queue itself is unbounded so stop sentinels can always be
+        # enqueued, submit enforces queue_size
+        self._queue = Queue.Queue()
+        self._workers = []
+        for i in xrange(self._num_workers):
+            worker = threading.Thread(target=self._work, args=(self._queue,),
+                                      name='mongodrums-explain-%d' % (i))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _stop_workers(self):
+        # workers drain whatever is left in their queue before exiting
+        if self._queue is not None:
+            for worker in self._workers:
+                self._queue.put(None)
+        self._queue = None
+        self._workers = []
+
+    def _incr(self, stat):
+        with self._stats_lock:
+            self._stats[stat] += 1
+
+    def _work(self, queue):
+        while True:
+            job = queue.get()
+            try:
+                if job is None:
+                    break
+                func, args = job
+                func(*args)
+                self._incr('completed')
+            except Exception:
+                self._incr('errors')
+                logging.exception('explain worker failed')
+            finally:
+                queue.task_done()
+
+    def submit(self, func, *args):
+        """ Run ``func(*args)`` on a worker thread
+
+        Returns ``False`` and counts a drop when the queue is full rather than
+        blocking the caller
+
+        """
+        self._check_fork()
+        queue = self._queue
+        if queue is None:
+            with self._lock:
+                if self._queue is None:
+                    self._start_workers()
+                queue = self._queue
+        if queue.qsize() >= self._queue_size:
+            self._incr('dropped')
+            return False
+        queue.put((func, args))
+        self._incr('submitted')
+        return True
+
+    def join(self):
+        """ Block until every submitted explain has been processed
+
+        """
+        self._check_fork()
+        queue = self._queue
+        if queue is not None:
+            queue.join()
+
+    def stats(self):
+        self._check_fork()
+        with self._stats_lock:
+            stats = dict(self._stats)
+        queue = self._queue
+        stats['queued'] = queue.qsize() if queue is not None else 0
+        return stats
+
+
+def submit(func, *args):
+    return ExplainPool().submit(func, *args)
+
+
+def stats():
+    return ExplainPool().stats()
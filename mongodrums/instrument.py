@@ -1,9 +1,10 @@
-import inspect
 import logging
 import random
 import socket
+import sys
 import Queue
 import threading
+import time
 import traceback
 
 from abc import ABCMeta, abstractmethod
@@ -13,14 +14,153 @@ from types import MethodType
 
 import pymongo
 
+from bson.errors import InvalidDocument
 from bson.json_util import dumps
+from bson.objectid import ObjectId
 from bunch import Bunch
 from pymongo.errors import OperationFailure
 
 from .config import (
     configure, get_config, register_update_callback, unregister_update_callback
 )
+from .aggregator import Aggregator
+from .explain import ExplainPool
 from .pusher import push
+from .sampler import Sampler, sample_key
+from .timing import record as record_timing
+from .util import LRUCache, skeleton
+from .util.source import SourceResolver
+
+
+# the parts of an explain kept in the cache (and sent with cache hits)
+# (the legacy fields, or the current format's winning plan), along with the
+# scan counters so hits are profiled as scanning what the cached plan did
+CACHED_EXPLAIN_FIELDS = ('cursor', 'indexOnly', 'isMultiKey', 'scanAndOrder',
+                         'nscanned', 'nscannedObjects', 'n', 'queryPlanner')
+# the current format's counters, without its (large) tree of stages
+CACHED_EXECUTION_STATS = ('totalKeysExamined', 'totalDocsExamined',
+                          'nReturned')
+
+
+def explain_cache_key(database, collection, query, sort=None, fields=None):
+    """ Get the explain cache key for a query, or None if it has no skeleton
+
+    """
+    try:
+        return (database, collection, skeleton(query),
+                dumps(sort, sort_keys=True), dumps(fields, sort_keys=True))
+    except (InvalidDocument, TypeError):
+        return None
+
+
+# set while a CollectionMethodWrapper call is in progress on this thread so
+# the calls pymongo makes internally (find_one calling find, say) are not
+# instrumented a second time
+_local = threading.local()
+
+
+def _in_wrapped_call():
+    return getattr(_local, 'in_call', False)
+
+
+def _spec_or_id(spec_or_id):
+    if spec_or_id is None:
+        return {}
+    if not isinstance(spec_or_id, dict):
+        return {'_id': spec_or_id}
+    return spec_or_id
+
+
+def _spec_or_id_query(args, kwargs):
+    return (_spec_or_id(args[0] if len(args) > 0
+                        else kwargs.get('spec_or_id')),
+            None)
+
+
+def _find_and_modify_query(args, kwargs):
+    query = args[0] if len(args) > 0 else kwargs.get('query', {})
+    sort = args[3] if len(args) > 3 else kwargs.get('sort')
+    if isinstance(sort, dict):
+        sort = sort.items()
+    return (query, sort)
+
+
+def _aggregate_query(args, kwargs):
+    pipeline = args[0] if len(args) > 0 else kwargs.get('pipeline', [])
+    if isinstance(pipeline, dict):
+        pipeline = [pipeline]
+    # only a leading $match can use an index, explain it as a find
+    if len(pipeline) > 0 and '$match' in pipeline[0]:
+        return (pipeline[0]['$match'], None)
+    return None
+
+
+# Collection methods wrapped by CollectionMethodWrapper, each with a function
+# taking the call's (args, kwargs) and returning the (query, sort) to explain
+# when the call is sampled, or None if there is nothing to explain
+COLLECTION_METHODS = [
+    ('find_one', _spec_or_id_query),
+    ('count', None),
+    ('aggregate', _aggregate_query),
+    ('remove', _spec_or_id_query),
+    ('find_and_modify', _find_and_modify_query),
+    ('insert', None),
+    ('distinct', None),
+]
+
+
+class ExplainCache(object):
+    """ Recently seen plans keyed by :func:`explain_cache_key`
+
+    While an entry is fresh wrappers skip the explain round trip and push a
+    hit record carrying the ``plan_id`` of the full explain that was pushed
+    when the entry was cached.
+
+    """
+    def __new__(cls, *args, **kwargs):
+        if not hasattr(cls, '_instance'):
+            cls._instance = super(cls, ExplainCache).__new__(cls, *args,
+                                                             **kwargs)
+            cls._instance._initialized = False
+        return cls._instance
+
+    def __init__(self):
+        if not self._initialized:
+            self._size = 0
+            self._cache = LRUCache(self._size)
+            self._configure(get_config())
+            register_update_callback(self._configure)
+            self._initialized = True
+
+    def _configure(self, config):
+        self._size = config.instrument.explain_cache.size
+        self._cache.configure(self._size, config.instrument.explain_cache.ttl)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def put(self, key, explain):
+        """ Cache ``explain`` and return the plan id it was cached under
+
+        """
+        if self._size <= 0:
+            return None
+        plan = {'plan_id': str(ObjectId()),
+                'explain': dict([(f, explain[f]) for f in CACHED_EXPLAIN_FIELDS
+                                 if f in explain])}
+        if 'executionStats' in explain:
+            stats = explain['executionStats']
+            plan['explain']['executionStats'] = \
+                dict([(f, stats[f]) for f in CACHED_EXECUTION_STATS
+                      if f in stats])
+        self._cache.put(key, plan)
+        return plan['plan_id']
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return self._cache.stats()
 
 
 class Wrapper(object):
@@ -36,6 +176,9 @@ class Wrapper(object):
     def _configure(self, config):
         self._frequency = config.instrument.sample_frequency
         self._filter_packages = config.instrument.filter_packages
+        self._source_resolver = SourceResolver(self._filter_packages)
+        self._async_explain = config.instrument.async_explain.enabled
+        self._aggregate = config.instrument.aggregate.enabled
 
     def __get__(self, owner, owner_type):
         if owner is None:
@@ -47,14 +190,89 @@ class Wrapper(object):
         pass
 
     def get_source(self):
-        frame = \
-            filter(lambda f: f[0].f_globals['__package__'] \
-                             not in self._filter_packages,
-                   inspect.stack()[2:])[0]
+        # skip this frame and the __call__ frame that invoked it
+        return self._source_resolver.resolve(sys._getframe(2))
+
+    @property
+    def function(self):
+        return self._func.__name__
+
+    def sample(self, collection, query):
+        """ Decide whether to explain a call of this wrapper's function
+
+        """
+        return Sampler().sample(sample_key(collection.database.name,
+                                           collection.name, self.function,
+                                           query),
+                                self._frequency)
+
+    def explain(self, curs):
         try:
-            return '%s:%d' % (frame[1], frame[2])
-        finally:
-            del frame
+            return curs.explain()
+        except (TypeError, OperationFailure):
+            explain = {'error': traceback.format_exc()}
+            logging.error('error trying to run explain on curs:\n%s' %
+                          (explain['error']))
+            return explain
+
+    def _push(self, msg):
+        if self._aggregate:
+            Aggregator().add(msg)
+        else:
+            push(msg)
+
+    def _explain_into(self, msg, curs, cache_key):
+        explain = self.explain(curs)
+        msg['explain'] = explain
+        if cache_key is not None and 'error' not in explain:
+            plan_id = ExplainCache().put(cache_key, explain)
+            if plan_id is not None:
+                msg['plan_id'] = plan_id
+
+    def _explain_and_push(self, msg, curs, cache_key):
+        self._explain_into(msg, curs, cache_key)
+        self._push(msg)
+
+    def _cached_into(self, msg, cache_key):
+        """ Add the plan of a fresh :class:`ExplainCache` entry to ``msg``,
+        returning whether there was one
+
+        """
+        plan = ExplainCache().get(cache_key) if cache_key is not None else None
+        if plan is None:
+            return False
+        msg.update({'cached': True,
+                    'plan_id': plan['plan_id'],
+                    'explain': plan['explain']})
+        return True
+
+    def explain_now(self, msg, get_cursor, cache_key=None):
+        """ Add the explain of the cursor returned by ``get_cursor`` to
+        ``msg`` on the caller's thread, or the cached plan if ``cache_key``
+        has a fresh :class:`ExplainCache` entry, for calls that have to be
+        explained before they run
+
+        """
+        if not self._cached_into(msg, cache_key):
+            self._explain_into(msg, get_cursor(), cache_key)
+
+    def push_explain(self, msg, get_cursor, cache_key=None):
+        """ Explain the cursor returned by ``get_cursor`` and push ``msg``
+
+        If ``cache_key`` has a fresh :class:`ExplainCache` entry no cursor is
+        built and ``msg`` is pushed as a hit pointing at the cached plan. In
+        async mode the explain is handed off to the background
+        :class:`~mongodrums.explain.ExplainPool` (and dropped if its queue is
+        full), otherwise it runs on the caller's thread.
+
+        """
+        if self._cached_into(msg, cache_key):
+            self._push(msg)
+        elif self._async_explain:
+            ExplainPool().submit(self._explain_and_push, msg, get_cursor(),
+                                 cache_key)
+        else:
+            self._explain_and_push(msg, get_cursor(), cache_key)
 
     @classmethod
     @abstractmethod
@@ -79,21 +297,23 @@ class Wrapper(object):
 class FindWrapper(Wrapper):
     def __call__(self, self_, *args, **kwargs):
         curs = self._func(self_, *args, **kwargs)
-        if random.random() < self._frequency:
-            try:
-                explain = curs.explain()
-            except (TypeError, OperationFailure):
-                explain = {'error': traceback.format_exc()}
-                logging.error('error trying to run explain on curs:\n%s' %
-                              (explain['error']))
-            push({'type': 'explain',
-                  'function': 'find',
-                  'database': self_.database.name,
-                  'collection': self_.name,
-                  'query': dumps(args[0] if len(args) > 0 else {},
-                                 sort_keys=True),
-                  'explain': explain,
-                  'source': self.get_source()})
+        if _in_wrapped_call():
+            return curs
+        spec = args[0] if len(args) > 0 else kwargs.get('spec', {})
+        if self.sample(self_, spec):
+            fields = args[1] if len(args) > 1 else kwargs.get('fields')
+            # the caller is free to modify (and iterate) curs once we return,
+            # so explain a snapshot of it when running in the background
+            self.push_explain(
+                {'type': 'explain',
+                 'function': 'find',
+                 'database': self_.database.name,
+                 'collection': self_.name,
+                 'query': dumps(spec, sort_keys=True),
+                 'source': self.get_source()},
+                curs.clone if self._async_explain else lambda: curs,
+                explain_cache_key(self_.database.name, self_.name, spec,
+                                  kwargs.get('sort'), fields))
         return curs
 
     @classmethod
@@ -117,22 +337,29 @@ class FindWrapper(Wrapper):
 
 class UpdateWrapper(Wrapper):
     def __call__(self, self_, *args, **kwargs):
-        if random.random() < self._frequency:
-            curs = self_.find(args[0])
+        if _in_wrapped_call():
+            return self._func(self_, *args, **kwargs)
+        # so the find explaining the update isn't instrumented itself
+        _local.in_call = True
+        try:
+            if self.sample(self_, args[0]):
+                self.push_explain({'type': 'explain',
+                                   'function': 'update',
+                                   'database': self_.database.name,
+                                   'collection': self_.name,
+                                   'query': dumps(args[0], sort_keys=True),
+                                   'source': self.get_source()},
+                                  partial(self_.find, args[0]),
+                                  explain_cache_key(self_.database.name,
+                                                    self_.name, args[0]))
+            start = time.time()
             try:
-                explain = curs.explain()
-            except (TypeError, OperationFailure):
-                explain = {'error': traceback.format_exc()}
-                logging.error('error trying to run explain on curs:\n%s' %
-                              (explain['error']))
-            push({'type': 'explain',
-                  'function': 'update',
-                  'database': self_.database.name,
-                  'collection': self_.name,
-                  'query': dumps(args[0], sort_keys=True),
-                  'explain': explain,
-                  'source': self.get_source()})
-        return self._func(self_, *args, **kwargs)
+                return self._func(self_, *args, **kwargs)
+            finally:
+                record_timing(self_.database.name, self_.name, 'update',
+                              (time.time() - start) * 1000)
+        finally:
+            _local.in_call = False
 
     @classmethod
     def wrap(cls):
@@ -153,16 +380,101 @@ class UpdateWrapper(Wrapper):
                     pymongo.collection.Collection.update._func
 
 
+class CollectionMethodWrapper(Wrapper):
+    """ Time every call to a Collection method and explain sampled ones
+
+    The wrapped methods are listed in :data:`COLLECTION_METHODS`. Sampled
+    calls push an explain record including the call's ``duration`` (in
+    milliseconds), which means the explain runs after the call itself. The
+    methods in :attr:`WRITES` change what their query matches, so they are
+    explained before the call instead, on the caller's thread even with
+    async explains, and pushed once it returns.
+
+    """
+    WRITES = ('remove', 'find_and_modify')
+
+    def __init__(self, func, get_query=None):
+        super(CollectionMethodWrapper, self).__init__(func)
+        self._get_query = get_query
+
+    def __call__(self, self_, *args, **kwargs):
+        if _in_wrapped_call():
+            return self._func(self_, *args, **kwargs)
+        _local.in_call = True
+        try:
+            msg = None
+            query = self._get_query(args, kwargs) \
+                    if self._get_query is not None else None
+            if query is not None and self.sample(self_, query[0]):
+                msg = {'type': 'explain',
+                       'function': self.function,
+                       'database': self_.database.name,
+                       'collection': self_.name,
+                       'query': dumps(query[0], sort_keys=True),
+                       'source': self.get_source()}
+                get_cursor = partial(self_.find, query[0], sort=query[1])
+                cache_key = explain_cache_key(self_.database.name,
+                                              self_.name, query[0], query[1])
+                if self.function in self.__class__.WRITES:
+                    self.explain_now(msg, get_cursor, cache_key)
+            start = time.time()
+            try:
+                return self._func(self_, *args, **kwargs)
+            finally:
+                duration = (time.time() - start) * 1000
+                record_timing(self_.database.name, self_.name, self.function,
+                              duration)
+                if msg is not None:
+                    msg['duration'] = duration
+                    if 'explain' in msg:
+                        self._push(msg)
+                    else:
+                        self.push_explain(msg, get_cursor, cache_key)
+        finally:
+            _local.in_call = False
+
+    @classmethod
+    def wrap(cls):
+        with cls._lock:
+            for name, get_query in COLLECTION_METHODS:
+                func = getattr(pymongo.collection.Collection, name, None)
+                if func is None or isinstance(func, cls):
+                    continue
+                wrapper = cls(func, get_query)
+                setattr(pymongo.collection.Collection, name, wrapper)
+                register_update_callback(wrapper._configure)
+
+    @classmethod
+    def unwrap(cls):
+        with cls._lock:
+            for name, _ in COLLECTION_METHODS:
+                wrapper = getattr(pymongo.collection.Collection, name, None)
+                if isinstance(wrapper, cls):
+                    unregister_update_callback(wrapper._configure)
+                    setattr(pymongo.collection.Collection, name,
+                            wrapper._func)
+
+
+def explain_cache_stats():
+    return ExplainCache().stats()
+
+
+def sampler_stats():
+    return Sampler().stats()
+
+
 def start(config=None):
     if config is not None:
         configure(config)
     FindWrapper.wrap()
     UpdateWrapper.wrap()
+    CollectionMethodWrapper.wrap()
 
 
 def stop():
     FindWrapper.unwrap()
     UpdateWrapper.unwrap()
+    CollectionMethodWrapper.unwrap()
 
 
 @contextmanager
@@ -174,5 +486,7 @@ def instrument(config=None):
         stop()
 
 def instrumented():
-    return any([isinstance(pymongo.collection.Collection.update, Wrapper),
-                isinstance(pymongo.collection.Collection.find, Wrapper)])
+    return any([isinstance(getattr(pymongo.collection.Collection, name, None),
+                           Wrapper)
+                for name in ['find', 'update'] +
+                            [m for m, _ in COLLECTION_METHODS]])
@@ -0,0 +1,184 @@
+"""
+Normalized summaries of explain output, whatever the server's explain format
+
+Legacy explains (servers before 3.0) describe the plan with a ``cursor``
+string (``BtreeCursor a_1``, ``BasicCursor``) and flat counters. Current
+ones describe it with the ``queryPlanner.winningPlan`` stage tree and, when
+run with execution stats, an ``executionStats`` tree of the same stages with
+their counters. :func:`summarize` turns either into a summary with:
+
+``index``
+    the name of the index used, the names of the indexes used joined by
+    ``,`` when there are several (``$or`` queries), ``_id_`` for lookups by
+    ``_id``, ``EOF`` when the query was answered without reading anything
+    (e.g. from a missing collection) or ``COLLSCAN`` when the collection was
+    scanned
+``stages``
+    the stages of the winning plan (``IXSCAN``, ``COLLSCAN``, ``FETCH``,
+    ``SORT``...), outermost first, each listed once
+``covered``
+    whether the query was answered from index keys alone
+``sort``
+    whether results were sorted in memory
+``keys_examined``, ``docs_examined``, ``n``, ``yields``, ``millis``
+    the index keys and documents examined, documents returned, times the
+    query yielded and milliseconds it took, or None when the explain
+    doesn't say
+
+"""
+
+COLLSCAN = 'COLLSCAN'
+EOF = 'EOF'
+ID_INDEX = '_id_'
+
+# where a stage's children are in its document
+_CHILD_FIELDS = ('inputStage', 'inputStages', 'shards', 'winningPlan',
+                 'executionStages')
+# stages that scan the index named by their indexName
+_INDEX_STAGES = ('IXSCAN', 'COUNT_SCAN', 'DISTINCT_SCAN', 'GEO_NEAR_2D',
+                 'GEO_NEAR_2DSPHERE', 'TEXT')
+
+
+def _walk(root):
+    """ Yield the stages of a stage tree, outermost first
+
+    """
+    stack = [root]
+    while len(stack) > 0:
+        stage = stack.pop()
+        if 'stage' in stage:
+            yield stage
+        children = []
+        for field in _CHILD_FIELDS:
+            child = stage.get(field)
+            if isinstance(child, dict):
+                children.append(child)
+            elif isinstance(child, list):
+                children.extend([c for c in child if isinstance(c, dict)])
+        stack.extend(reversed(children))
+
+
+def _unique(values):
+    seen = set()
+    out = []
+    for value in values:
+        if value not in seen:
+            seen.add(value)
+            out.append(value)
+    return out
+
+
+def _summarize_query_planner(explain):
+    stages = list(_walk(explain['queryPlanner'].get('winningPlan', {})))
+    names = _unique([stage['stage'] for stage in stages])
+    indexes = _unique([ID_INDEX if stage['stage'] == 'IDHACK'
+                       else stage['indexName'] for stage in stages
+                       if stage['stage'] == 'IDHACK' or
+                       (stage['stage'] in _INDEX_STAGES and
+                        'indexName' in stage)])
+    stats = explain.get('executionStats', {})
+    yields = None
+    if 'executionStages' in stats:
+        execution = list(_walk(stats['executionStages']))
+        if len(execution) > 0:
+            # older servers count yields, newer ones saved states
+            yields = execution[0].get('saveState',
+                                      execution[0].get('yields'))
+    if len(indexes) > 0:
+        index = ','.join(indexes)
+    elif COLLSCAN not in names and EOF in names:
+        index = EOF
+    else:
+        index = COLLSCAN
+    return {'index': index,
+            'stages': names,
+            # IDHACK fetches the document itself
+            'covered': len(indexes) > 0 and 'FETCH' not in names and
+                       'IDHACK' not in names and COLLSCAN not in names,
+            'sort': 'SORT' in names,
+            'keys_examined': stats.get('totalKeysExamined'),
+            'docs_examined': stats.get('totalDocsExamined'),
+            'n': stats.get('nReturned'),
+            'yields': yields,
+            'millis': stats.get('executionTimeMillis')}
+
+
+def _legacy_index(cursor):
+    if cursor.startswith('BtreeCursor '):
+        return cursor.split()[1]
+    if cursor.startswith('BasicCursor'):
+        return None
+    if cursor == 'IDCursor':
+        return ID_INDEX
+    return cursor
+
+
+def cursor_index(cursor):
+    """ Get the index a legacy explain's ``cursor`` names, as
+    :func:`summarize` names it
+
+    """
+    index = _legacy_index(cursor)
+    return COLLSCAN if index is None else index
+
+
+def _summarize_legacy(explain):
+    # $or queries are explained clause by clause
+    clauses = explain.get('clauses') or [explain]
+    clause_indexes = [_legacy_index(clause.get('cursor', ''))
+                      for clause in clauses]
+    indexes = _unique(clause_indexes)
+    names = []
+    if None in indexes:
+        names.append(COLLSCAN)
+        indexes.remove(None)
+    if len(indexes) > 0:
+        names.append('IXSCAN')
+    # a collection scan's nscanned counts the documents it scanned, not
+    # index keys
+    keys_examined = explain.get('nscanned')
+    if keys_examined is not None and None in clause_indexes:
+        keys_examined = sum([clause.get('nscanned', 0)
+                             for clause, index in zip(clauses, clause_indexes)
+                             if index is not None])
+    index_only = bool(explain.get('indexOnly', False))
+    if len(indexes) > 0 and not index_only:
+        names.insert(0, 'FETCH')
+    if explain.get('scanAndOrder', False):
+        names.insert(0, 'SORT')
+    return {'index': ','.join(indexes) if len(indexes) > 0 else COLLSCAN,
+            'stages': names,
+            'covered': index_only and len(indexes) > 0,
+            'sort': bool(explain.get('scanAndOrder', False)),
+            'keys_examined': keys_examined,
+            'docs_examined': explain.get('nscannedObjects'),
+            'n': explain.get('n'),
+            'yields': explain.get('nYields'),
+            'millis': explain.get('millis')}
+
+
+def summarize(explain):
+    """ Summarize an explain, legacy or current, as described above
+
+    Raises :class:`ValueError` for explains that failed or are in neither
+    format.
+
+    """
+    if 'error' in explain:
+        raise ValueError('explain failed: %s' % (explain['error']))
+    if 'queryPlanner' in explain:
+        return _summarize_query_planner(explain)
+    if 'cursor' in explain:
+        return _summarize_legacy(explain)
+    raise ValueError('unknown explain format')
+
+
+def plan_summary(data):
+    """ Get the summary of the explain of a pushed record, summarizing it
+    only once however many sinks ask
+
+    """
+    summary = data.get('plan')
+    if summary is None:
+        summary = data['plan'] = summarize(data['explain'])
+    return summary
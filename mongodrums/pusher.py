@@ -3,13 +3,38 @@ TODO: add dtls support
 
 """
 
+import atexit
+import errno
+import itertools
+import logging
+import os
+import random
 import socket
+import threading
+import time
 
-from bson.json_util import dumps
+from collections import deque
 
+from . import wire
 from .config import get_config, register_update_callback
+from .util import unix_socket_path
+
+
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest')
+
 
 class Pusher(object):
+    """ Push messages to the collector
+
+    :meth:`push` only appends to a bounded queue, messages are encoded and
+    sent by a background sender thread. When the queue is full either the
+    oldest queued message or the one being pushed is dropped, as set by
+    ``pusher.queue.overflow``.
+
+    A forked child starts its own sender thread and drops what its parent
+    had queued, the parent sends that.
+
+    """
     def __new__(cls, *args, **kwargs):
         if not hasattr(cls, '_instance'):
             cls._instance = super(cls, Pusher).__new__(cls, *args, **kwargs)
@@ -20,20 +45,245 @@ class Pusher(object):
         if not self._initialized:
             self._push_addr = None
             self._push_port = None
+            self._format = None
+            # fragment message ids, randomly seeded so they don't collide
+            # between pushers sharing a collector
+            self._msg_ids = itertools.count(random.getrandbits(48))
             self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # don't block the application when the collector falls behind,
+            # unix datagram sockets block rather than drop when it does
+            self._unix_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._unix_sock.setblocking(0)
+            self._unix_retry = 0
+            self._overflow = OVERFLOW_POLICIES[0]
+            self._reset()
+            self._stopped = False
+            self._flushed = time.time()
             self._configure(get_config())
             register_update_callback(self._configure)
+            self._initialized = True
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._batch = []
+        self._batch_size = 0
+        self._queue = deque()
+        self._queue_lock = threading.Lock()
+        # held while draining the queue so a flush sends everything pushed
+        # before it, in order
+        self._send_lock = threading.Lock()
+        self._stats = {'enqueued': 0, 'sent': 0, 'dropped': 0, 'errored': 0}
+        self._stats_lock = threading.Lock()
+        self._thread = None
+        self._wake = threading.Event()
+
+    def _check_fork(self):
+        # a forked child inherits the parent's thread object, not the
+        # thread, and locks the parent's threads may have been holding
+        if self._pid != os.getpid():
+            self._reset()
 
     def _configure(self, config):
         self._push_addr = config.pusher.addr
         self._push_port = config.pusher.port
+        self._unix_path = unix_socket_path(self._push_addr)
+        if self._unix_path is not None:
+            self._push_addr = config.pusher.unix.fallback_addr
+        self._unix_max_datagram_size = config.pusher.unix.max_datagram_size
+        self._unix_retry_interval = config.pusher.unix.retry_interval
+        self._unix_retry = 0
+        self._batch_enabled = config.pusher.batch.enabled
+        self._batch_max_size = config.pusher.batch.max_size
+        self._batch_interval = config.pusher.batch.interval
+        self._compress_threshold = config.pusher.compress_threshold
+        self._max_datagram_size = config.pusher.max_datagram_size
+        self._queue_size = config.pusher.queue.size
+        if config.pusher.queue.overflow in OVERFLOW_POLICIES:
+            self._overflow = config.pusher.queue.overflow
+        else:
+            # raising would keep the other update callbacks from running
+            logging.error('unknown overflow policy %s, keeping %s' %
+                          (config.pusher.queue.overflow, self._overflow))
+        with self._lock:
+            if config.pusher.format != self._format:
+                # bodies in the batch were encoded in the old format
+                data, count = self._take_batch()
+                if data is not None:
+                    self._send(data, count)
+                self._format = config.pusher.format
+        # the sender thread may be waiting without a timeout
+        self._wake.set()
 
-    def push(self, msg):
+    def _incr(self, stat, count=1):
+        with self._stats_lock:
+            self._stats[stat] += count
+
+    def _sendto(self, sock, data, addr, max_size):
+        if len(data) > max_size:
+            for fragment in wire.fragment(data, max_size,
+                                          next(self._msg_ids)):
+                sock.sendto(fragment, addr)
+        else:
+            sock.sendto(data, addr)
+
+    def _send(self, data, count=1):
+        """ Send a datagram carrying ``count`` messages
+
+        """
+        if self._unix_path is not None and time.time() >= self._unix_retry:
+            try:
+                self._sendto(self._unix_sock, data, self._unix_path,
+                             self._unix_max_datagram_size)
+                self._incr('sent', count)
+                return
+            except socket.error as e:
+                if e.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+                    self._incr('errored', count)
+                    return
+            except Exception:
+                self._incr('errored', count)
+                return
+            # no collector on the unix socket, use udp for a while
+            self._unix_retry = time.time() + self._unix_retry_interval
         try:
-            self._sock.sendto(dumps(msg), (self._push_addr, self._push_port))
+            self._sendto(self._sock, data, (self._push_addr, self._push_port),
+                         self._max_datagram_size)
+            self._incr('sent', count)
         except Exception:
-            pass
+            self._incr('errored', count)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='mongodrums-pusher')
+            self._thread.daemon = True
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self._batch_interval if self._batch_enabled
+                            else None)
+            self._wake.clear()
+            with self._send_lock:
+                self._drain()
+                if time.time() - self._flushed >= self._batch_interval:
+                    self._flush_batch()
+
+    def stop(self):
+        """ Stop the sender thread, sending whatever is still queued
+
+        """
+        self._stopped = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _take_batch(self):
+        batch, self._batch = self._batch, []
+        self._batch_size = 0
+        if len(batch) == 0:
+            return (None, 0)
+        return (wire.pack_batch(batch, self._format, self._compress_threshold),
+                len(batch))
+
+    def _flush_batch(self):
+        self._flushed = time.time()
+        with self._lock:
+            data, count = self._take_batch()
+        if data is not None:
+            self._send(data, count)
+
+    def flush(self):
+        """ Send everything queued, including whatever is waiting in the
+        current batch
+
+        """
+        self._check_fork()
+        with self._send_lock:
+            self._drain()
+            self._flush_batch()
+
+    def _batch_push(self, body):
+        fixed, per_body = wire.batch_overhead(self._format)
+        if fixed + len(body) > self._batch_max_size:
+            # too big to share a datagram with anything
+            self._send(wire.pack(body, self._format,
+                                 self._compress_threshold))
+            return
+        with self._lock:
+            full, count = None, 0
+            size = len(body) + (per_body if len(self._batch) > 0 else 0)
+            if fixed + self._batch_size + size > self._batch_max_size:
+                full, count = self._take_batch()
+                size = len(body)
+            self._batch.append(body)
+            self._batch_size += size
+        if full is not None:
+            self._send(full, count)
+
+    def _send_msg(self, msg):
+        format_ = self._format
+        try:
+            body = wire.encode_body(msg, format_)
+        except Exception:
+            self._incr('errored')
+            logging.debug('failed to encode %r', msg, exc_info=True)
+            return
+        if self._batch_enabled:
+            self._batch_push(body)
+        else:
+            self._send(wire.pack(body, format_, self._compress_threshold))
+
+    def _drain(self):
+        while True:
+            with self._queue_lock:
+                if len(self._queue) == 0:
+                    return
+                msg = self._queue.popleft()
+            self._send_msg(msg)
+
+    def push(self, msg):
+        """ Queue a message for the sender thread, this never blocks on the
+        network
+
+        """
+        self._check_fork()
+        with self._queue_lock:
+            if len(self._queue) >= self._queue_size:
+                self._incr('dropped')
+                if self._overflow == 'drop_newest':
+                    return
+                self._queue.popleft()
+            self._queue.append(msg)
+        self._incr('enqueued')
+        if self._stopped:
+            # pushed by something flushing at exit after the sender stopped
+            self.flush()
+            return
+        if self._thread is None:
+            self._start()
+        self._wake.set()
+
+    def stats(self):
+        self._check_fork()
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['queued'] = len(self._queue)
+        return stats
+
 
 def push(msg):
     Pusher().push(msg)
 
+
+def flush():
+    Pusher().flush()
+
+
+def stats():
+    return Pusher().stats()
@@ -0,0 +1,147 @@
+"""
+Adaptive, per query shape sampling with a process wide cap on samples per
+second
+
+"""
+
+import random
+import threading
+import time
+
+from bson.errors import InvalidDocument
+
+from .config import get_config, register_update_callback
+from .util import LRUCache, skeleton
+
+
+def sample_key(database, collection, function, query):
+    """ Get the shape a call is sampled under, or None if it has no skeleton
+
+    """
+    try:
+        return (database, collection, function, skeleton(query))
+    except (InvalidDocument, TypeError):
+        return None
+
+
+class TokenBucket(object):
+    """ Allow ``rate`` events per second with bursts of up to ``capacity``
+
+    A ``rate`` of 0 disables the limit.
+
+    """
+    def __init__(self, rate, capacity):
+        self._lock = threading.Lock()
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = float(capacity)
+        self._last = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(float(self._capacity),
+                           self._tokens + max(0, now - self._last) * self._rate)
+        self._last = now
+
+    def configure(self, rate, capacity):
+        with self._lock:
+            self._refill()
+            self._rate = rate
+            self._capacity = capacity
+            self._tokens = min(self._tokens, float(capacity))
+
+    def consume(self):
+        if self._rate <= 0:
+            return True
+        with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class Sampler(object):
+    """ Decide which calls get explained
+
+    Each shape (see :func:`sample_key`) is sampled with probability
+    ``sample_frequency / (1 + decay * seen)``, never dropping below
+    ``min_frequency``, where ``seen`` is the number of times the shape has
+    been seen. A shape that has never been sampled is always sampled, and
+    every sample has to take a token from a bucket refilled at
+    ``max_per_second``. A new shape that finds the bucket empty is not
+    counted as seen so its next call gets another chance.
+
+    """
+    def __new__(cls, *args, **kwargs):
+        if not hasattr(cls, '_instance'):
+            cls._instance = super(cls, Sampler).__new__(cls, *args, **kwargs)
+            cls._instance._initialized = False
+        return cls._instance
+
+    def __init__(self):
+        if not self._initialized:
+            self._stats_lock = threading.Lock()
+            self._stats = {'sampled': 0, 'skipped': 0, 'throttled': 0}
+            config = get_config()
+            self._seen = LRUCache(0)
+            self._bucket = TokenBucket(config.instrument.sampling.max_per_second,
+                                       config.instrument.sampling.burst)
+            self._configure(config)
+            register_update_callback(self._configure)
+            self._initialized = True
+
+    def _configure(self, config):
+        sampling = config.instrument.sampling
+        self._decay = sampling.decay
+        self._min_frequency = sampling.min_frequency
+        self._seen.configure(sampling.max_shapes)
+        self._bucket.configure(sampling.max_per_second, sampling.burst)
+
+    def _incr(self, stat):
+        with self._stats_lock:
+            self._stats[stat] += 1
+
+    def sample(self, key, frequency):
+        """ Decide whether to sample a call with shape ``key``
+
+        :param key:         the call's shape, if None the call is sampled with
+                            a flat ``frequency``
+        :param frequency:   the base sample frequency
+
+        """
+        if frequency <= 0:
+            return False
+        if key is None:
+            seen, rate = None, frequency
+        else:
+            seen = self._seen.get(key, 0)
+            rate = 1. if seen == 0 else \
+                   max(min(self._min_frequency, frequency),
+                       frequency / (1. + self._decay * seen))
+        sampled = random.random() < rate
+        if sampled and not self._bucket.consume():
+            self._incr('throttled')
+            sampled = False
+        else:
+            self._incr('sampled' if sampled else 'skipped')
+        if seen is not None and (sampled or seen > 0):
+            self._seen.put(key, seen + 1)
+        return sampled
+
+    def clear(self):
+        self._seen.clear()
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['shapes'] = len(self._seen)
+        return stats
+
+
+def sample(key, frequency):
+    return Sampler().sample(key, frequency)
+
+
+def stats():
+    return Sampler().stats()
@@ -1,9 +1,19 @@
-from abc import ABCMeta, abstractmethod
+import hashlib
+import os
+import random
+import time
 
-from pymongo.errors import DuplicateKeyError
+from abc import ABCMeta, abstractmethod, abstractproperty
+from datetime import datetime
+
+from bson.json_util import dumps
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 
 from .config import get_config
-from .util import get_default_database, sanitize, skeleton
+from .plan import plan_summary
+from .util import get_default_database, merge_update, sanitize, skeleton
+from .util.histogram import Histogram
+from .util.spacesaving import CardinalityGuard, SpaceSaving
 
 
 class Sink(object):
@@ -20,31 +30,110 @@ class Sink(object):
     def send(self, data, address):
         pass
 
+    def full(self):
+        """ Whether the sink has buffered enough to be flushed now, checked
+        by the collector after each message the sink handles
+
+        """
+        return False
+
+    def flush(self):
+        """ Write out anything the sink buffers, called by the collector
+        periodically, when the sink is :meth:`full` and when it stops
+
+        """
+        pass
+
+    def stats(self):
+        """ Get stats of the sink's own, included in the collector's
+
+        """
+        return None
+
+
+class SinkFull(Exception):
+    """ Raised by sinks that can't take any more data until they are
+    flushed
+
+    """
+    pass
+
+
+# errors of the backends sinks write to, as opposed to errors in the data
+# they are given: the collector spools data while a sink raises these, and
+# retries it later
+BACKEND_ERRORS = (PyMongoError, EnvironmentError, SinkFull)
+
+
+# record types produced by mongodrums.instrument and mongodrums.aggregator that
+# carry an explain
+EXPLAIN_TYPES = ('explain', 'explain_summary')
+
 
-class ProfileSink(Sink):
+# mongo's error code for a duplicate key
+DUPLICATE_KEY = 11000
+
+
+class MongoSink(Sink):
+    """ Base of the sinks that write to the database at ``mongo_uri``
+
+    """
     def __new__(cls, *args, **kwargs):
         if not hasattr(cls, '_MongoClient'):
             from gevent import monkey; monkey.patch_socket()
             from pymongo import MongoClient
             cls._MongoClient = MongoClient
-        return super(ProfileSink, cls).__new__(cls, *args, **kwargs)
+        return super(MongoSink, cls).__new__(cls, *args, **kwargs)
 
-    def __init__(self):
+    def __init__(self, mongo_uri):
         self._config = get_config()
+        self._mongo_uri = mongo_uri
         self._db = None
-        self._session_col = None
-
-    def filter(self, data, address):
-        return data['collection'].startswith('$')
 
     @property
     def db(self):
         if self._db is None:
-            mongo_uri = self._config.index_profile_sink.mongo_uri
-            client = self.__class__._MongoClient(mongo_uri)
-            self._db = get_default_database(client, mongo_uri)
+            client = self.__class__._MongoClient(self._mongo_uri)
+            self._db = get_default_database(client, self._mongo_uri)
         return self._db
 
+
+class ProfileSink(MongoSink):
+    """ Base of the sinks that write profiles to mongo
+
+    Profiles are aggregated in memory, per :meth:`_key`, in entries made by
+    :meth:`_new_entry`. :meth:`flush` writes them as one unordered bulk
+    write of the upserts :meth:`_updates` makes of them. The sink is
+    :meth:`full` once ``flush_size`` entries are buffered. Entries that
+    fail to be written are kept for the next flush, up to ``max_buffered``
+    entries in all, past which records of new entries raise
+    :class:`SinkFull` (so the collector spools them) and entries that failed
+    are dropped.
+
+    The shapes (:meth:`_shape`) profiled per collection are bounded by a
+    :class:`~mongodrums.util.spacesaving.CardinalityGuard` of
+    ``cardinality_guard.max_keys`` (with ``cardinality_guard.candidates``
+    candidates), records of shapes it doesn't admit are profiled as the
+    ``__overflow__`` shape.
+
+    """
+    def __init__(self, flush_size, max_buffered):
+        super(ProfileSink, self).__init__(
+            get_config().index_profile_sink.mongo_uri)
+        self._session_col = None
+        self._flush_size = flush_size
+        self._max_buffered = max_buffered
+        self._entries = {}
+        self._dropped = 0
+        self._guard = \
+            CardinalityGuard(self._config.cardinality_guard.max_keys,
+                             self._config.cardinality_guard.candidates)
+
+    def filter(self, data, address):
+        return data.get('type', 'explain') not in EXPLAIN_TYPES or \
+               data['collection'].startswith('$') or \
+               'error' in data['explain']
+
     @property
     def session_col(self):
         if self._session_col is None:
@@ -53,10 +142,206 @@ class ProfileSink(Sink):
             self._session_col = SessionCollection(self.db[col_name])
         return self._session_col
 
+    @abstractproperty
+    def profile_col(self):
+        pass
+
+    def _shape(self, data):
+        """ Get the shape of a record, guarded per collection, as
+        ``(skeleton, source)``
+
+        """
+        return (skeleton(data['query']), data['source'])
+
+    @abstractmethod
+    def _key(self, data, shape):
+        pass
+
+    @abstractmethod
+    def _new_entry(self):
+        pass
+
+    @abstractmethod
+    def _updates(self, entries):
+        """ Make upserts of buffered entries, as ``(query, update, keys)``
+        with the keys of the entries in the update
+
+        """
+        pass
+
+    def send(self, data, address):
+        shape = self._shape(data)
+        if not self._guard.admit('%s.%s' % (data['database'],
+                                            data['collection']),
+                                 shape, data.get('count', 1)):
+            shape = tuple([CardinalityGuard.OVERFLOW if part is not None
+                           else None for part in shape])
+        key = self._key(data, shape)
+        entry = self._entries.get(key)
+        if entry is None:
+            if len(self._entries) >= self._max_buffered:
+                raise SinkFull('%d profiles buffered' % (len(self._entries)))
+            entry = self._entries[key] = self._new_entry()
+        entry.add(data)
+
+    def full(self):
+        return len(self._entries) >= self._flush_size
+
+    def stats(self):
+        return {'buffered': len(self._entries),
+                'dropped': self._dropped,
+                'cardinality': self._guard.stats()}
+
+    def _bulk_upsert(self, collection, updates):
+        """ Write the updates, returning those that failed
+
+        """
+        bulk = collection.initialize_unordered_bulk_op()
+        for q, update, keys in updates:
+            bulk.find(q).upsert().update_one(update)
+        try:
+            bulk.execute()
+        except BulkWriteError as e:
+            return [(updates[error['index']], error['code'])
+                    for error in e.details['writeErrors']]
+        return []
+
+    def _requeue(self, entries, keys):
+        for key in keys:
+            entry = entries[key]
+            if key in self._entries:
+                entry.merge(self._entries[key])
+            elif len(self._entries) >= self._max_buffered:
+                self._dropped += 1
+                continue
+            self._entries[key] = entry
+
+    def flush(self):
+        if len(self._entries) == 0:
+            return
+        # nothing has been written if the collection can't be had, so the
+        # entries are simply left buffered
+        collection = self.profile_col.collection
+        # messages handled while the write is in flight start a new buffer
+        entries, self._entries = self._entries, {}
+        updates = self._updates(entries)
+        # an unordered bulk that raises anything but a BulkWriteError may
+        # have applied any of its updates, requeuing them could count them
+        # twice so they are dropped instead
+        unknown = updates
+        try:
+            failed = self._bulk_upsert(collection, updates)
+            # concurrent upserts of a new document race on the unique index,
+            # retrying the losers updates the winner's document
+            retry = [update for update, code in failed
+                     if code == DUPLICATE_KEY]
+            unknown = retry
+            if len(retry) > 0:
+                failed = [(update, code) for update, code in failed
+                          if code != DUPLICATE_KEY] + \
+                         self._bulk_upsert(collection, retry)
+        except BaseException:
+            self._dropped += sum([len(update[2]) for update in unknown])
+            raise
+        if len(failed) > 0:
+            # keep what wasn't written for the next flush
+            self._requeue(entries, [key for update, code in failed
+                                    for key in update[2]])
+            raise RuntimeError('failed to write %d profiles: %s' %
+                               (len(failed), sorted(set(
+                                   [code for update, code in failed]))))
+
+
+def query_key(query_skeleton):
+    """ The key of a query skeleton in an index profile's ``queries``,
+    skeletons can't be keys themselves as they contain ``.`` and ``$``
+
+    """
+    if isinstance(query_skeleton, unicode):
+        query_skeleton = query_skeleton.encode('utf-8')
+    return hashlib.md5(query_skeleton).hexdigest()
+
+
+# plan summary counters kept as histograms per query, and the ratios of keys
+# and documents examined to documents returned derived from them
+SCAN_METRICS = ('keys_examined', 'docs_examined', 'n', 'yields')
+SCAN_RATIOS = (('keys_per_returned', 'keys_examined'),
+               ('docs_per_returned', 'docs_examined'))
+
+
+def scan_metrics(plan):
+    """ Get the scan metrics and ratios of a plan summary (see
+    :mod:`mongodrums.plan`), or None if it has none
+
+    """
+    if plan['keys_examined'] is None and plan['docs_examined'] is None:
+        return None
+    metrics = dict([(metric, plan[metric] or 0) for metric in SCAN_METRICS])
+    for ratio, metric in SCAN_RATIOS:
+        # a query returning nothing still examined what it examined
+        metrics[ratio] = float(metrics[metric]) / max(metrics['n'], 1)
+    metrics['sort'] = plan['sort']
+    return metrics
+
+
+class _IndexQueryEntry(object):
+    def __init__(self):
+        self.count = 0
+        self.covered = None
+        self.durations = Histogram()
+        self.scan = dict([(name, Histogram()) for name in
+                          SCAN_METRICS + tuple([r for r, m in SCAN_RATIOS])])
+        self.scan_and_order = 0
+
+    def _add_scan(self, plan, count):
+        metrics = scan_metrics(plan)
+        if metrics is None:
+            return
+        for name, histogram in self.scan.iteritems():
+            histogram.add(metrics[name], count)
+        if metrics['sort']:
+            self.scan_and_order += count
+
+    def add(self, data):
+        plan = plan_summary(data)
+        if data.get('type') == 'explain_summary':
+            self.count += data['count']
+            self.durations.merge(Histogram.from_document(data['millis']))
+        else:
+            self.count += 1
+            # cache hits carry the cached plan but no timing of their own
+            if not data.get('cached', False) and plan['millis'] is not None:
+                self.durations.add(plan['millis'])
+        # the plan's counters stand for every execution, cached or not
+        self._add_scan(plan, data.get('count', 1))
+        self.covered = plan['covered']
+
+    def merge(self, other):
+        self.count += other.count
+        self.covered = other.covered
+        self.durations.merge(other.durations)
+        for name, histogram in self.scan.iteritems():
+            histogram.merge(other.scan[name])
+        self.scan_and_order += other.scan_and_order
+
 
 class IndexProfileSink(ProfileSink):
+    """ Profile which queries use which indexes
+
+    Queries are aggregated per (session, collection, index, skeleton), with
+    one upsert per index profile document. Query durations are kept as a
+    :class:`~mongodrums.util.histogram.Histogram` (``durations``) so
+    profiles stay the same size however long a session runs. So are the
+    explain's scan counters (see :func:`scan_metrics`), under ``scan``,
+    along with how many queries needed an in memory sort
+    (``scan.scan_and_order``).
+
+    """
     def __init__(self):
-        super(IndexProfileSink, self).__init__()
+        config = get_config()
+        super(IndexProfileSink, self).__init__(
+            config.index_profile_sink.flush_size,
+            config.index_profile_sink.max_buffered)
         self._index_profile_col = None
 
     @property
@@ -64,72 +349,354 @@ class IndexProfileSink(ProfileSink):
         if self._index_profile_col is None:
             from .collection import IndexProfileCollection
             col_name = IndexProfileCollection.get_collection_name()
-            self._index_profile_col = IndexProfileCollection(self.db[col_name])
+            index_profile_col = IndexProfileCollection(self.db[col_name])
+            index_profile_col.ensure_indexes()
+            self._index_profile_col = index_profile_col
         return self._index_profile_col
 
-    def send(self, data, address):
-        q = {'session': data['session'],
-             'collection': data['collection'],
-             'index': data['explain']['cursor']}
-        query_skeleton = skeleton(data['query'])
-        try:
-            doc = {'queries': []}
-            doc.update(q)
-            self.index_profile_col.insert(doc)
-        except DuplicateKeyError:
-            pass
-
-        q.update({'queries.query': {'$ne': query_skeleton}})
-        self.index_profile_col.update(
-            q,
-            {
-                '$push': {
-                    'queries': {
-                        'query': query_skeleton,
-                        'count': 0,
-                        'durations': []
-                    }
-                }
-            })
-
-        self.index_profile_col.update(
-            {'session': data['session'],
-             'collection': data['collection'],
-             'index': data['explain']['cursor'],
-             'queries.query': query_skeleton},
-            {'$inc': {'queries.$.count': 1},
-             '$set': {
-                 'queries.$.covered': data['explain']['indexOnly']
-             },
-             '$push': {
-                 'queries.$.durations': data['explain']['millis']
-            }})
+    @property
+    def profile_col(self):
+        return self.index_profile_col
+
+    def _shape(self, data):
+        # index profiles are per skeleton, whatever their source
+        return (skeleton(data['query']), None)
+
+    def _key(self, data, shape):
+        return (data['session'], data['collection'],
+                plan_summary(data)['index'], shape[0])
+
+    def _new_entry(self):
+        return _IndexQueryEntry()
+
+    def _updates(self, entries):
+        updates = {}
+        for key, entry in entries.iteritems():
+            session, collection, index, query_skeleton = key
+            q = (session, collection, index)
+            if q not in updates:
+                updates[q] = ({'$inc': {}, '$set': {}}, [])
+            update, keys = updates[q]
+            prefix = 'queries.%s.' % (query_key(query_skeleton))
+            update['$inc'][prefix + 'count'] = entry.count
+            update['$set'][prefix + 'query'] = query_skeleton
+            update['$set'][prefix + 'covered'] = entry.covered
+            if entry.durations.count > 0:
+                merge_update(update,
+                              entry.durations.to_update(prefix + 'durations'))
+            for name, histogram in entry.scan.iteritems():
+                if histogram.count > 0:
+                    merge_update(update, histogram.to_update(
+                        '%sscan.%s' % (prefix, name)))
+            if entry.scan_and_order > 0:
+                update['$inc'][prefix + 'scan.scan_and_order'] = \
+                    entry.scan_and_order
+            keys.append(key)
+        return [({'session': session, 'collection': collection,
+                  'index': index}, update, keys)
+                for (session, collection, index), (update, keys)
+                in updates.iteritems()]
+
+
+def _lowest_priority(samples, n):
+    return sorted(samples, key=lambda sample: sample['priority'])[:n]
+
+
+class _QueryEntry(object):
+    def __init__(self, max_samples):
+        self.max_samples = max_samples
+        self.count = 0
+        self.hits = 0
+        self.millis = Histogram()
+        self.durations = Histogram()
+        self.first_seen = None
+        self.last_seen = None
+        self.explain = None
+        self.plan = None
+        self.plan_id = None
+        # a sample of the explains seen, each is given a random priority and
+        # those with the lowest are kept
+        self.samples = []
+
+    def _sample(self, explain, seen):
+        self.explain = explain
+        self.samples.append({'explain': explain, 'seen': seen,
+                             'priority': random.random()})
+        if len(self.samples) > self.max_samples:
+            self.samples = _lowest_priority(self.samples, self.max_samples)
+
+    def add(self, data):
+        seen = datetime.utcnow()
+        if self.first_seen is None:
+            self.first_seen = seen
+        self.last_seen = seen
+        if data.get('type') == 'explain_summary':
+            self.count += data['count']
+            self.hits += data.get('hits', 0)
+            self.millis.merge(Histogram.from_document(data['millis']))
+            cached = data['count'] == data.get('hits', 0)
+        else:
+            self.count += 1
+            cached = data.get('cached', False)
+            millis = plan_summary(data)['millis']
+            if cached:
+                self.hits += 1
+            elif millis is not None:
+                self.millis.add(millis)
+        if 'durations' in data:
+            self.durations.merge(Histogram.from_document(data['durations']))
+        elif 'duration' in data:
+            self.durations.add(data['duration'])
+        self.plan_id = data.get('plan_id', self.plan_id)
+        # cache hits carry the cached plan, it was sampled when cached
+        if not cached or self.explain is None:
+            self.plan = plan_summary(data)
+            self._sample(sanitize(data['explain']), seen)
+
+    def merge(self, other):
+        self.count += other.count
+        self.hits += other.hits
+        self.millis.merge(other.millis)
+        self.durations.merge(other.durations)
+        self.first_seen = min(self.first_seen, other.first_seen)
+        self.last_seen = max(self.last_seen, other.last_seen)
+        self.explain = other.explain
+        self.plan = other.plan
+        self.plan_id = other.plan_id or self.plan_id
+        self.samples = _lowest_priority(self.samples + other.samples,
+                                        self.max_samples)
 
 
 class QueryProfileSink(ProfileSink):
+    """ Profile the plans of queries
+
+    Explains are deduplicated per (session, database, collection, function,
+    skeleton, source, index) into one document, with the number of times
+    the query was seen, when it was first and last seen, histograms of its
+    explain ``millis`` and call ``durations``, its latest ``explain`` and
+    its summary (``plan``, see :mod:`mongodrums.plan`) and a uniform random
+    sample of up to ``query_profile_sink.samples`` of its explains. Each
+    explain sampled is given a random ``priority`` and those with the lowest
+    are kept, in memory and in the document, so the sample stays uniform
+    across flushes and collectors.
+
+    """
     def __init__(self):
-        super(QueryProfileSink, self).__init__()
+        config = get_config()
+        super(QueryProfileSink, self).__init__(
+            config.query_profile_sink.flush_size,
+            config.query_profile_sink.max_buffered)
+        self._max_samples = config.query_profile_sink.samples
         self._query_profile_col = None
 
-    def filter(self, data, address):
-        return data['collection'].startswith('$')
-
     @property
     def query_profile_col(self):
         if self._query_profile_col is None:
             from .collection import QueryProfileCollection
             col_name = QueryProfileCollection.get_collection_name()
-            self._query_profile_col = QueryProfileCollection(self.db[col_name])
+            query_profile_col = QueryProfileCollection(self.db[col_name])
+            query_profile_col.ensure_indexes(self._max_samples)
+            self._query_profile_col = query_profile_col
         return self._query_profile_col
 
+    @property
+    def profile_col(self):
+        return self.query_profile_col
+
+    def _key(self, data, shape):
+        return (data['session'], data['database'], data['collection'],
+                data['function'], shape[0], shape[1],
+                plan_summary(data)['index'])
+
+    def _new_entry(self):
+        return _QueryEntry(self._max_samples)
+
+    def _updates(self, entries):
+        updates = []
+        for key, entry in entries.iteritems():
+            session, database, collection, function, query_skeleton, \
+                source, index = key
+            update = {'$inc': {'count': entry.count, 'hits': entry.hits},
+                      '$min': {'first_seen': entry.first_seen},
+                      '$max': {'last_seen': entry.last_seen},
+                      '$set': {'explain': entry.explain,
+                               'plan': entry.plan},
+                      '$push': {'samples': {'$each': entry.samples,
+                                            '$sort': {'priority': 1},
+                                            '$slice': self._max_samples}}}
+            if entry.plan_id is not None:
+                update['$set']['plan_id'] = entry.plan_id
+            for field in ['millis', 'durations']:
+                histogram = getattr(entry, field)
+                if histogram.count > 0:
+                    merge_update(update, histogram.to_update(field))
+            updates.append(({'session': session, 'database': database,
+                             'collection': collection, 'function': function,
+                             'query': query_skeleton, 'source': source,
+                             'index': index}, update, [key]))
+        return updates
+
+
+class TimingSink(MongoSink):
+    """ Keep the call timings pushed by :mod:`mongodrums.timing`
+
+    Timings are added up per (session, database, collection, function) into
+    one document of the ``timing`` collection, with the number of calls
+    (``count``), their total milliseconds (``total``) and the quickest and
+    slowest (``min`` and ``max``).
+
+    """
+    COLLECTION_NAME = 'timing'
+    KEY = ('session', 'database', 'collection', 'function')
+
+    def __init__(self):
+        super(TimingSink, self).__init__(get_config().timing_sink.mongo_uri)
+        self._timing_col = None
+
+    @property
+    def timing_col(self):
+        if self._timing_col is None:
+            timing_col = self.db[self.__class__.COLLECTION_NAME]
+            timing_col.ensure_index([(field, 1)
+                                     for field in self.__class__.KEY],
+                                    unique=True)
+            self._timing_col = timing_col
+        return self._timing_col
+
+    def filter(self, data, address):
+        return data.get('type') != 'timing'
+
     def send(self, data, address):
-        query_profile_doc = \
-            {'function': data['function'],
-             'database': data['database'],
-             'collection': data['collection'],
-             'session': data['session'],
-             'explain': sanitize(data['explain']),
-             'query': skeleton(data['query']),
-             'source': data['source']}
-        self.query_profile_col.save(query_profile_doc)
+        q = dict([(field, data[field]) for field in self.__class__.KEY])
+        update = {'$inc': {'count': data['count'], 'total': data['total']},
+                  '$min': {'min': data['min']},
+                  '$max': {'max': data['max']}}
+        try:
+            self.timing_col.update(q, update, upsert=True)
+        except DuplicateKeyError:
+            # lost the race to create the document, update the winner's
+            self.timing_col.update(q, update)
+
+
+class TopKSink(MongoSink):
+    """ Track the heaviest query skeletons of each collection in fixed
+    memory, to find what to optimize first
+
+    Skeletons are ranked per collection by how often they were seen
+    (``count``), their total explain ``millis`` and their total scan
+    inefficiency (keys or documents examined per document returned of each
+    explain), each in a
+    :class:`~mongodrums.util.spacesaving.SpaceSaving` of
+    ``top_k_sink.size`` counters. Every ``top_k_sink.snapshot_interval``
+    seconds the top ``top_k_sink.k`` of each ranking are written as one
+    document per collection to the ``top_k`` collection, or appended as a
+    JSON line to ``top_k_sink.path`` if set.
+
+    With more than one collector worker each worker only ranks the share of
+    the traffic it receives, so snapshots carry the worker's ``pid`` and
+    are appended to ``top_k_sink.path`` suffixed with ``.<pid>``. Consumers
+    merge the latest snapshot of every pid, adding up the weights (and
+    errors) of the same skeleton.
+
+    """
+    RANKINGS = ('count', 'millis', 'scan')
+    COLLECTION_NAME = 'top_k'
+
+    def __init__(self):
+        config = get_config()
+        super(TopKSink, self).__init__(config.top_k_sink.mongo_uri)
+        self._size = config.top_k_sink.size
+        self._k = config.top_k_sink.k
+        self._snapshot_interval = config.top_k_sink.snapshot_interval
+        self._path = config.top_k_sink.path
+        self._workers = config.collector.workers
+        self._rankings = {}
+        self._snapshotted = time.time()
+        self._changed = False
+
+    def filter(self, data, address):
+        return data.get('type', 'explain') not in EXPLAIN_TYPES or \
+               data['collection'].startswith('$') or \
+               'error' in data['explain']
+
+    def send(self, data, address):
+        namespace = (data['database'], data['collection'])
+        rankings = self._rankings.get(namespace)
+        if rankings is None:
+            rankings = self._rankings[namespace] = \
+                dict([(ranking, SpaceSaving(self._size))
+                      for ranking in self.__class__.RANKINGS])
+        query_skeleton = skeleton(data['query'])
+        plan = plan_summary(data)
+        if data.get('type') == 'explain_summary':
+            count = data['count']
+            millis = data['millis'].get('sum', 0)
+        else:
+            count = 1
+            # cache hits carry the cached plan but no timing of their own
+            millis = 0 if data.get('cached', False) else plan['millis'] or 0
+        rankings['count'].add(query_skeleton, count)
+        if millis > 0:
+            rankings['millis'].add(query_skeleton, millis)
+        # collection scans examine documents but no keys
+        examined = max(plan['keys_examined'], plan['docs_examined'])
+        if examined is not None:
+            rankings['scan'].add(query_skeleton,
+                                 count * float(examined) /
+                                 max(plan['n'], 1))
+        self._changed = True
+
+    def top(self):
+        """ Get the top skeletons of every ranking, per ``(database,
+        collection)``
+
+        """
+        return dict([(namespace,
+                      dict([(ranking,
+                             [{'query': key, 'weight': weight,
+                               'error': error}
+                              for key, weight, error
+                              in table.top(self._k)])
+                            for ranking, table in rankings.iteritems()]))
+                     for namespace, rankings in self._rankings.iteritems()])
+
+    def snapshot(self):
+        """ Write the top skeletons of every collection
+
+        """
+        now = datetime.utcnow()
+        top = self.top()
+        self._snapshotted = time.time()
+        self._changed = False
+        docs = []
+        for (database, collection), rankings in top.iteritems():
+            doc = {'time': now,
+                   'session': self._config.collector.session,
+                   'pid': os.getpid(),
+                   'database': database,
+                   'collection': collection}
+            doc.update(rankings)
+            docs.append(doc)
+        if len(docs) == 0:
+            return
+        try:
+            if self._path is not None:
+                path = self._path
+                if self._workers > 1:
+                    path = '%s.%d' % (path, os.getpid())
+                with open(path, 'a') as f:
+                    f.write(dumps(docs) + '\n')
+            else:
+                self.db[self.__class__.COLLECTION_NAME].insert(docs)
+        except Exception:
+            # snapshot again next time round
+            self._changed = True
+            raise
+
+    def flush(self):
+        if self._changed and \
+                time.time() - self._snapshotted >= self._snapshot_interval:
+            self.snapshot()
 
+    def stats(self):
+        return {'collections': len(self._rankings)}
@@ -0,0 +1,186 @@
+"""
+An append only, segment rotated, on disk spool of records for sinks that
+can't keep up
+
+Records are BSON documents, each prefixed with its length, written through a
+memory map of a pre-sized segment file. A zero length marks the end of the
+records in a segment (segments are created zero filled). Segments are
+numbered in the order they are written and read, and are deleted once every
+record in them has been read. Segments left behind by a previous process are
+read before any new ones, starting from where it stopped reading.
+
+"""
+
+import mmap
+import os
+import struct
+
+from collections import deque
+
+from bson import BSON
+
+
+LENGTH = struct.Struct('!I')
+SUFFIX = '.spool'
+OFFSET_SUFFIX = '.offset'
+
+
+class _Segment(object):
+    def __init__(self, path, size=None):
+        self.path = path
+        with open(path, 'w+b' if size is not None else 'r+b') as f:
+            if size is not None:
+                f.truncate(size)
+            self.size = os.fstat(f.fileno()).st_size
+            self.map = mmap.mmap(f.fileno(), self.size)
+        # where the next record is read from and written to
+        self.read_offset = 0
+        self.write_offset = 0
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+
+
+class Spool(object):
+    """ Spool records to ``directory`` in ``segment_size`` byte segments,
+    taking up at most ``max_size`` bytes
+
+    Records that would take the spool over ``max_size`` are dropped. This is
+    not thread safe.
+
+    """
+    def __init__(self, directory, segment_size=2**24, max_size=2**30):
+        self._directory = directory
+        self._segment_size = segment_size
+        self._max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._segments = deque(sorted(
+            [int(name[:-len(SUFFIX)]) for name in os.listdir(directory)
+             if name.endswith(SUFFIX) and name[:-len(SUFFIX)].isdigit()]))
+        self._next = self._segments[-1] + 1 if self._segments else 0
+        self._writer = None
+        self._reader = None
+        self._stats = {'appended': 0, 'read': 0, 'dropped': 0}
+
+    def _path(self, seq, suffix=SUFFIX):
+        return os.path.join(self._directory, '%020d%s' % (seq, suffix))
+
+    def _rotate(self):
+        if (len(self._segments) + 1) * self._segment_size > self._max_size:
+            return False
+        if self._writer is not None and self._writer is not self._reader:
+            self._writer.close()
+        seq = self._next
+        self._next += 1
+        self._writer = _Segment(self._path(seq), self._segment_size)
+        self._writer.seq = seq
+        self._segments.append(seq)
+        return True
+
+    def append(self, record):
+        """ Append a record (a BSON encodable dict), returning False if it
+        was dropped
+
+        """
+        data = BSON.encode(record)
+        size = LENGTH.size + len(data)
+        # leave room for the end of segment marker
+        if size + LENGTH.size > self._segment_size:
+            self._stats['dropped'] += 1
+            return False
+        writer = self._writer
+        if writer is None or \
+                writer.write_offset + size + LENGTH.size > writer.size:
+            if not self._rotate():
+                self._stats['dropped'] += 1
+                return False
+            writer = self._writer
+        writer.map[writer.write_offset:writer.write_offset + size] = \
+            LENGTH.pack(len(data)) + data
+        writer.write_offset += size
+        self._stats['appended'] += 1
+        return True
+
+    def _remove(self, segment):
+        # segments are only removed once read, so this is always the oldest
+        segment.close()
+        os.unlink(segment.path)
+        if os.path.exists(self._path(segment.seq, OFFSET_SUFFIX)):
+            os.unlink(self._path(segment.seq, OFFSET_SUFFIX))
+        self._segments.popleft()
+
+    def _next_reader(self):
+        if self._reader is not None:
+            if self._reader is self._writer:
+                # fully read while still being written to
+                return False
+            self._remove(self._reader)
+            self._reader = None
+        if len(self._segments) == 0:
+            return False
+        seq = self._segments[0]
+        if self._writer is not None and self._writer.seq == seq:
+            self._reader = self._writer
+        else:
+            self._reader = _Segment(self._path(seq))
+            self._reader.seq = seq
+            offset_path = self._path(seq, OFFSET_SUFFIX)
+            if os.path.exists(offset_path):
+                with open(offset_path) as f:
+                    self._reader.read_offset = int(f.read())
+        return True
+
+    def read(self, max_records):
+        """ Read (and consume) up to ``max_records`` of the oldest records
+
+        """
+        records = []
+        while len(records) < max_records:
+            reader = self._reader
+            if reader is None or \
+                    reader.read_offset + LENGTH.size > reader.size:
+                length = 0
+            else:
+                length, = LENGTH.unpack_from(reader.map, reader.read_offset)
+            if length == 0:
+                if not self._next_reader():
+                    break
+                continue
+            start = reader.read_offset + LENGTH.size
+            records.append(BSON(reader.map[start:start + length]).decode())
+            reader.read_offset = start + length
+        self._stats['read'] += len(records)
+        return records
+
+    def empty(self):
+        if len(self._segments) == 0:
+            return True
+        reader = self._reader
+        return len(self._segments) == 1 and reader is not None and \
+               reader is self._writer and \
+               reader.read_offset == reader.write_offset
+
+    def close(self):
+        reader = self._reader
+        if reader is not None and reader.read_offset > 0:
+            if reader is self._writer and \
+                    reader.read_offset == reader.write_offset:
+                self._remove(reader)
+            else:
+                # so the records read aren't read again
+                with open(self._path(reader.seq, OFFSET_SUFFIX), 'w') as f:
+                    f.write(str(reader.read_offset))
+        for segment in (self._reader, self._writer):
+            if segment is not None:
+                segment.close()
+        self._reader = self._writer = None
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats.update({'segments': len(self._segments),
+                      'bytes': len(self._segments) * self._segment_size})
+        return stats
@@ -3,6 +3,8 @@ from unittest import TestCase
 import pymongo
 
 from mongodrums.config import get_config, configure, update
+from mongodrums.instrument import ExplainCache
+from mongodrums.sampler import Sampler
 
 # TODO: use ming's "mongo in memory"?
 
@@ -18,6 +20,8 @@ class BaseTest(TestCase):
         self.client = pymongo.MongoClient()
         self.client.drop_database(self.__class__.TEST_DB)
         self.db = self.client[self.__class__.TEST_DB]
+        ExplainCache().clear()
+        Sampler().clear()
 
     def tearDown(self):
         configure(self.saved_config)
@@ -1,16 +1,28 @@
+import json
+import multiprocessing
+import os
+import shutil
+import signal
 import socket
+import tempfile
 import time
 import ssl
+import urllib2
 
 import gevent
 import mock
 import pymongo
 
+from unittest import TestCase
+
 from . import BaseTest
+from mongodrums.capture import read_capture
 from mongodrums.collection import SessionCollection
-from mongodrums.collector import Collector, CollectorRunner
+from mongodrums.collector import Collector, CollectorRunner, SinkQueue
 from mongodrums.config import get_config, update
 from mongodrums.sink import Sink
+from mongodrums.spool import Spool
+from mongodrums.wire import encode, encode_body, fragment, pack_batch
 
 
 class _BufferSink(Sink):
@@ -21,6 +33,42 @@ class _BufferSink(Sink):
         self.msgs.append((data, address))
 
 
+class _SlowSink(_BufferSink):
+    def send(self, data, address):
+        gevent.sleep(.5)
+        super(_SlowSink, self).send(data, address)
+
+
+class _FailingSink(_BufferSink):
+    def __init__(self):
+        super(_FailingSink, self).__init__()
+        self.failing = True
+
+    def send(self, data, address):
+        if self.failing:
+            raise IOError('sink is down')
+        super(_FailingSink, self).send(data, address)
+
+
+class _BadDataSink(_BufferSink):
+    def send(self, data, address):
+        if data.get('bad'):
+            raise KeyError('bad')
+        super(_BadDataSink, self).send(data, address)
+
+
+class _FileSink(Sink):
+    """ Count messages in a per process file, for sinks in worker processes
+
+    """
+    def __init__(self, tmp_dir):
+        self._tmp_dir = tmp_dir
+
+    def send(self, data, address):
+        with open(os.path.join(self._tmp_dir, str(os.getpid())), 'a') as f:
+            f.write('.')
+
+
 class CollectorTest(BaseTest):
     def setUp(self):
         super(CollectorTest, self).setUp()
@@ -81,3 +129,252 @@ class CollectorTest(BaseTest):
             time.sleep(.1)
         self.assertEqual([x[0] for x in sink.msgs], ['blah'] * 5)
 
+    def test_stats(self):
+        update({'collector': {'stats': {'port': 63334}}})
+        config = get_config()
+        addr = (config.collector.addr, config.collector.port)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink = _BufferSink()
+        self._start_server([sink])
+        time.sleep(1)
+        for i in xrange(5):
+            sock.sendto(encode({'a': i}), addr)
+        sock.sendto(encode({'a': 5})[:-1], addr)
+        time.sleep(.1)
+        stats = json.loads(urllib2.urlopen(
+                    'http://%s:%d/' % (config.collector.stats.addr,
+                                       config.collector.stats.port)).read())
+        self._stop_server()
+        self.assertEqual(stats['receive']['datagrams'], 6)
+        self.assertEqual(stats['receive']['messages'], 5)
+        self.assertEqual(stats['receive']['decode_errors'], 1)
+        self.assertEqual(stats['decode_ms']['count'], 6)
+        self.assertEqual(stats['sinks']['_BufferSink']['handled'], 5)
+        self.assertEqual(stats['sinks']['_BufferSink']['handle_ms']['count'],
+                         5)
+        self.assertEqual(stats['kernel']['drops'], 0)
+
+    def test_handle_batch(self):
+        update({'collector': {'session': 'collector_test'}})
+        sink = _BufferSink()
+        collector = Collector(('127.0.0.1', 0))
+        collector.add_sink(sink)
+        for format_ in ['json', 'bson']:
+            collector.handle(
+                pack_batch([encode_body({'a': 1}, format_),
+                            encode_body({'b': 2}, format_)], format_),
+                ('127.0.0.1', 1234))
+        collector.join_sinks()
+        self.assertEqual([x[0] for x in sink.msgs],
+                         [{'a': 1, 'session': 'collector_test'},
+                          {'b': 2, 'session': 'collector_test'}] * 2)
+
+    def test_handle_slow_sink(self):
+        sink = _BufferSink()
+        slow_sink = _SlowSink()
+        collector = Collector(('127.0.0.1', 0))
+        collector.add_sink(sink)
+        collector.add_sink(slow_sink, queue_size=2, workers=1)
+        for i in xrange(5):
+            collector.handle(encode({'a': i}), ('127.0.0.1', 1234))
+        # the slow sink drops what doesn't fit in its queue, without holding
+        # up the other sink
+        collector.join_sinks(.1)
+        self.assertEqual([x[0]['a'] for x in sink.msgs], range(5))
+        self.assertEqual(slow_sink.msgs, [])
+        collector.join_sinks()
+        self.assertEqual([x[0]['a'] for x in slow_sink.msgs], [0, 1])
+        stats = collector.sink_stats()
+        self.assertEqual(stats['_BufferSink']['handled'], 5)
+        self.assertEqual(stats['_SlowSink']['handled'], 2)
+        self.assertEqual(stats['_SlowSink']['dropped'], 3)
+
+    def test_handle_spool(self):
+        update({'collector': {'spool': {'retry_interval': .2}}})
+        tmp_dir = tempfile.mkdtemp()
+        replay_interval = SinkQueue.REPLAY_INTERVAL
+        SinkQueue.REPLAY_INTERVAL = .05
+        try:
+            sink = _FailingSink()
+            collector = Collector(('127.0.0.1', 0), spool_dir=tmp_dir)
+            collector.add_sink(sink, queue_size=4, workers=1)
+            for i in xrange(20):
+                collector.handle(encode({'a': i}), ('127.0.0.1', 1234))
+            collector.join_sinks()
+            gevent.sleep(.5)
+            self.assertEqual(sink.msgs, [])
+            stats = collector.sink_stats()['_FailingSink']
+            self.assertTrue(stats['spooled'] >= 20)
+            self.assertEqual(stats['dropped'], 0)
+            sink.failing = False
+            # replayed a half empty queue at a time
+            for i in xrange(50):
+                if len(sink.msgs) == 20:
+                    break
+                gevent.sleep(.1)
+            self.assertEqual(sorted([x[0]['a'] for x in sink.msgs]),
+                             range(20))
+            self.assertEqual([x[1] for x in sink.msgs],
+                             [('127.0.0.1', 1234)] * 20)
+        finally:
+            SinkQueue.REPLAY_INTERVAL = replay_interval
+            shutil.rmtree(tmp_dir)
+
+    def test_handle_spool_bad_data(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            sink = _BadDataSink()
+            collector = Collector(('127.0.0.1', 0), spool_dir=tmp_dir)
+            collector.add_sink(sink, queue_size=4, workers=1)
+            collector.handle(encode({'bad': True}), ('127.0.0.1', 1234))
+            collector.join_sinks()
+            # bad data is dropped rather than spooled, and doesn't divert
+            # what follows to the spool as if the sink were down
+            collector.handle(encode({'a': 1}), ('127.0.0.1', 1234))
+            collector.join_sinks()
+            self.assertEqual([x[0]['a'] for x in sink.msgs], [1])
+            stats = collector.sink_stats()['_BadDataSink']
+            self.assertEqual(stats['errors'], 1)
+            self.assertEqual(stats['spooled'], 0)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_capture(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'capture')
+            collector = Collector(('127.0.0.1', 0), capture_path=path)
+            collector.add_sink(_BufferSink())
+            collector.start()
+            datagrams = [encode({'a': i}) for i in xrange(3)] + ['blah']
+            for i, data in enumerate(datagrams):
+                collector.handle(data, ('127.0.0.1', 1234 + i))
+            collector.stop()
+            records = list(read_capture(path))
+            self.assertEqual([r[1:] for r in records],
+                             [(('127.0.0.1', 1234 + i), data)
+                              for i, data in enumerate(datagrams)])
+            timestamps = [r[0] for r in records]
+            self.assertEqual(timestamps, sorted(timestamps))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_handle_fragments(self):
+        update({'collector': {'session': 'collector_test'}})
+        sink = _BufferSink()
+        collector = Collector(('127.0.0.1', 0))
+        collector.add_sink(sink)
+        msg = {'a': 'x' * 1000}
+        fragments = fragment(encode(msg), 256, 1)
+        self.assertTrue(len(fragments) > 1)
+        # fragments are only put back together per source, and in any order
+        for data in reversed(fragments[1:]):
+            collector.handle(data, ('127.0.0.1', 1234))
+        for data in fragments[:-1]:
+            collector.handle(data, ('127.0.0.1', 4321))
+        collector.join_sinks()
+        self.assertEqual(sink.msgs, [])
+        collector.handle(fragments[0], ('127.0.0.1', 1234))
+        collector.join_sinks()
+        self.assertEqual([x[0] for x in sink.msgs],
+                         [dict(msg, session='collector_test')])
+
+    def test_handle_unix(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'collector.sock')
+            # left behind by a collector that didn't stop cleanly
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.bind(path)
+            sock.close()
+            update({'collector': {'addr': 'unix://' + path}})
+            sink = _BufferSink()
+            self._start_server([sink])
+            time.sleep(1)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.sendto(encode({'a': 'x' * 100000}), path)
+            time.sleep(.1)
+            self._stop_server()
+            self.assertFalse(os.path.exists(path))
+            self.assertEqual([x[0]['a'] for x in sink.msgs], ['x' * 100000])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_workers(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            config = get_config()
+            addr = (config.collector.addr, config.collector.port)
+            self._server = CollectorRunner(lambda: [_FileSink(tmp_dir)], 3)
+            self._server.start()
+            time.sleep(1)
+            workers = multiprocessing.active_children()
+            self.assertEqual(len(workers), 3)
+            # the kernel picks a worker by source address
+            for i in xrange(60):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.sendto(encode({'a': i}), addr)
+                sock.close()
+            time.sleep(.5)
+            counts = [os.path.getsize(os.path.join(tmp_dir, name))
+                      for name in os.listdir(tmp_dir)]
+            self.assertEqual(sum(counts), 60)
+            self.assertTrue(len(counts) > 1)
+            os.kill(workers[0].pid, signal.SIGKILL)
+            time.sleep(1)
+            pids = [w.pid for w in multiprocessing.active_children()]
+            self.assertEqual(len(pids), 3)
+            self.assertNotIn(workers[0].pid, pids)
+            self._stop_server()
+            self.assertEqual(multiprocessing.active_children(), [])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class SpoolTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _read_all(self, spool):
+        records = []
+        while True:
+            batch = spool.read(7)
+            if len(batch) == 0:
+                return records
+            records.extend(batch)
+
+    def test_rotate(self):
+        spool = Spool(self.tmp_dir, 1024, 4096)
+        for i in xrange(30):
+            self.assertTrue(spool.append({'i': i, 'pad': 'x' * 50}))
+        self.assertEqual(spool.stats()['segments'], 3)
+        self.assertEqual([r['i'] for r in self._read_all(spool)], range(30))
+        self.assertTrue(spool.empty())
+        # read segments are removed, the one being written to is kept
+        self.assertEqual(len(os.listdir(self.tmp_dir)), 1)
+
+    def test_max_size(self):
+        spool = Spool(self.tmp_dir, 1024, 2048)
+        appended = [spool.append({'i': i, 'pad': 'x' * 50})
+                    for i in xrange(30)]
+        count = appended.count(True)
+        self.assertEqual(appended, [True] * count + [False] * (30 - count))
+        self.assertEqual(spool.stats()['dropped'], 30 - count)
+        self.assertEqual([r['i'] for r in self._read_all(spool)],
+                         range(count))
+
+    def test_reopen(self):
+        spool = Spool(self.tmp_dir, 1024, 4096)
+        for i in xrange(30):
+            spool.append({'i': i, 'pad': 'x' * 50})
+        self.assertEqual([r['i'] for r in spool.read(10)], range(10))
+        spool.close()
+        spool = Spool(self.tmp_dir, 1024, 4096)
+        spool.append({'i': 30})
+        self.assertEqual([r['i'] for r in self._read_all(spool)],
+                         range(10, 31))
+        spool.close()
+        self.assertEqual(os.listdir(self.tmp_dir), [])
@@ -1,4 +1,5 @@
 import inspect
+import threading
 
 import pymongo
 
@@ -6,10 +7,17 @@ from mock import patch
 
 from . import BaseTest
 from mongodrums.instrument import (
-    UpdateWrapper, FindWrapper, start, stop, instrument, instrumented
+    UpdateWrapper, FindWrapper, CollectionMethodWrapper, COLLECTION_METHODS,
+    start, stop, instrument, instrumented, explain_cache_stats
 )
 
 from mongodrums.config import update
+from mongodrums.aggregator import Aggregator
+from mongodrums.explain import ExplainPool
+from mongodrums.plan import summarize
+from mongodrums.sampler import Sampler, sample_key
+from mongodrums.timing import Timings
+from mongodrums.util.source import SourceResolver
 
 
 class InstrumentTest(BaseTest):
@@ -44,6 +52,70 @@ class InstrumentTest(BaseTest):
         self.assertNotIsInstance(pymongo.collection.Collection.find,
                                  FindWrapper)
 
+    def test_instrument_collection_methods(self):
+        funcs = dict([(name, getattr(pymongo.collection.Collection, name))
+                      for name, _ in COLLECTION_METHODS])
+        with CollectionMethodWrapper.instrument():
+            for name in funcs:
+                self.assertIsInstance(
+                    getattr(pymongo.collection.Collection, name),
+                    CollectionMethodWrapper)
+        for name, func in funcs.iteritems():
+            self.assertEqual(getattr(pymongo.collection.Collection, name),
+                             func)
+
+    def test_find_one_push(self):
+        update({'instrument': {'sample_frequency': 1}})
+        with patch('mongodrums.instrument.push') as push_mock, \
+             instrument():
+            doc = self.db.foo.find_one(2)
+            self.assertEqual(doc, {'_id': 2, 'name': 'alice'})
+            # the find issued by find_one is not instrumented separately
+            self.assertEqual(push_mock.call_count, 1)
+            msg = push_mock.call_args[0][0]
+            self.assertEqual(msg['function'], 'find_one')
+            self.assertEqual(msg['query'], '{"_id": 2}')
+            self.assertIn('duration', msg)
+            self.assertIn('allPlans', msg['explain'])
+
+    def test_remove_push(self):
+        update({'instrument': {'sample_frequency': 1}})
+        with patch('mongodrums.instrument.push') as push_mock, \
+             instrument():
+            self.db.foo.remove({'name': 'bob'})
+            self.assertEqual(push_mock.call_count, 1)
+            msg = push_mock.call_args[0][0]
+            self.assertEqual(msg['function'], 'remove')
+            self.assertIn('duration', msg)
+            # explained before the remove, while bob could still be found
+            self.assertEqual(summarize(msg['explain'])['n'], 1)
+        self.assertIsNone(self.db.foo.find_one({'name': 'bob'}))
+
+    def test_timing(self):
+        Timings().flush()
+        with patch('mongodrums.timing.push') as push_mock, \
+             CollectionMethodWrapper.instrument():
+            for i in xrange(3):
+                self.db.foo.count()
+            self.db.foo.insert({'_id': 5, 'name': 'eve'})
+            Timings().flush()
+        timings = dict([(c[0][0]['function'], c[0][0])
+                        for c in push_mock.call_args_list])
+        self.assertEqual(timings['count']['count'], 3)
+        self.assertEqual(timings['insert']['count'], 1)
+        self.assertEqual(timings['count']['collection'], 'foo')
+        self.assertLessEqual(timings['count']['min'],
+                             timings['count']['max'])
+
+    def test_update_push(self):
+        update({'instrument': {'sample_frequency': 1}})
+        with patch('mongodrums.instrument.push') as push_mock, \
+             instrument():
+            self.db.foo.update({'name': 'bob'}, {'$set': {'age': 40}})
+            # the find explaining the update is not instrumented separately
+            self.assertEqual(push_mock.call_count, 1)
+            self.assertEqual(push_mock.call_args[0][0]['function'], 'update')
+
     def test_find_push(self):
         update({'instrument': {'sample_frequency': 1}})
         with patch('mongodrums.instrument.push') as push_mock, \
@@ -73,6 +145,20 @@ class InstrumentTest(BaseTest):
             source = '%s:%d' % (frame_info[0], frame_info[1] - 1)
             self.assertEqual(push_mock.call_args[0][0]['source'], source)
 
+    def test_source_resolver(self):
+        def _inspect_source(filter_packages):
+            frame = filter(lambda f: f[0].f_globals.get('__package__') \
+                                     not in filter_packages,
+                           inspect.stack()[1:])[0]
+            return '%s:%d' % (frame[1], frame[2])
+
+        for filter_packages in [[], ['mongodrums.tests']]:
+            resolver = SourceResolver(filter_packages)
+            # the second pass is served from the per code object cache
+            for i in xrange(2):
+                a, b = resolver.resolve(), _inspect_source(filter_packages)
+                self.assertEqual(a, b)
+
     def test_instrumented(self):
         self.assertFalse(instrumented())
         with instrument():
@@ -90,3 +176,135 @@ class InstrumentTest(BaseTest):
                 self.db.foo.update({'name': 'zed'}, {'$set': {'age': 40}})
         for doc in docs:
             self.assertIn('error', doc['explain'])
+
+    def test_async_explain(self):
+        update({'instrument': {'sample_frequency': 1,
+                               'async_explain': {'enabled': True}}})
+        with patch('mongodrums.instrument.push') as push_mock, \
+             FindWrapper.instrument():
+            curs = self.db.foo.find({'name': 'bob'})
+            frame_info = inspect.getframeinfo(inspect.currentframe())
+            source = '%s:%d' % (frame_info[0], frame_info[1] - 1)
+            self.assertEqual([d for d in curs], [{'_id': 1, 'name': 'bob'}])
+            ExplainPool().join()
+            self.assertEqual(push_mock.call_count, 1)
+            self.assertIn('allPlans', push_mock.call_args[0][0]['explain'])
+            self.assertEqual(push_mock.call_args[0][0]['source'], source)
+
+    def test_async_explain_drop(self):
+        update({'instrument': {'sample_frequency': 1,
+                               'sampling': {'decay': 0},
+                               'async_explain': {'enabled': True,
+                                                 'workers': 1,
+                                                 'queue_size': 1}}})
+        release = threading.Event()
+        before = ExplainPool().stats()
+        with patch('pymongo.cursor.Cursor.explain') as explain_mock, \
+             patch('mongodrums.instrument.push') as push_mock, \
+             FindWrapper.instrument():
+            explain_mock.side_effect = lambda: release.wait() or {}
+            for i in xrange(3):
+                self.db.foo.find({'name': 'bob'})
+            release.set()
+            ExplainPool().join()
+        after = ExplainPool().stats()
+        dropped = after['dropped'] - before['dropped']
+        self.assertGreaterEqual(dropped, 1)
+        self.assertEqual(push_mock.call_count, 3 - dropped)
+
+    def test_explain_cache(self):
+        update({'instrument': {'sample_frequency': 1,
+                               'sampling': {'decay': 0}}})
+        before = explain_cache_stats()
+        with patch('mongodrums.instrument.push') as push_mock, \
+             FindWrapper.instrument():
+            self.db.foo.find({'name': 'bob'})
+            self.db.foo.find({'name': 'alice'})
+            self.db.foo.find({'name': 'zed'}, sort=[('name', 1)])
+        after = explain_cache_stats()
+        full, hit, sorted_ = [c[0][0] for c in push_mock.call_args_list]
+        self.assertIn('allPlans', full['explain'])
+        self.assertNotIn('cached', full)
+        self.assertTrue(hit['cached'])
+        self.assertEqual(hit['plan_id'], full['plan_id'])
+        self.assertEqual(hit['explain']['cursor'], full['explain']['cursor'])
+        self.assertNotIn('allPlans', hit['explain'])
+        # hits carry the cached plan's scan counters, but not its timing
+        self.assertEqual(summarize(hit['explain'])['keys_examined'],
+                         summarize(full['explain'])['keys_examined'])
+        self.assertIsNone(summarize(hit['explain'])['millis'])
+        self.assertNotIn('cached', sorted_)
+        self.assertEqual(after['hits'] - before['hits'], 1)
+        self.assertEqual(after['misses'] - before['misses'], 2)
+
+    def test_explain_cache_disabled(self):
+        update({'instrument': {'sample_frequency': 1,
+                               'sampling': {'decay': 0},
+                               'explain_cache': {'size': 0}}})
+        with patch('mongodrums.instrument.push') as push_mock, \
+             FindWrapper.instrument():
+            self.db.foo.find({'name': 'bob'})
+            self.db.foo.find({'name': 'alice'})
+        for call in push_mock.call_args_list:
+            self.assertIn('allPlans', call[0][0]['explain'])
+            self.assertNotIn('plan_id', call[0][0])
+
+    def test_adaptive_sampling(self):
+        update({'instrument': {'sampling': {'decay': 1,
+                                            'min_frequency': 0,
+                                            'max_per_second': 0}}})
+        sampler = Sampler()
+        key = sample_key(self.db.name, 'foo', 'find', {'name': 'bob'})
+        self.assertEqual(key, sample_key(self.db.name, 'foo', 'find',
+                                         {'name': 'alice'}))
+        with patch('random.random') as random_mock:
+            random_mock.return_value = .9
+            # new shapes are always sampled
+            self.assertTrue(sampler.sample(key, .5))
+            # then at .5 / (1 + seen)
+            random_mock.return_value = .24
+            self.assertTrue(sampler.sample(key, .5))
+            self.assertFalse(sampler.sample(key, .5))
+            random_mock.return_value = .12
+            self.assertTrue(sampler.sample(key, .5))
+        self.assertFalse(sampler.sample(key, 0))
+
+    def test_sampling_rate_limit(self):
+        update({'instrument': {'sampling': {'max_per_second': 1,
+                                            'burst': 1}}})
+        sampler = Sampler()
+        bob = sample_key(self.db.name, 'foo', 'find', {'name': 'bob'})
+        zed = sample_key(self.db.name, 'foo', 'find', {'_id': 3})
+        with patch('time.time') as time_mock:
+            time_mock.return_value = 1000.
+            update({'instrument': {'sampling': {'burst': 1}}})
+            self.assertTrue(sampler.sample(bob, 1))
+            self.assertFalse(sampler.sample(zed, 1))
+            time_mock.return_value = 1001.
+            # zed is still new, so it gets sampled as soon as a token is free
+            with patch('random.random') as random_mock:
+                random_mock.return_value = .99
+                self.assertTrue(sampler.sample(zed, .01))
+        self.assertGreaterEqual(sampler.stats()['throttled'], 1)
+
+    def test_aggregate(self):
+        update({'instrument': {'sample_frequency': 1,
+                               'sampling': {'decay': 0},
+                               'aggregate': {'enabled': True}}})
+        Aggregator().flush()
+        with patch('mongodrums.aggregator.push') as push_mock, \
+             patch('mongodrums.instrument.push') as instrument_push_mock, \
+             instrument():
+            for name in ['bob', 'alice', 'zed']:
+                self.db.foo.find_one({'name': name})
+            self.assertEqual(instrument_push_mock.call_count, 0)
+            Aggregator().flush()
+        self.assertEqual(push_mock.call_count, 1)
+        summary = push_mock.call_args[0][0]
+        self.assertEqual(summary['type'], 'explain_summary')
+        self.assertEqual(summary['function'], 'find_one')
+        self.assertEqual(summary['count'], 3)
+        self.assertEqual(summary['hits'], 2)
+        self.assertEqual(summary['millis']['count'], 1)
+        self.assertEqual(summary['durations']['count'], 3)
+        self.assertIn('allPlans', summary['explain'])
@@ -1,19 +1,23 @@
+import os
 import select
+import shutil
 import socket
+import tempfile
 import threading
 
 from bson import ObjectId
-from bson.json_util import dumps
+from bson.json_util import dumps, loads
 
 from . import BaseTest
-from mongodrums.config import get_config, configure
-from mongodrums.pusher import push
+from mongodrums.config import get_config, configure, update
+from mongodrums.pusher import Pusher, push, stats
+from mongodrums.wire import MAGIC, Reassembler, decode
 
 
 class _TestCollector(threading.Thread):
-    def __init__(self, address):
+    def __init__(self, address, family=socket.AF_INET):
         threading.Thread.__init__(self)
-        self._sock = socket.socket(socket.AF_INET,
+        self._sock = socket.socket(family,
                                    socket.SOCK_DGRAM)
         self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
         self._sock.bind(address)
@@ -23,12 +27,23 @@ class _TestCollector(threading.Thread):
     def run(self):
         rlist, wlist, xlist = select.select([self._sock], [], [], 10)
         try:
-            self.msg = rlist[0].recv(4096)
+            self.msg = rlist[0].recv(2 ** 18)
         except IndexError:
             pass
         self._sock.close()
 
 
+class _FragmentCollector(_TestCollector):
+    def run(self):
+        reassembler = Reassembler()
+        while self.msg is None:
+            rlist, wlist, xlist = select.select([self._sock], [], [], 10)
+            if len(rlist) == 0:
+                break
+            self.msg = reassembler.add(None, rlist[0].recv(65535))
+        self._sock.close()
+
+
 class PusherTest(BaseTest):
     def setUp(self):
         super(PusherTest, self).setUp()
@@ -37,6 +52,14 @@ class PusherTest(BaseTest):
                                           self._config.collector.port))
 
     def test_push(self):
+        self._collector.start()
+        msg = {'blah': {'blah': ObjectId()}}
+        push(msg)
+        self._collector.join()
+        self.assertEqual(decode(self._collector.msg), [msg])
+
+    def test_push_json(self):
+        update({'pusher': {'format': 'json'}})
         self._collector.start()
         msg = {'blah': {'blah': ObjectId()}}
         push(msg)
@@ -44,5 +67,151 @@ class PusherTest(BaseTest):
         self.assertEqual(dumps(msg),
                          self._collector.msg)
 
+    def test_push_bson(self):
+        # binary datagrams are opt in, older collectors only read json
+        update({'pusher': {'format': 'bson'}})
+        self._collector.start()
+        msg = {'blah': {'blah': ObjectId()}}
+        push(msg)
+        self._collector.join()
+        self.assertEqual(self._collector.msg[0], MAGIC)
+        self.assertEqual(decode(self._collector.msg), [msg])
+
+    def test_push_batch(self):
+        update({'pusher': {'batch': {'enabled': True, 'interval': 10}}})
+        self._collector.start()
+        msgs = [{'blah': i} for i in xrange(3)]
+        for msg in msgs:
+            push(msg)
+        Pusher().flush()
+        self._collector.join()
+        self.assertEqual(decode(self._collector.msg), msgs)
+
+    def test_push_batch_json(self):
+        update({'pusher': {'format': 'json',
+                           'batch': {'enabled': True, 'interval': 10}}})
+        self._collector.start()
+        msgs = [{'blah': i} for i in xrange(3)]
+        for msg in msgs:
+            push(msg)
+        Pusher().flush()
+        self._collector.join()
+        self.assertEqual(loads(self._collector.msg),
+                         {'type': 'batch', 'msgs': msgs})
+
+    def test_push_batch_max_size(self):
+        update({'pusher': {'format': 'json',
+                           'batch': {'enabled': True, 'interval': 10,
+                                     'max_size': 64}}})
+        self._collector.start()
+        # the second message doesn't fit in the first's datagram, which is
+        # sent as soon as the second is pushed
+        push({'blah': 'x' * 16})
+        push({'blah': 'y' * 16})
+        self._collector.join()
+        Pusher().flush()
+        self.assertEqual(loads(self._collector.msg),
+                         {'type': 'batch', 'msgs': [{'blah': 'x' * 16}]})
+
+    def test_push_uncompressed(self):
+        # compression is opt in, json only collectors can't read it
+        self._collector.start()
+        msg = {'blah': 'x' * 2048}
+        push(msg)
+        self._collector.join()
+        self.assertEqual(dumps(msg), self._collector.msg)
+
+    def test_push_compressed(self):
+        update({'pusher': {'compress_threshold': 64}})
+        self._collector.start()
+        msg = {'blah': 'x' * 1024}
+        push(msg)
+        self._collector.join()
+        self.assertTrue(len(self._collector.msg) < 1024)
+        self.assertEqual(decode(self._collector.msg), [msg])
+
+    def test_push_fragmented(self):
+        update({'pusher': {'compress_threshold': 0,
+                           'max_datagram_size': 256}})
+        collector = _FragmentCollector((self._config.collector.addr,
+                                        self._config.collector.port))
+        collector.start()
+        msg = {'blah': 'x' * 1024}
+        push(msg)
+        collector.join()
+        self.assertEqual(decode(collector.msg), [msg])
+
+    def test_push_unix(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'collector.sock')
+            update({'pusher': {'addr': 'unix://' + path,
+                               'compress_threshold': 0}})
+            collector = _TestCollector(path, socket.AF_UNIX)
+            collector.start()
+            # larger than a udp datagram, but not too large for a unix one
+            msg = {'blah': 'x' * 100000}
+            push(msg)
+            collector.join()
+            self.assertEqual(decode(collector.msg), [msg])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_push_unix_fallback(self):
+        update({'pusher': {'addr': 'unix:///nonexistent/collector.sock'}})
+        self._collector.start()
+        msg = {'blah': {'blah': ObjectId()}}
+        push(msg)
+        self._collector.join()
+        self.assertEqual(decode(self._collector.msg), [msg])
+
+    def _push_overflow(self, overflow):
+        update({'pusher': {'queue': {'size': 2, 'overflow': overflow}}})
+        self._collector.start()
+        before = stats()
+        # hold up the sender thread so the queue fills
+        with Pusher()._send_lock:
+            for i in xrange(3):
+                push({'blah': i})
+            after = stats()
+        Pusher().flush()
+        self._collector.join()
+        self.assertEqual(after['enqueued'] - before['enqueued'],
+                         3 if overflow == 'drop_oldest' else 2)
+        self.assertEqual(after['dropped'] - before['dropped'], 1)
+        self.assertEqual(after['queued'], 2)
+        self.assertEqual(stats()['sent'] - before['sent'], 2)
+        return decode(self._collector.msg)
+
+    def test_push_drop_oldest(self):
+        self.assertEqual(self._push_overflow('drop_oldest'), [{'blah': 1}])
+
+    def test_push_drop_newest(self):
+        self.assertEqual(self._push_overflow('drop_newest'), [{'blah': 0}])
+
+    def test_push_bad_overflow(self):
+        update({'pusher': {'queue': {'overflow': 'drop_newest'}}})
+        # a bad policy is logged rather than raised to update's caller
+        update({'pusher': {'queue': {'overflow': 'drop_all'}}})
+        self.assertEqual(Pusher()._overflow, 'drop_newest')
+
+    def test_push_fork(self):
+        pusher = Pusher()
+        # a message the parent is still holding when it forks
+        with pusher._send_lock:
+            push({'blah': 'parent'})
+            pid = os.fork()
+            if pid == 0:
+                # the child sends its own messages from its own thread, not
+                # the parent's
+                push({'blah': 'child'})
+                pusher.flush()
+                child_stats = stats()
+                os._exit(0 if pusher._thread.is_alive() and
+                         child_stats['enqueued'] == 1 and
+                         child_stats['sent'] == 1 else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+
     def test_push_reconfigure(self):
         pass
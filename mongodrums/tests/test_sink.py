@@ -1,5 +1,9 @@
+import os
 import pymongo
 import random
+import tempfile
+
+from bson.json_util import dumps, loads
 
 import mongodrums.instrument
 
@@ -7,7 +11,13 @@ from . import BaseTest
 from mongodrums.collection import IndexProfileCollection, QueryProfileCollection
 from mongodrums.config import get_config, update
 from mongodrums.instrument import instrument
-from mongodrums.sink import IndexProfileSink, QueryProfileSink
+from mongodrums.plan import summarize
+from mongodrums.sink import (
+    IndexProfileSink, QueryProfileSink, SinkFull, TimingSink, TopKSink,
+    query_key
+)
+from mongodrums.util import _p_skeleton, skeleton, skeleton_stats
+from mongodrums.util.spacesaving import CardinalityGuard
 
 
 class ProfileSinkTest(BaseTest):
@@ -29,6 +39,14 @@ class ProfileSinkTest(BaseTest):
             'query_profile_sink': {
                 'mongo_uri': 'mongodb://127.0.0.1:27017/%s' %
                              (self.__class__.SINK_TEST_DB)
+            },
+            'timing_sink': {
+                'mongo_uri': 'mongodb://127.0.0.1:27017/%s' %
+                             (self.__class__.SINK_TEST_DB)
+            },
+            'top_k_sink': {
+                'mongo_uri': 'mongodb://127.0.0.1:27017/%s' %
+                             (self.__class__.SINK_TEST_DB)
             }
         })
         self._index_profile_sink = IndexProfileSink()
@@ -76,6 +94,8 @@ class ProfileSinkTest(BaseTest):
         for msg in self._msgs:
             self._index_profile_sink.handle(msg, ('127.0.0.1', 65535))
             self._query_profile_sink.handle(msg, ('127.0.0.1', 65535))
+        self._index_profile_sink.flush()
+        self._query_profile_sink.flush()
         query_profile_col = QueryProfileCollection.get_collection_name()
         index_profile_col = IndexProfileCollection.get_collection_name()
         self.assertEqual(self.sink_db[query_profile_col].find().count(), 2)
@@ -92,8 +112,341 @@ class ProfileSinkTest(BaseTest):
         for msg in self._msgs:
             self._index_profile_sink.handle(msg, ('127.0.0.1', 65535))
             self._query_profile_sink.handle(msg, ('127.0.0.1', 65535))
+        self._index_profile_sink.flush()
+        self._query_profile_sink.flush()
         query_profile_col = QueryProfileCollection.get_collection_name()
         index_profile_col = IndexProfileCollection.get_collection_name()
         self.assertEqual(self.sink_db[query_profile_col].find().count(), 2)
         self.assertEqual(self.sink_db[index_profile_col].find().count(), 1)
 
+
+    def test_index_profile_aggregation(self):
+        update({'instrument': {'sampling': {'decay': 0}}})
+        with instrument():
+            for i in xrange(10):
+                self.db.foo.find({'store': 'store_%d' % (i)}).count()
+        # all but the first are explain cache hits
+        self.assertTrue(any([msg.get('cached') for msg in self._msgs]))
+        for msg in self._msgs:
+            self._index_profile_sink.handle(msg, ('127.0.0.1', 65535))
+        index_profile_col = IndexProfileCollection.get_collection_name()
+        # nothing is written until the sink is flushed
+        self.assertEqual(self.sink_db[index_profile_col].find().count(), 0)
+        self._index_profile_sink.flush()
+        self._index_profile_sink.flush()
+        docs = list(self.sink_db[index_profile_col].find())
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(len(docs[0]['queries']), 1)
+        query = docs[0]['queries'].values()[0]
+        self.assertEqual(query['query'], skeleton({'store': 'store_0'}))
+        self.assertEqual(query['count'],
+                         len([msg for msg in self._msgs if not
+                              self._index_profile_sink.filter(msg, None)]))
+        # durations are a histogram, not an array of every query's millis
+        self.assertGreater(query['durations']['count'], 0)
+        self.assertLessEqual(query['durations']['count'], query['count'])
+        # as are the explain's scan counters and ratios
+        self.assertEqual(query['scan']['docs_per_returned']['count'],
+                         query['count'])
+        self.assertEqual(query['scan']['n']['count'], query['count'])
+
+    def test_index_profile_migration(self):
+        index_profile_col = IndexProfileCollection.get_collection_name()
+        # index profiles used to keep their queries in a list
+        query = skeleton({'store': 'store_0'})
+        self.sink_db[index_profile_col].insert(
+            {'session': 's', 'collection': 'foo', 'index': 'store_1',
+             'queries': [{'query': query, 'count': 2, 'covered': False,
+                          'durations': [1, 3]}]})
+        self._index_profile_sink.index_profile_col
+        docs = list(self.sink_db[index_profile_col].find())
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(docs[0]['queries'].keys(), [query_key(query)])
+        migrated = docs[0]['queries'][query_key(query)]
+        self.assertEqual(migrated['count'], 2)
+        self.assertEqual(migrated['durations']['count'], 2)
+
+    def test_index_profile_rekey(self):
+        index_profile_col = IndexProfileCollection.get_collection_name()
+        # index profiles used to be keyed by the legacy explain's cursor
+        query = skeleton({'store': 'store_0'})
+        for index in ['BtreeCursor store_1', 'store_1']:
+            self.sink_db[index_profile_col].insert(
+                {'session': 's', 'collection': 'foo', 'index': index,
+                 'queries': {query_key(query): {'query': query, 'count': 2,
+                                                'covered': False}}})
+        self._index_profile_sink.index_profile_col
+        docs = list(self.sink_db[index_profile_col].find())
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(docs[0]['index'], 'store_1')
+        self.assertEqual(docs[0]['queries'][query_key(query)]['count'], 4)
+
+    def test_profile_sink_full(self):
+        update({'index_profile_sink': {'flush_size': 1, 'max_buffered': 1}})
+        sink = IndexProfileSink()
+        with instrument():
+            self.db.foo.find({'store': 'store_0'}).count()
+            self.db.foo.find({'widget': 'widget_0'}).count()
+        msgs = [msg for msg in self._msgs if not sink.filter(msg, None)]
+        self.assertFalse(sink.full())
+        sink.handle(msgs[0], ('127.0.0.1', 65535))
+        # the collector flushes full sinks, the sink doesn't flush itself
+        self.assertTrue(sink.full())
+        index_profile_col = IndexProfileCollection.get_collection_name()
+        self.assertEqual(self.sink_db[index_profile_col].find().count(), 0)
+        # past max_buffered new profiles are refused, for the collector to
+        # spool
+        self.assertRaises(SinkFull, sink.handle, msgs[-1],
+                          ('127.0.0.1', 65535))
+        sink.flush()
+        self.assertFalse(sink.full())
+        sink.handle(msgs[-1], ('127.0.0.1', 65535))
+
+    def test_query_profile_deduplication(self):
+        update({'query_profile_sink': {'samples': 2}})
+        self._query_profile_sink = QueryProfileSink()
+        with instrument():
+            for i in xrange(10):
+                self.db.foo.find({'store': 'store_%d' % (i)}).count()
+        for msg in self._msgs:
+            self._query_profile_sink.handle(msg, ('127.0.0.1', 65535))
+        self._query_profile_sink.flush()
+        query_profile_col = QueryProfileCollection.get_collection_name()
+        docs = list(self.sink_db[query_profile_col].find())
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(docs[0]['query'], skeleton({'store': 'store_0'}))
+        self.assertEqual(docs[0]['count'],
+                         len([msg for msg in self._msgs if not
+                              self._query_profile_sink.filter(msg, None)]))
+        self.assertLessEqual(docs[0]['first_seen'], docs[0]['last_seen'])
+        # cache hits aren't sampled, they carry the cached plan
+        self.assertGreater(len(docs[0]['samples']), 0)
+        self.assertLessEqual(len(docs[0]['samples']), 2)
+
+    def test_query_profile_migration(self):
+        query_profile_col = QueryProfileCollection.get_collection_name()
+        # query profiles used to be stored one per sample
+        explain = {'cursor': 'BtreeCursor store_1', 'indexOnly': False,
+                   'millis': 1, 'n': 1, 'nscanned': 1, 'nscannedObjects': 1}
+        sample = {'session': 's', 'database': 'mongodrums_test',
+                  'collection': 'foo', 'function': 'find',
+                  'query': skeleton({'store': 'store_0'}), 'source': 'x:1',
+                  'explain': explain}
+        for i in xrange(3):
+            self.sink_db[query_profile_col].insert(dict(sample))
+        self._query_profile_sink.query_profile_col
+        docs = list(self.sink_db[query_profile_col].find())
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(docs[0]['count'], 3)
+        self.assertEqual(docs[0]['index'], 'store_1')
+        self.assertEqual(len(docs[0]['samples']), 3)
+
+    def test_query_profile_rekey(self):
+        query_profile_col = QueryProfileCollection.get_collection_name()
+        # counted query profiles used to be keyed by the explain's cursor
+        key = ['session', 'database', 'collection', 'function', 'query',
+               'source', 'cursor']
+        self.sink_db[query_profile_col].ensure_index(
+            [(field, pymongo.ASCENDING) for field in key], unique=True)
+        explain = {'cursor': 'BtreeCursor store_1', 'indexOnly': False,
+                   'millis': 1, 'n': 1, 'nscanned': 1, 'nscannedObjects': 1}
+        self.sink_db[query_profile_col].insert(
+            {'session': 's', 'database': 'mongodrums_test',
+             'collection': 'foo', 'function': 'find',
+             'query': skeleton({'store': 'store_0'}), 'source': 'x:1',
+             'cursor': explain['cursor'], 'count': 2, 'hits': 1,
+             'explain': explain, 'samples': [{'explain': explain}]})
+        self._query_profile_sink.query_profile_col
+        indexes = self.sink_db[query_profile_col].index_information()
+        self.assertFalse(any(['cursor' in dict(info['key'])
+                              for info in indexes.itervalues()]))
+        docs = list(self.sink_db[query_profile_col].find())
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(docs[0]['index'], 'store_1')
+        self.assertNotIn('cursor', docs[0])
+        self.assertEqual(docs[0]['count'], 2)
+
+    def test_skeleton_cache(self):
+        with instrument():
+            for i in xrange(10):
+                self.db.foo.find({'store': 'store_0'}).count()
+        hits = skeleton_stats()['hits']
+        for msg in self._msgs:
+            self._query_profile_sink.handle(msg, ('127.0.0.1', 65535))
+        self.assertGreater(skeleton_stats()['hits'], hits)
+
+    def test_skeleton_nesting(self):
+        # skeletons are built without recursion, so aren't limited by depth
+        query = {}
+        for i in xrange(2000):
+            query = {'$and': [query]}
+        self.assertTrue(_p_skeleton(query).startswith('{$and:[{$and:'))
+
+    def test_skeleton_collapse(self):
+        queries = [{'a': {'$in': [{'b': 1}, {'b': 2}]},
+                    '$or': [{'c': 1}, {'d': 1}, {'c': 2}]},
+                   {'a': {'$in': [{'b': 3}]},
+                    '$or': [{'d': 2}, {'c': 3}]}]
+        self.assertNotEqual(skeleton(queries[0]), skeleton(queries[1]))
+        update({'skeleton': {'collapse': {'enabled': True,
+                                          'operators': ['$in', '$or']}}})
+        self.assertEqual(skeleton(queries[0]), skeleton(queries[1]))
+        self.assertEqual(skeleton(dumps(queries[0])),
+                         skeleton(dumps(queries[1])))
+        self.assertEqual(skeleton(queries[0]),
+                         dumps(u'{$or:[{c},{d}],a:{$in:[{b}]}}'))
+        update({'skeleton': {'collapse': {'operators': ['$in']}}})
+        self.assertNotEqual(skeleton(queries[0]), skeleton(queries[1]))
+
+    def test_plan_summary(self):
+        legacy = {'cursor': 'BtreeCursor store_1', 'indexOnly': False,
+                  'scanAndOrder': True, 'nscanned': 10,
+                  'nscannedObjects': 10, 'n': 5, 'nYields': 0, 'millis': 2}
+        current = {
+            'queryPlanner': {'winningPlan': {
+                'stage': 'SORT',
+                'inputStage': {'stage': 'FETCH',
+                               'inputStage': {'stage': 'IXSCAN',
+                                              'indexName': 'store_1'}}}},
+            'executionStats': {'totalKeysExamined': 10,
+                               'totalDocsExamined': 10, 'nReturned': 5,
+                               'executionTimeMillis': 2,
+                               'executionStages': {'stage': 'SORT',
+                                                   'saveState': 0}}}
+        self.assertEqual(summarize(legacy), summarize(current))
+        self.assertEqual(summarize(current)['stages'],
+                         ['SORT', 'FETCH', 'IXSCAN'])
+        scan = summarize({'queryPlanner': {
+            'winningPlan': {'stage': 'COLLSCAN'}}})
+        self.assertEqual(scan['index'], 'COLLSCAN')
+        self.assertIsNone(scan['keys_examined'])
+        self.assertEqual(summarize({'cursor': 'BasicCursor'})['index'],
+                         'COLLSCAN')
+        # a legacy collection scan examines no index keys
+        self.assertEqual(summarize({'cursor': 'BasicCursor', 'nscanned': 10,
+                                    'nscannedObjects': 10})['keys_examined'],
+                         0)
+        self.assertEqual(summarize({'queryPlanner': {
+            'winningPlan': {'stage': 'IDHACK'}}})['index'], '_id_')
+        self.assertEqual(summarize({'queryPlanner': {
+            'winningPlan': {'stage': 'EOF'}}})['index'], 'EOF')
+        self.assertRaises(ValueError, summarize, {'error': 'bad'})
+
+    def test_cardinality_guard(self):
+        update({'cardinality_guard': {'max_keys': 1}})
+        self._query_profile_sink = QueryProfileSink()
+        with instrument():
+            self.db.foo.find({'store': 'store_0'}).count()
+            self.db.foo.find({'widget': 'widget_0'}).count()
+        for msg in self._msgs:
+            self._query_profile_sink.handle(msg, ('127.0.0.1', 65535))
+        self._query_profile_sink.flush()
+        query_profile_col = QueryProfileCollection.get_collection_name()
+        queries = [doc['query'] for doc in
+                   self.sink_db[query_profile_col].find()]
+        self.assertIn(skeleton({'store': 'store_0'}), queries)
+        self.assertIn('__overflow__', queries)
+        stats = self._query_profile_sink.stats()['cardinality']
+        self.assertEqual(stats['mongodrums_test.foo']['keys'], 1)
+        self.assertGreater(stats['mongodrums_test.foo']['overflowed'], 0)
+
+    def test_cardinality_guard_churn(self):
+        guard = CardinalityGuard(10, 40)
+        admitted = set()
+        for i in xrange(100):
+            # a few real shapes among many seen only once
+            keys = ['shape_%d' % (j) for j in xrange(4)] + \
+                   ['noise_%d_%d' % (i, j) for j in xrange(20)]
+            random.shuffle(keys)
+            for key in keys:
+                if guard.admit('db.foo', key):
+                    admitted.add(key)
+        # admitted keys are never evicted, so never more than max_keys
+        self.assertLessEqual(len(admitted), 10)
+        for j in xrange(4):
+            self.assertTrue(guard.admit('db.foo', 'shape_%d' % (j)))
+
+    def test_timing(self):
+        sink = TimingSink()
+        timing = {'type': 'timing', 'session': 'test',
+                  'database': 'mongodrums_test', 'collection': 'foo',
+                  'function': 'count', 'count': 2, 'total': 3., 'min': 1.,
+                  'max': 2.}
+        sink.handle(timing, ('127.0.0.1', 65535))
+        sink.handle(dict(timing, count=1, total=5., min=5., max=5.),
+                    ('127.0.0.1', 65535))
+        # only timings are kept
+        sink.handle({'type': 'explain'}, ('127.0.0.1', 65535))
+        docs = list(self.sink_db[TimingSink.COLLECTION_NAME].find())
+        self.assertEqual(len(docs), 1)
+        self.assertEqual((docs[0]['count'], docs[0]['total'],
+                          docs[0]['min'], docs[0]['max']), (3, 8., 1., 5.))
+
+    def test_top_k(self):
+        update({'top_k_sink': {'k': 1}})
+        with instrument():
+            for i in xrange(3):
+                self.db.foo.find({'store': 'store_%d' % (i)}).count()
+            self.db.foo.find({'widget': 'widget_0'}).count()
+        top_k_sink = TopKSink()
+        for msg in self._msgs:
+            top_k_sink.handle(msg, ('127.0.0.1', 65535))
+        top = top_k_sink.top()[('mongodrums_test', 'foo')]
+        self.assertEqual([entry['query'] for entry in top['count']],
+                         [skeleton({'store': 'store_0'})])
+        top_k_sink.snapshot()
+        docs = list(self.sink_db[TopKSink.COLLECTION_NAME].find())
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(docs[0]['count'], top['count'])
+
+    def test_top_k_file(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            update({'top_k_sink': {'path': path}})
+            with instrument():
+                self.db.foo.find({'store': 'store_0'}).count()
+            top_k_sink = TopKSink()
+            for msg in self._msgs:
+                top_k_sink.handle(msg, ('127.0.0.1', 65535))
+            top_k_sink.snapshot()
+            with open(path) as f:
+                snapshots = [loads(line) for line in f]
+            self.assertEqual(len(snapshots), 1)
+            self.assertEqual(snapshots[0][0]['collection'], 'foo')
+        finally:
+            os.unlink(path)
+
+    def test_top_k_file_workers(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        worker_path = '%s.%d' % (path, os.getpid())
+        try:
+            update({'collector': {'workers': 2},
+                    'top_k_sink': {'path': path}})
+            with instrument():
+                self.db.foo.find({'store': 'store_0'}).count()
+            top_k_sink = TopKSink()
+            for msg in self._msgs:
+                top_k_sink.handle(msg, ('127.0.0.1', 65535))
+            top_k_sink.snapshot()
+            # each worker appends to a file of its own
+            self.assertEqual(os.path.getsize(path), 0)
+            with open(worker_path) as f:
+                snapshots = [loads(line) for line in f]
+            self.assertEqual(snapshots[0][0]['pid'], os.getpid())
+        finally:
+            os.unlink(path)
+            if os.path.exists(worker_path):
+                os.unlink(worker_path)
+
+    def test_top_k_snapshot_failure(self):
+        update({'top_k_sink': {'path': '/nonexistent/top_k'}})
+        with instrument():
+            self.db.foo.find({'store': 'store_0'}).count()
+        top_k_sink = TopKSink()
+        for msg in self._msgs:
+            top_k_sink.handle(msg, ('127.0.0.1', 65535))
+        self.assertRaises(IOError, top_k_sink.snapshot)
+        # what failed to be written is written on the next flush
+        self.assertTrue(top_k_sink._changed)
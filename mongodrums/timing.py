@@ -0,0 +1,108 @@
+"""
+Cheap wall clock timing of every instrumented call, pushed periodically as
+per (database, collection, function) totals
+
+"""
+
+import atexit
+import os
+import threading
+
+from .config import get_config, register_update_callback
+from .pusher import push
+
+
+class Timings(object):
+    def __new__(cls, *args, **kwargs):
+        if not hasattr(cls, '_instance'):
+            cls._instance = super(cls, Timings).__new__(cls, *args, **kwargs)
+            cls._instance._initialized = False
+        return cls._instance
+
+    def __init__(self):
+        if not self._initialized:
+            self._reset()
+            self._configure(get_config())
+            register_update_callback(self._configure)
+            self._initialized = True
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._timings = {}
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _check_fork(self):
+        # a forked child starts its own flush thread, what the parent had
+        # recorded is pushed by the parent
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _configure(self, config):
+        self._enabled = config.instrument.timing.enabled
+        self._flush_interval = config.instrument.timing.flush_interval
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='mongodrums-timings')
+            self._thread.daemon = True
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stop.wait(self._flush_interval):
+            self.flush()
+
+    def stop(self):
+        """ Stop the flush thread, pushing whatever has been recorded
+
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def record(self, database, collection, function, duration):
+        """ Record a call that took ``duration`` milliseconds
+
+        """
+        if not self._enabled:
+            return
+        key = (database, collection, function)
+        self._check_fork()
+        with self._lock:
+            timing = self._timings.get(key)
+            if timing is None:
+                self._timings[key] = [1, duration, duration, duration]
+            else:
+                timing[0] += 1
+                timing[1] += duration
+                if duration < timing[2]:
+                    timing[2] = duration
+                if duration > timing[3]:
+                    timing[3] = duration
+        if self._thread is None:
+            self._start()
+
+    def flush(self):
+        self._check_fork()
+        with self._lock:
+            timings, self._timings = self._timings, {}
+        for (database, collection, function), (count, total, min_, max_) in \
+                timings.iteritems():
+            push({'type': 'timing',
+                  'database': database,
+                  'collection': collection,
+                  'function': function,
+                  'count': count,
+                  'total': total,
+                  'min': min_,
+                  'max': max_})
+
+
+def record(database, collection, function, duration):
+    Timings().record(database, collection, function, duration)
@@ -1,6 +1,9 @@
 import re
+import threading
+import time
 import urlparse
 
+from collections import OrderedDict
 from datetime import datetime
 
 from bson.json_util import loads, dumps
@@ -11,6 +14,8 @@ from bson.errors import InvalidDocument
 from bson.objectid import ObjectId
 from bson.son import SON
 
+from ..config import get_config, register_update_callback
+
 
 BSON_TYPES = set([
     int,
@@ -29,9 +34,11 @@ BSON_TYPES = set([
     SON,
 ])
 
+UNIX_SCHEME = 'unix://'
+
 
 # _p_skeleton function courtesy of https://github.com/dcrosta/professor
-def _p_skeleton(query_part):
+def _p_skeleton(query_part, collapse=None):
     """
     Generate a "skeleton" of a document (or embedded document). A
     skeleton is a (unicode) string indicating the keys present in
@@ -45,33 +52,240 @@ def _p_skeleton(query_part):
     the type of a key or value in the document is not known to
     Professor).
 
+    The skeletons of the elements of lists under a key in ``collapse`` (a
+    set of operators, say ``$in`` and ``$or``) are deduplicated and sorted,
+    so the skeleton doesn't depend on how many elements of each shape the
+    list has, or their order.
+
+    Documents are walked with an explicit stack rather than recursively.
+    The walk is at a list or document (``container``, with its sorted
+    ``keys`` or None for a list, and whether it is a list to collapse), the
+    index ``i`` of its next element of ``n`` and the skeletons ``out`` of
+    its elements so far, and the stack holds the same of the containers it
+    is in.
+
     """
     t = type(query_part)
-    if t == list:
-        out = []
-        for element in query_part:
-            sub = skeleton(element)
-            if sub is not None:
-                out.append(sub)
-        return u'[%s]' % ','.join(out)
-    elif t in (dict, SON):
-        out = []
-        for key in sorted(query_part.keys()):
-            sub = skeleton(query_part[key])
-            if sub is not None:
-                out.append('%s:%s' % (key, sub))
-            else:
-                out.append(key)
-        return u'{%s}' % ','.join(out)
+    if t is list:
+        keys = None
+    elif t is dict or t is SON:
+        keys = sorted(query_part.keys())
     elif t not in BSON_TYPES:
         raise InvalidDocument('unknown BSON type %r' % t)
+    else:
+        return None
+    container, i, n, out = query_part, 0, len(query_part), []
+    collapsing = False
+    stack = []
+    # locals are quicker to look up than globals and attributes
+    push, pop, bson_types = stack.append, stack.pop, BSON_TYPES
+    while True:
+        if i < n:
+            element = container[i] if keys is None else container[keys[i]]
+            i += 1
+            t = type(element)
+            if t is list:
+                push((keys, container, i, n, out, collapsing))
+                collapsing = collapse is not None and keys is not None and \
+                             keys[i - 1] in collapse
+                keys, container, i, n, out = None, element, 0, len(element), []
+            elif t is dict or t is SON:
+                push((keys, container, i, n, out, collapsing))
+                collapsing = False
+                keys = sorted(element.keys())
+                container, i, n, out = element, 0, len(keys), []
+            elif t not in bson_types:
+                raise InvalidDocument('unknown BSON type %r' % t)
+            elif keys is not None:
+                out.append(keys[i - 1])
+            continue
+        if keys is None:
+            if collapsing:
+                out = sorted(set(out))
+            sub = u'[%s]' % ','.join(out)
+        else:
+            sub = u'{%s}' % ','.join(out)
+        if len(stack) == 0:
+            return sub
+        keys, container, i, n, out, collapsing = pop()
+        if keys is None:
+            out.append(sub)
+        else:
+            out.append('%s:%s' % (keys[i - 1], sub))
 
 
 def skeleton(o):
+    """ Get the skeleton of a query (a document or its json), collapsing
+    the operators in ``skeleton.collapse.operators`` if
+    ``skeleton.collapse.enabled``
+
+    """
+    cache = SkeletonCache()
     if isinstance(o, basestring):
-        o = loads(o)
-    return dumps(_p_skeleton(o))
+        return cache.skeleton(o)
+    return dumps(_p_skeleton(o, cache.collapse))
+
+
+def skeleton_stats():
+    return SkeletonCache().stats()
+
+
+def sanitize(o):
+    """
+    Make a document (usually explain output) safe to store by replacing the
+    characters mongo does not allow in keys: a leading ``$`` and ``.``
+    anywhere, with their full width unicode equivalents.
+
+    """
+    if isinstance(o, dict):
+        out = {}
+        for key, value in o.iteritems():
+            if isinstance(key, basestring):
+                if key.startswith('$'):
+                    key = u'\uff04' + key[1:]
+                key = key.replace('.', u'\uff0e')
+            out[key] = sanitize(value)
+        return out
+    elif isinstance(o, (list, tuple)):
+        return [sanitize(v) for v in o]
+    return o
+
+
+class LRUCache(object):
+    """
+    A thread safe least recently used cache holding at most ``size`` entries,
+    each of which expires ``ttl`` seconds after it was put (if ``ttl`` is
+    given). A ``size`` of 0 disables the cache.
+
+    """
+    def __init__(self, size, ttl=None):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = size
+        self._ttl = ttl
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self):
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def configure(self, size, ttl=None):
+        with self._lock:
+            self._size = size
+            self._ttl = ttl
+            self._evict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._entries.pop(key)
+            except KeyError:
+                self._misses += 1
+                return default
+            if expires is not None and expires <= time.time():
+                self._expirations += 1
+                self._misses += 1
+                return default
+            self._entries[key] = (value, expires)
+            self._hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if self._size <= 0:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = \
+                (value, time.time() + self._ttl if self._ttl else None)
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {'entries': len(self._entries),
+                    'hits': self._hits,
+                    'misses': self._misses,
+                    'evictions': self._evictions,
+                    'expirations': self._expirations,
+                    'hit_rate': float(self._hits) / lookups if lookups else 0.}
+
+
+class SkeletonCache(object):
+    """ Skeletons of recently seen query strings
+
+    Query strings are what instrumented calls push and sinks skeleton every
+    record of, so the skeletons of the ``skeleton.cache_size`` most recently
+    seen ones are kept rather than parsed and walked again. They are
+    dropped when the operators to collapse (``collapse``) change.
+
+    """
+    def __new__(cls, *args, **kwargs):
+        if not hasattr(cls, '_instance'):
+            cls._instance = super(cls, SkeletonCache).__new__(cls, *args,
+                                                              **kwargs)
+            cls._instance._initialized = False
+        return cls._instance
+
+    def __init__(self):
+        if not self._initialized:
+            self._cache = LRUCache(0)
+            self.collapse = None
+            self._configure(get_config())
+            register_update_callback(self._configure)
+            self._initialized = True
+
+    def _configure(self, config):
+        collapse = None
+        if config.skeleton.collapse.enabled:
+            collapse = frozenset(config.skeleton.collapse.operators)
+        if collapse != self.collapse:
+            # cached skeletons were collapsed differently
+            self._cache.clear()
+        self.collapse = collapse
+        self._cache.configure(config.skeleton.cache_size)
+
+    def skeleton(self, query):
+        value = self._cache.get(query)
+        if value is None:
+            value = dumps(_p_skeleton(loads(query), self.collapse))
+            self._cache.put(query, value)
+        return value
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return self._cache.stats()
+
+
+def merge_update(update, other):
+    """ Merge the operators of update ``other`` into ``update``
+
+    """
+    for op, fields in other.iteritems():
+        update.setdefault(op, {}).update(fields)
 
 
 def get_default_database(client, mongo_uri):
     return client[urlparse.urlparse(mongo_uri).path.strip('/')]
+
+
+def unix_socket_path(addr):
+    """ Get the socket path of a ``unix:///path`` address, or None for any
+    other address
+
+    """
+    if isinstance(addr, basestring) and addr.startswith(UNIX_SCHEME):
+        return addr[len(UNIX_SCHEME):]
+    return None
@@ -0,0 +1,141 @@
+import math
+
+
+class Histogram(object):
+    """
+    A mergeable, fixed precision histogram of non-negative values
+
+    Values are counted in logarithmic buckets, bucket ``i`` holding values in
+    ``[BASE ** i, BASE ** (i + 1))``, so the number of buckets grows with the
+    log of the value range rather than with the number of values. Values
+    below ``BASE ** MIN_BUCKET`` (including 0) are counted in ``MIN_BUCKET``.
+    Alongside the buckets the exact count, sum, min and max are kept.
+
+    """
+    BASE = 2 ** .25
+    MIN_BUCKET = -40
+
+    _LOG_BASE = math.log(BASE)
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def bucket(cls, value):
+        if value <= 0:
+            return cls.MIN_BUCKET
+        return max(cls.MIN_BUCKET,
+                   int(math.floor(math.log(value) / cls._LOG_BASE)))
+
+    @classmethod
+    def bucket_bounds(cls, bucket):
+        return (cls.BASE ** bucket, cls.BASE ** (bucket + 1))
+
+    def add(self, value, count=1):
+        bucket = self.bucket(value)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for bucket, count in other.buckets.iteritems():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or
+                                      other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or
+                                      other.max > self.max):
+            self.max = other.max
+
+    def subtract(self, other):
+        """ Take out the values of ``other``, an earlier copy of this
+        histogram (min and max can't be taken out so are left as is)
+
+        """
+        for bucket, count in other.buckets.iteritems():
+            count = self.buckets.get(bucket, 0) - count
+            if count > 0:
+                self.buckets[bucket] = count
+            else:
+                self.buckets.pop(bucket, None)
+        self.count -= other.count
+        self.total -= other.total
+
+    @property
+    def mean(self):
+        return float(self.total) / self.count if self.count else None
+
+    def percentile(self, q):
+        """ Estimate the ``q``th (0 - 100) percentile, to within a bucket
+
+        """
+        if self.count == 0:
+            return None
+        rank = q / 100. * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                break
+        lower, upper = self.bucket_bounds(bucket)
+        return min(max(math.sqrt(lower * upper), self.min), self.max)
+
+    def summary(self, percentiles=(50, 95, 99)):
+        """ Get the count, mean, min, max and some percentiles
+
+        """
+        summary = {'count': self.count,
+                   'mean': self.mean,
+                   'min': self.min,
+                   'max': self.max}
+        for q in percentiles:
+            summary['p%d' % (q)] = self.percentile(q)
+        return summary
+
+    def to_document(self):
+        """ Get a BSON friendly representation (bucket keys are strings)
+
+        """
+        return {'buckets': dict([(str(b), c)
+                                 for b, c in self.buckets.iteritems()]),
+                'count': self.count,
+                'sum': self.total,
+                'min': self.min,
+                'max': self.max}
+
+    def to_update(self, field):
+        """ Get the update operators that merge this histogram into one
+        stored (as by :meth:`to_document`) in ``field`` of a document,
+        creating it if need be
+
+        """
+        inc = dict([('%s.buckets.%d' % (field, b), c)
+                    for b, c in self.buckets.iteritems()])
+        inc.update({'%s.count' % (field): self.count,
+                    '%s.sum' % (field): self.total})
+        update = {'$inc': inc}
+        if self.count > 0:
+            update.update({'$min': {'%s.min' % (field): self.min},
+                           '$max': {'%s.max' % (field): self.max}})
+        return update
+
+    @classmethod
+    def from_document(cls, doc):
+        histogram = cls()
+        histogram.buckets = dict([(int(b), c) for b, c in
+                                  doc.get('buckets', {}).iteritems()])
+        histogram.count = doc.get('count', 0)
+        histogram.total = doc.get('sum', 0)
+        histogram.min = doc.get('min')
+        histogram.max = doc.get('max')
+        return histogram
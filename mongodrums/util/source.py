@@ -0,0 +1,49 @@
+import sys
+
+
+class SourceResolver(object):
+    """ Resolve the first stack frame outside of a set of filtered packages
+
+    Walks frames via their ``f_back`` link instead of building the full stack
+    with :func:`inspect.stack` (which also reads source context from disk) and
+    caches the filtered/not filtered decision per code object.
+
+    :param filter_packages:     packages (compared against a frame's
+                                ``__package__`` global) to skip over
+
+    """
+    def __init__(self, filter_packages):
+        self._filter_packages = frozenset(filter_packages)
+        self._filtered = {}
+
+    @property
+    def filter_packages(self):
+        return self._filter_packages
+
+    def _is_filtered(self, frame):
+        code = frame.f_code
+        try:
+            return self._filtered[code]
+        except KeyError:
+            filtered = \
+                frame.f_globals.get('__package__') in self._filter_packages
+            self._filtered[code] = filtered
+            return filtered
+
+    def resolve(self, frame=None):
+        """ Get the ``file:line`` of the first unfiltered frame
+
+        :param frame:   the frame to start walking from [default: the caller's
+                        frame]
+
+        """
+        if frame is None:
+            frame = sys._getframe(1)
+        try:
+            while frame is not None and self._is_filtered(frame):
+                frame = frame.f_back
+            if frame is None:
+                return None
+            return '%s:%d' % (frame.f_code.co_filename, frame.f_lineno)
+        finally:
+            del frame
@@ -0,0 +1,142 @@
+"""
+Fixed memory heavy hitter tracking with the space-saving algorithm
+(Metwally, Agrawal and El Abbadi, "Efficient Computation of Frequent and
+Top-k Elements in Data Streams")
+
+"""
+
+import heapq
+
+
+class SpaceSaving(object):
+    """
+    Approximate weighted counts of the heaviest of a stream of keys, in at
+    most ``size`` counters
+
+    Once every counter is in use, a new key takes over the counter with the
+    smallest count, starting from that count. So a key's count is never
+    under its true count, and over it by at most its ``error`` (the count it
+    took over). Any key whose true count is over ``total / size`` is
+    tracked.
+
+    """
+    def __init__(self, size):
+        self.size = size
+        self.total = 0
+        self._counts = {}
+        self._errors = {}
+        # (count, key) of every tracked key, counts are only updated when
+        # they reach the top of the heap (they only ever grow)
+        self._heap = []
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __contains__(self, key):
+        return key in self._counts
+
+    def _min(self):
+        while True:
+            count, key = self._heap[0]
+            if self._counts[key] == count:
+                return count, key
+            heapq.heapreplace(self._heap, (self._counts[key], key))
+
+    def add(self, key, weight=1):
+        """ Count ``weight`` for ``key``, returning the key whose counter it
+        took over, if it did
+
+        """
+        self.total += weight
+        if key in self._counts:
+            self._counts[key] += weight
+            return None
+        if len(self._counts) < self.size:
+            self._counts[key] = weight
+            self._errors[key] = 0
+            heapq.heappush(self._heap, (weight, key))
+            return None
+        count, evicted = self._min()
+        del self._counts[evicted]
+        del self._errors[evicted]
+        self._counts[key] = count + weight
+        self._errors[key] = count
+        heapq.heapreplace(self._heap, (count + weight, key))
+        return evicted
+
+    def count(self, key):
+        return self._counts.get(key, 0)
+
+    def error(self, key):
+        return self._errors.get(key, 0)
+
+    def top(self, n=None):
+        """ Get the ``n`` (or all) heaviest keys as ``(key, count, error)``,
+        heaviest first
+
+        """
+        top = sorted(self._counts.iteritems(), key=lambda x: x[1],
+                     reverse=True)
+        if n is not None:
+            top = top[:n]
+        return [(key, count, self._errors[key]) for key, count in top]
+
+
+class CardinalityGuard(object):
+    """
+    Bound the number of distinct keys (query shapes, say) admitted per
+    collection
+
+    At most ``max_keys`` keys are admitted per collection, and once
+    admitted a key stays admitted, so what is kept per collection is bounded
+    however many keys are seen. The first half of a collection's keys are
+    admitted as they come. Past that a key is a candidate, counted in a
+    :class:`SpaceSaving` of ``candidates`` counters, and is only admitted if
+    it is seen again while still counted. So keys only ever seen once
+    (values interpolated into queries) don't use up the rest, while keys
+    seen more often than the candidates churn still get in. A ``max_keys``
+    of 0 admits everything.
+
+    """
+    OVERFLOW = '__overflow__'
+
+    def __init__(self, max_keys, candidates):
+        self._max_keys = max_keys
+        self._candidates = candidates
+        self._admitted = {}
+        self._tables = {}
+        self._overflowed = {}
+
+    def admit(self, collection, key, weight=1):
+        """ Count ``weight`` for ``key`` in ``collection``, returning
+        whether it is admitted
+
+        """
+        if self._max_keys <= 0:
+            return True
+        admitted = self._admitted.get(collection)
+        if admitted is None:
+            admitted = self._admitted[collection] = set()
+            self._tables[collection] = SpaceSaving(self._candidates)
+            self._overflowed[collection] = 0
+        if key in admitted:
+            return True
+        if len(admitted) < self._max_keys:
+            table = self._tables[collection]
+            if len(admitted) < (self._max_keys + 1) // 2 or key in table:
+                admitted.add(key)
+                return True
+            table.add(key, weight)
+        self._overflowed[collection] += weight
+        return False
+
+    def stats(self):
+        """ Get the number of keys admitted, candidates counted and weight
+        overflowed per collection
+
+        """
+        return dict([(collection,
+                      {'keys': len(admitted),
+                       'candidates': len(self._tables[collection]),
+                       'overflowed': self._overflowed[collection]})
+                     for collection, admitted in self._admitted.iteritems()])
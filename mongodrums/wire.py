@@ -0,0 +1,227 @@
+"""
+The datagram format shared by :mod:`mongodrums.pusher` and
+:mod:`mongodrums.collector`
+
+A binary datagram starts with a three byte header -- ``MAGIC``, the format
+version and a flags byte -- followed by a BSON document, or with
+``FLAG_BATCH`` set, several BSON documents back to back (each is length
+prefixed so they need no further framing). With ``FLAG_JSON`` the body is
+JSON text instead, and with ``FLAG_ZLIB`` the body is zlib compressed.
+Anything not starting with ``MAGIC`` is taken to be a legacy JSON datagram.
+
+Datagrams that are too large to send are split by :func:`fragment` into
+``FLAG_FRAGMENT`` datagrams, each carrying a ``FRAGMENT_HEADER`` (message
+id, fragment index and fragment count) and a slice of the original
+datagram, which :class:`Reassembler` puts back together.
+
+"""
+
+import struct
+import time
+import zlib
+
+from collections import OrderedDict
+
+from bson import BSON, decode_all
+from bson.json_util import dumps, loads
+
+
+MAGIC = '\xd7'
+VERSION = 1
+
+FLAG_BATCH = 0x01
+FLAG_ZLIB = 0x02
+FLAG_FRAGMENT = 0x04
+FLAG_JSON = 0x08
+
+HEADER = struct.Struct('!cBB')
+FRAGMENT_HEADER = struct.Struct('!QHH')
+
+FORMATS = ('bson', 'json')
+
+JSON_BATCH_PREFIX = '{"type": "batch", "msgs": ['
+JSON_BATCH_SUFFIX = ']}'
+
+
+def encode_body(msg, format_='bson'):
+    """ Serialize a single message, see :func:`pack` and :func:`pack_batch`
+
+    """
+    if format_ == 'bson':
+        return BSON.encode(msg)
+    elif format_ == 'json':
+        return dumps(msg)
+    raise ValueError('unknown wire format %s' % (format_))
+
+
+def _frame(body, format_, flags, compress_threshold):
+    if compress_threshold > 0 and len(body) > compress_threshold:
+        flags |= FLAG_ZLIB
+        body = zlib.compress(body)
+    if format_ == 'json':
+        if not flags & FLAG_ZLIB:
+            return body
+        flags |= FLAG_JSON
+    return HEADER.pack(MAGIC, VERSION, flags) + body
+
+
+def pack(body, format_='bson', compress_threshold=0):
+    """ Frame a body from :func:`encode_body` as a datagram
+
+    :param compress_threshold:  compress bodies larger than this many bytes
+                                [default: never compress]
+
+    """
+    return _frame(body, format_, 0, compress_threshold)
+
+
+def pack_batch(bodies, format_='bson', compress_threshold=0):
+    """ Frame several bodies from :func:`encode_body` as one datagram
+
+    """
+    if format_ == 'bson':
+        return _frame(''.join(bodies), format_, FLAG_BATCH,
+                      compress_threshold)
+    return _frame(JSON_BATCH_PREFIX + ','.join(bodies) + JSON_BATCH_SUFFIX,
+                  format_, 0, compress_threshold)
+
+
+def batch_overhead(format_='bson'):
+    """ Get the (fixed, per element) bytes :func:`pack_batch` adds
+
+    """
+    if format_ == 'bson':
+        return (HEADER.size, 0)
+    return (len(JSON_BATCH_PREFIX) + len(JSON_BATCH_SUFFIX), 1)
+
+
+def encode(msg, format_='bson', compress_threshold=0):
+    return pack(encode_body(msg, format_), format_, compress_threshold)
+
+
+def fragment(datagram, max_size, msg_id):
+    """ Split a datagram into fragments of at most ``max_size`` bytes
+
+    """
+    overhead = HEADER.size + FRAGMENT_HEADER.size
+    if max_size <= overhead:
+        raise ValueError('max_size must be larger than %d' % (overhead))
+    chunk_size = max_size - overhead
+    count = (len(datagram) + chunk_size - 1) // chunk_size
+    if count > 0xffff:
+        raise ValueError('datagram too large to fragment')
+    header = HEADER.pack(MAGIC, VERSION, FLAG_FRAGMENT)
+    return [header + FRAGMENT_HEADER.pack(msg_id, i, count) +
+            datagram[i * chunk_size:(i + 1) * chunk_size]
+            for i in xrange(count)]
+
+
+def is_fragment(data):
+    return data[:1] == MAGIC and len(data) >= HEADER.size and \
+           ord(data[2]) & FLAG_FRAGMENT != 0
+
+
+class _Partial(object):
+    def __init__(self, count, created):
+        self.count = count
+        self.created = created
+        self.chunks = {}
+        self.size = 0
+
+
+class Reassembler(object):
+    """ Put fragmented datagrams back together
+
+    Partially received datagrams are dropped once they are older than
+    ``timeout`` seconds, or (oldest first) when the fragments held exceed
+    ``max_bytes``.
+
+    """
+    def __init__(self, timeout=5, max_bytes=2**24):
+        self._timeout = timeout
+        self._max_bytes = max_bytes
+        self._pending = OrderedDict()
+        self._bytes = 0
+        self._stats = {'completed': 0, 'expired': 0, 'evicted': 0}
+
+    def _drop(self, key, stat):
+        partial = self._pending.pop(key)
+        self._bytes -= partial.size
+        self._stats[stat] += 1
+
+    def _expire(self, now):
+        while len(self._pending) > 0:
+            key = next(iter(self._pending))
+            if self._pending[key].created + self._timeout > now:
+                break
+            self._drop(key, 'expired')
+
+    def add(self, source, data):
+        """ Add a fragment, returning the reassembled datagram once the last
+        fragment for it has arrived
+
+        :param source:  where the fragment came from, fragment message ids
+                        are only unique per source
+
+        """
+        msg_id, index, count = \
+            FRAGMENT_HEADER.unpack_from(data, HEADER.size)
+        if index >= count:
+            raise ValueError('bad fragment %d of %d' % (index, count))
+        now = time.time()
+        self._expire(now)
+        key = (source, msg_id)
+        partial = self._pending.get(key)
+        if partial is None:
+            partial = self._pending[key] = _Partial(count, now)
+        elif partial.count != count:
+            self._drop(key, 'evicted')
+            raise ValueError('fragment count mismatch for message %d' %
+                             (msg_id))
+        if index in partial.chunks:
+            return None
+        chunk = data[HEADER.size + FRAGMENT_HEADER.size:]
+        partial.chunks[index] = chunk
+        partial.size += len(chunk)
+        self._bytes += len(chunk)
+        if len(partial.chunks) == partial.count:
+            self._drop(key, 'completed')
+            return ''.join([partial.chunks[i] for i in xrange(count)])
+        while self._bytes > self._max_bytes and len(self._pending) > 0:
+            self._drop(next(iter(self._pending)), 'evicted')
+        return None
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats.update({'pending': len(self._pending), 'bytes': self._bytes})
+        return stats
+
+
+def decode(data):
+    """ Get the messages carried by a (complete, not fragmented) datagram
+
+    Binary datagrams with an unsupported version raise :class:`ValueError`,
+    data that is neither binary nor JSON is returned as is.
+
+    """
+    if data[:1] == MAGIC:
+        _, version, flags = HEADER.unpack_from(data)
+        if version != VERSION:
+            raise ValueError('unsupported wire format version %d' % (version))
+        if flags & FLAG_FRAGMENT:
+            raise ValueError('fragments need to be reassembled first')
+        body = data[HEADER.size:]
+        if flags & FLAG_ZLIB:
+            body = zlib.decompress(body)
+        if flags & FLAG_JSON:
+            return decode(body)
+        # batched or not the body is a run of BSON documents
+        return decode_all(body)
+    try:
+        if data.strip()[0] == '{':
+            data = loads(data)
+    except (ValueError, IndexError):
+        pass
+    if isinstance(data, dict) and data.get('type') == 'batch':
+        return data['msgs']
+    return [data]
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import socket
+import sys
+import time
+import urllib2
+
+from argparse import ArgumentParser
+
+from mongodrums.capture import read_capture
+from mongodrums.config import get_config
+from mongodrums.util import unix_socket_path
+from mongodrums.util.histogram import Histogram
+
+
+class Replayer(object):
+    """ Send the datagrams of a capture file to a collector
+
+    Datagrams from each source address in the capture are sent from their own
+    socket (up to ``max_sources`` sockets), so fragments are reassembled and
+    ``SO_REUSEPORT`` workers are picked as they were when captured.
+
+    """
+    def __init__(self, addr, port, speed=1., max_sources=256):
+        self._unix_path = unix_socket_path(addr)
+        self._addr = self._unix_path or (addr, port)
+        self._speed = speed
+        self._max_sources = max_sources
+        self._socks = {}
+
+    def _sock(self, source):
+        key = hash(source) % self._max_sources
+        sock = self._socks.get(key)
+        if sock is None:
+            family = socket.AF_UNIX if self._unix_path else socket.AF_INET
+            sock = self._socks[key] = socket.socket(family, socket.SOCK_DGRAM)
+        return sock
+
+    def replay(self, path):
+        """ Replay a capture, returning the number of datagrams and bytes
+        sent, and how long sending took
+
+        """
+        sent = bytes_ = 0
+        start = first = None
+        for timestamp, source, data in read_capture(path):
+            now = time.time()
+            if start is None:
+                start, first = now, timestamp
+            elif self._speed > 0:
+                delay = (timestamp - first) / self._speed - (now - start)
+                if delay > 0:
+                    time.sleep(delay)
+            try:
+                self._sock(source).sendto(data, self._addr)
+            except socket.error as e:
+                logging.warning('failed to send datagram: %s' % (e))
+                continue
+            sent += 1
+            bytes_ += len(data)
+        return sent, bytes_, time.time() - start if start is not None else 0
+
+
+def _add(a, b):
+    if isinstance(a, dict) and isinstance(b, dict):
+        if 'buckets' in a:
+            histogram = Histogram.from_document(a)
+            histogram.merge(Histogram.from_document(b))
+            return histogram.to_document()
+        added = dict(b)
+        added.update([(key, _add(value, b[key]) if key in b else value)
+                      for key, value in a.iteritems()])
+        return added
+    if a is None or b is None:
+        return None
+    if isinstance(a, (int, long, float)) and isinstance(b, (int, long, float)):
+        return a + b
+    return a
+
+
+def _get_stats(stats_urls):
+    """ Get the stats of every collector worker, added up
+
+    """
+    return reduce(_add, [json.loads(urllib2.urlopen(url +
+                                                    '/histograms').read())
+                         for url in stats_urls])
+
+
+def _wait_drained(stats_urls, timeout):
+    """ Wait for the collector's sink queues to empty and its datagram count
+    to stop changing
+
+    """
+    deadline = time.time() + timeout
+    last = None
+    while time.time() < deadline:
+        stats = _get_stats(stats_urls)
+        queued = sum([s['queued'] for s in stats['sinks'].itervalues()])
+        if queued == 0 and stats['receive']['datagrams'] == last:
+            return stats
+        last = stats['receive']['datagrams']
+        time.sleep(.5)
+    logging.warning('collector did not drain in %d seconds' % (timeout))
+    return stats
+
+
+def _delta_summary(after, before):
+    histogram = Histogram.from_document(after)
+    histogram.subtract(Histogram.from_document(before))
+    return histogram.summary()
+
+
+def _report(sent, bytes_, elapsed, drained, before, after):
+    report = {'sent': {'datagrams': sent,
+                       'bytes': bytes_,
+                       'seconds': elapsed,
+                       'datagrams_per_second': sent / elapsed
+                                               if elapsed else None,
+                       'bytes_per_second': bytes_ / elapsed
+                                           if elapsed else None}}
+    if before is None:
+        return report
+    received = (after['receive']['datagrams'] -
+                before['receive']['datagrams'])
+    report['received'] = {
+        'datagrams': received,
+        'messages': (after['receive']['messages'] -
+                     before['receive']['messages']),
+        'decode_errors': (after['receive']['decode_errors'] -
+                          before['receive']['decode_errors']),
+        'lost': sent - received,
+        'loss': float(sent - received) / sent if sent else 0.,
+        'seconds': drained,
+        'datagrams_per_second': received / drained if drained else None,
+        'decode_ms': _delta_summary(after['decode_ms'], before['decode_ms'])}
+    if after['kernel'] is not None and before['kernel'] is not None:
+        report['received']['kernel_drops'] = \
+            after['kernel']['drops'] - before['kernel']['drops']
+    report['sinks'] = {}
+    for name, sink in after['sinks'].iteritems():
+        sink_before = before['sinks'][name]
+        report['sinks'][name] = dict(
+            [(key, sink[key] - sink_before[key])
+             for key in ['handled', 'dropped', 'errors', 'spooled']])
+        for key in ['wait_ms', 'handle_ms']:
+            report['sinks'][name][key] = \
+                _delta_summary(sink[key], sink_before[key])
+    return report
+
+
+def main():
+    config = get_config()
+
+    parser = ArgumentParser(description='replay a collector capture file to '
+                                        'a collector and report how it did')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log debug output [default: %(default)s]')
+    parser.add_argument(
+        '--addr', default=config.collector.addr, metavar='ADDR',
+        help='the collector address, unix:///path for a unix socket '
+             '[default: %(default)s]')
+    parser.add_argument(
+        '--port', default=config.collector.port, type=int, metavar='PORT',
+        help='the collector port [default: %(default)s]')
+    parser.add_argument(
+        '--speed', default=1., type=float, metavar='N',
+        help='replay at N times the captured rate, 0 to send as fast as '
+             'possible [default: %(default)s]')
+    parser.add_argument(
+        '--workers', default=config.collector.workers, type=int, metavar='N',
+        help='the number of collector workers, whose stats are added up, '
+             'worker i serving them on the stats port + i '
+             '[default: %(default)s]')
+    parser.add_argument(
+        '--stats-port', default=config.collector.stats.port, type=int,
+        metavar='PORT', help='the collector\'s --stats-port, used to report '
+                             'loss and sink latency, without it only what '
+                             'was sent is reported [default: %(default)s]')
+    parser.add_argument(
+        '--stats-url', metavar='URL', action='append',
+        help='a collector stats endpoint, repeated for each worker, instead '
+             'of those on --stats-port, "none" to only report what was sent '
+             '[default: http://%s:<stats port> and the ports after it for '
+             'each worker]' % (config.collector.stats.addr))
+    parser.add_argument(
+        '--drain-timeout', default=60, type=float, metavar='SECONDS',
+        help='how long to wait for the collector to handle everything '
+             'sent [default: %(default)s]')
+    parser.add_argument('capture', metavar='PATH',
+                        help='the capture file to replay')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    if args.stats_url is None and args.stats_port is not None:
+        # every worker has to be asked, each only sees its share of the
+        # datagrams
+        stats_urls = ['http://%s:%d' % (config.collector.stats.addr,
+                                        args.stats_port + i)
+                      for i in xrange(args.workers)]
+    elif args.stats_url is None or args.stats_url == ['none']:
+        stats_urls = None
+    else:
+        stats_urls = [url.rstrip('/') for url in args.stats_url]
+    before = after = None
+    if stats_urls is not None:
+        before = _get_stats(stats_urls)
+    replayer = Replayer(args.addr, args.port, args.speed)
+    start = time.time()
+    sent, bytes_, elapsed = replayer.replay(args.capture)
+    if stats_urls is not None:
+        after = _wait_drained(stats_urls, args.drain_timeout)
+    drained = time.time() - start
+    print json.dumps(_report(sent, bytes_, elapsed, drained, before, after),
+                     indent=4, sort_keys=True)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,13 +14,48 @@ from mongodrums.collection import (
     SessionCollection, IndexProfileCollection, QueryProfileCollection
 )
 from mongodrums.util import get_default_database
+from mongodrums.util.histogram import Histogram
 
 
 _DEFAULT_URI = 'mongodb://localhost:27017/mongodrums'
+# how many query shapes to list by scan efficiency
+_TOP_SCANS = 20
+_SCAN_RATIOS = ('docs_per_returned', 'keys_per_returned')
 _INDEXES_TO_SKIP = [re.compile(r'BasicCursor.*'),
+                    re.compile(r'COLLSCAN$'),
+                    re.compile(r'EOF$'),
                     re.compile(r'(BtreeCursor )?_id_( .+)?')]
 
 
+def _index_name(index):
+    # profiles written from legacy explains have the cursor, 'BtreeCursor
+    # a_1' or 'BtreeCursor a_1 reverse'
+    if index.startswith('BtreeCursor '):
+        return index.split()[1]
+    return index
+
+
+def _index_names(index):
+    # plans using several indexes ($or queries) name them all, joined by ','
+    return [_index_name(name) for name in index.split(',')]
+
+
+def _queries(doc):
+    # profiles no collector has migrated yet keep their queries in a list
+    queries = doc['queries']
+    if isinstance(queries, dict):
+        return queries.values()
+    return queries
+
+
+def _latency(query):
+    # profiles written before durations were histograms have arrays
+    durations = query.get('durations')
+    if not isinstance(durations, dict):
+        return None
+    return Histogram.from_document(durations).summary()
+
+
 def _get_size(bytes_, unit):
     conv= {'b': ('bytes', 2**0),
            'k': ('Kbs', 2**10),
@@ -39,6 +74,25 @@ class Report(object):
         self._output_stream = output_stream
         self._session = session
         self._unit = unit
+        # scan efficiency per (collection, index, query)
+        self._scans = {}
+
+    def _add_scans(self, doc):
+        for q in _queries(doc):
+            scan = q.get('scan')
+            if not isinstance(scan, dict) or \
+                    'docs_per_returned' not in scan:
+                continue
+            key = (doc['collection'], doc['index'], q['query'])
+            if key not in self._scans:
+                self._scans[key] = {'count': 0, 'scan_and_order': 0}
+                for ratio in _SCAN_RATIOS:
+                    self._scans[key][ratio] = Histogram()
+            entry = self._scans[key]
+            entry['count'] += q['count']
+            entry['scan_and_order'] += scan.get('scan_and_order', 0)
+            for ratio in _SCAN_RATIOS:
+                entry[ratio].merge(Histogram.from_document(scan[ratio]))
 
     def build(self):
         index_col = \
@@ -49,53 +103,68 @@ class Report(object):
                 self._database[QueryProfileCollection.get_collection_name()])
         query = {} if self._session is None else {'session': self._session}
         for doc in index_col.find_iter(query):
-            if any([r.match(doc['index']) for r in _INDEXES_TO_SKIP]):
-                continue
-            logging.debug('working on index %s in collection %s' %
-                          (doc['index'], doc['collection']))
-            index_name = doc['index'].split()[1]
+            # collection scans are skipped below but are the worst scans
+            self._add_scans(doc)
+            # a plan using several indexes credits each of them
+            for index_name in _index_names(doc['index']):
+                if any([r.match(index_name) for r in _INDEXES_TO_SKIP]):
+                    continue
+                try:
+                    self._add_index(query_col, doc, index_name)
+                except KeyError:
+                    logging.warning('skipping index %s on collection %s:\n%s'
+                                    % (index_name, doc['collection'],
+                                       traceback.format_exc()))
+
+    def _add_index(self, query_col, doc, index_name):
+        logging.debug('working on index %s in collection %s' %
+                      (index_name, doc['collection']))
+        stats = self._current_indexes[doc['collection']].get('__stats', None)
+        index = self._current_indexes[doc['collection']][index_name]
+        # indexes are credited by every profile naming them, one per session
+        # and plan
+        doc_queries = _queries(doc)
+        queries = index.setdefault('queries', {})
+        latencies = index.setdefault('latencies', {})
+        for q in doc_queries:
+            queries.setdefault(q['query'], {})
+            latencies[q['query']] = _latency(q)
+        index['query_count'] = len(queries)
+        index['used_count'] = index.get('used_count', 0) + \
+                              sum([q['count'] for q in doc_queries])
+        if stats is not None:
+            index['total_size'] = stats['indexSizes'][index_name]
             try:
-                stats = self._current_indexes[doc['collection']].get('__stats',
-                                                                     None)
-                index = self._current_indexes[doc['collection']][index_name]
-                index['query_count'] = len(doc['queries'])
-                index['used_count'] = sum([q['count'] for q in doc['queries']])
-                index['queries'] = dict([(q['query'], {}) for q in doc['queries']])
-                if stats is not None:
-                    index['total_size'] = stats['indexSizes'][index_name]
-                    try:
-                        index['index_size_ratio'] = (float(index['total_size']) /
-                                                     stats['totalIndexSize'])
-                    except ZeroDivisionError:
-                        index['index_size_ratio'] = float(index['total_size'])
-                    try:
-                        index['collection_size_ratio'] = \
-                            float(index['total_size']) / stats['size']
-                    except ZeroDivisionError:
-                        index['collection_size_ratio'] = float(index['total_size'])
-                    # FIXME: make this more meaningful
-                    index['removal_score'] = index['index_size_ratio'] * \
-                                             index['collection_size_ratio']
-
-                for q in doc['queries']:
-                    logging.debug('gathering query informatin for index %s, ' \
-                                  'query %s' % (doc['index'], q['query']))
-                    query = {'query': q['query'],
-                             'collection': doc['collection'],
-                             'explain.cursor': doc['index']}
-                    if self._session is not None:
-                        query.update({'session': self._session})
-                    for query_doc in query_col.find_iter(query):
-                        queries = \
-                            self._current_indexes[doc['collection']][index_name]['queries']
-                        if query_doc['source'] not in queries[q['query']]:
-                            queries[q['query']][query_doc['source']] = 0
-                        queries[q['query']][query_doc['source']] += 1
-
-            except KeyError:
-                logging.warning('skipping index %s on collection %s:\n%s' %
-                                (index_name, doc['collection'],
-                                 traceback.format_exc()))
+                index['index_size_ratio'] = (float(index['total_size']) /
+                                             stats['totalIndexSize'])
+            except ZeroDivisionError:
+                index['index_size_ratio'] = float(index['total_size'])
+            try:
+                index['collection_size_ratio'] = \
+                    float(index['total_size']) / stats['size']
+            except ZeroDivisionError:
+                index['collection_size_ratio'] = float(index['total_size'])
+            # FIXME: make this more meaningful
+            index['removal_score'] = index['index_size_ratio'] * \
+                                     index['collection_size_ratio']
+
+        logging.debug('gathering query information for index %s' %
+                      (doc['index']))
+        # one lookup for every query of the profile, query profiles are
+        # deduplicated with a count of how often they were seen, bar those
+        # stored one per sample that no collector has migrated yet
+        query = {'session': doc['session'],
+                 'collection': doc['collection'],
+                 '$or': [{'index': doc['index']},
+                         {'count': {'$exists': False},
+                          'explain.cursor': doc['index']}]}
+        for query_doc in query_col.find_iter(query):
+            if query_doc['query'] not in queries:
+                continue
+            sources = queries[query_doc['query']]
+            sources[query_doc['source']] = \
+                sources.get(query_doc['source'], 0) + \
+                query_doc.get('count', 1)
 
     def _print(self, str_):
         self._output_stream.write(str_ + '\n')
@@ -124,7 +193,14 @@ class Report(object):
                                 (index['used_count'], index['query_count'],
                                  ['y', 'ies'][index['query_count'] > 0]))
                     for q in index['queries']:
-                        self._print('    * %s' % (q))
+                        latency = index['latencies'].get(q)
+                        if latency is None or latency['count'] == 0:
+                            self._print('    * %s' % (q))
+                        else:
+                            self._print('    * %s (p50 %.1fms, p95 %.1fms, '
+                                        'p99 %.1fms)' %
+                                        (q, latency['p50'], latency['p95'],
+                                         latency['p99']))
                         for line in index['queries'][q]:
                             self._print('        * %s hit %d times' % 
                                         (line, index['queries'][q][line]))
@@ -147,6 +223,28 @@ class Report(object):
                     total_size = index['total_size']
                 self._print('* total size is %s' % (total_size))
             self._print('\n---\n')
+        self._dump_scans_mark_down()
+
+    def _dump_scans_mark_down(self):
+        self._print('# query shapes by documents examined per document '
+                    'returned')
+        ranked = sorted(
+            self._scans.iteritems(),
+            key=lambda x: x[1]['docs_per_returned'].mean, reverse=True)
+        if len(ranked) == 0:
+            self._print('\n* no scan metrics were profiled')
+        for (col, index, q), scan in ranked[:_TOP_SCANS]:
+            docs = scan['docs_per_returned']
+            keys = scan['keys_per_returned']
+            self._print('\n## `%s` in %s using `%s`' % (q, col, index))
+            self._print('* %.1f documents examined per document returned '
+                        '(p50 %.1f, p95 %.1f, p99 %.1f)' %
+                        (docs.mean, docs.percentile(50),
+                         docs.percentile(95), docs.percentile(99)))
+            self._print('* %.1f index keys examined per document returned '
+                        '(p95 %.1f)' % (keys.mean, keys.percentile(95)))
+            self._print('* sorted in memory %d of %d times' %
+                        (scan['scan_and_order'], scan['count']))
 
     def dump_json(self):
         pass
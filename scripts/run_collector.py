@@ -12,7 +12,9 @@ from argparse import ArgumentParser
 
 from mongodrums.collector import CollectorRunner
 from mongodrums.config import get_config, update
-from mongodrums.sink import QueryProfileSink, IndexProfileSink
+from mongodrums.sink import (
+    QueryProfileSink, IndexProfileSink, TimingSink, TopKSink
+)
 from mongodrums.util.daemon import Daemonize
 
 
@@ -30,15 +32,35 @@ class Collector(Daemonize):
                     'session': self.args.session,
                     'mongo_uri': self.args.uri,
                     'addr': self.args.addr,
-                    'port': self.args.port
+                    'port': self.args.port,
+                    'workers': self.args.workers,
+                    'stats': {'port': self.args.stats_port},
+                    'spool': {'directory': self.args.spool_dir},
+                    'capture': self.args.capture
                 },
                 'index_profile_sink': {
                     'mongo_uri': self.args.uri
                  },
                 'query_profile_uri': {
                     'mongo_uri': self.args.uri
+                },
+                'timing_sink': {
+                    'mongo_uri': self.args.uri
+                },
+                'top_k_sink': {
+                    'mongo_uri': self.args.uri,
+                    'path': self.args.top_k_path
                 }})
-        collector = CollectorRunner([IndexProfileSink(), QueryProfileSink()])
+        top_k = self.args.top_k or self.args.top_k_path is not None
+
+        # called in each worker so every worker gets its own sinks
+        def sinks():
+            sinks = [IndexProfileSink(), QueryProfileSink(), TimingSink()]
+            if top_k:
+                sinks.append(TopKSink())
+            return sinks
+
+        collector = CollectorRunner(sinks)
         collector.start()
         while not should_exit:
             time.sleep(.1)
@@ -91,7 +113,34 @@ def main():
         help='the port to listen on [default: %(default)s]')
     parser.add_argument(
         '--addr', default=config.collector.addr, metavar='ADDR',
-        help='the address to listen on [default: %(default)s]')
+        help='the address to listen on, unix:///path for a unix socket '
+             '[default: %(default)s]')
+    parser.add_argument(
+        '-w', '--workers', default=config.collector.workers, type=int,
+        metavar='N', help='the number of collector processes sharing the '
+                          'address, more than one needs a udp address '
+                          '[default: %(default)s]')
+    parser.add_argument(
+        '--stats-port', default=config.collector.stats.port, type=int,
+        metavar='PORT', help='serve collector stats over http on this port, '
+                             'worker i on PORT + i [default: %(default)s]')
+    parser.add_argument(
+        '--spool-dir', default=config.collector.spool.directory,
+        metavar='PATH', help='spool data sinks can\'t keep up with to this '
+                             'directory [default: %(default)s]')
+    parser.add_argument(
+        '--capture', default=config.collector.capture, metavar='PATH',
+        help='record the datagrams received to this capture file, for '
+             'replay_capture.py [default: %(default)s]')
+    parser.add_argument(
+        '--top-k', action='store_true',
+        help='track the heaviest query shapes of each collection, writing '
+             'snapshots to the database [default: %(default)s]')
+    parser.add_argument(
+        '--top-k-path', default=config.top_k_sink.path, metavar='PATH',
+        help='track the heaviest query shapes of each collection, appending '
+             'snapshots to this file, suffixed with .<pid> for each worker '
+             'when there are several [default: %(default)s]')
 
     args = parser.parse_args()
 